@@ -2,9 +2,17 @@ import serverconn
 import job
 import errors
 import protohandler
-__all__ = [protohandler, serverconn, errors, job]
+import keepalive
+import worker
+main = worker.main
+__all__ = [protohandler, serverconn, errors, job, keepalive, worker]
 try:
     import twisted_client
     __all__.append(twisted_client)
 except ImportError:
     pass
+try:
+    import asyncio_client
+    __all__.append(asyncio_client)
+except ImportError:
+    pass
@@ -0,0 +1,183 @@
+"""
+asyncio client for beanstalkd.
+
+AsyncioConn is an asyncio Protocol. Its protocol methods (put, reserve,
+delete, ...) send the command right away and return a Future for the reply,
+so any number of commands can be in flight on one connection; the replies
+come back in the order the commands were sent, and each resolves its own
+future.
+
+Like the rest of the package this is Python 2 code, so it runs on trollius,
+the Python 2 port of asyncio, where futures are waited on with
+"yield From(...)" in a coroutine:
+
+    from trollius import From, coroutine
+
+    @coroutine
+    def work():
+        conn = yield From(asyncio_client.connect('localhost', 11300,
+                                                 job=asyncio_client.AsyncioJob))
+        jid = (yield From(conn.put('foo')))['jid']
+        job = yield From(conn.reserve())
+        yield From(job.Finish())
+"""
+
+from collections import deque
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+import protohandler
+import errors
+from job import Job, honorimmutable
+
+
+class AsyncioConn(asyncio.Protocol):
+    """An asyncio beanstalk connection. Use connect() to make one.
+
+    job works as it does for ServerConn: if it is set, replies about a job
+    are turned into job objects. It has to be AsyncioJob or a subclass of it:
+    the methods of job.Job wait for the reply, which they can't do here.
+    """
+    def __init__(self, job = False, loop = None):
+        self.job = job
+        self.loop = loop or asyncio.get_event_loop()
+        self.transport = None
+        self._reader = protohandler.ResponseReader()
+        self._waiting = deque()
+
+    def __repr__(self):
+        s = "<[%(active)s]%(class)s(%(peer)s)>"
+        active_ = "Open" if self.transport else "Closed"
+        peer = self.transport.get_extra_info('peername') \
+            if self.transport else None
+        return s % {"class" : self.__class__.__name__, "active" : active_,
+                    "peer" : peer}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+        waiting, self._waiting = self._waiting, deque()
+        self._reader.reset()
+        for future in waiting:
+            if not future.done():
+                future.set_exception(errors.NotConnected(
+                    'Connection lost: %s' % (exc,)))
+
+    def data_received(self, data):
+        for res in self._reader.feed(data):
+            future = self._waiting.popleft()
+            # the reply still had to be read for a cancelled command, so the
+            # replies after it match up
+            if future.cancelled():
+                continue
+            if isinstance(res, Exception):
+                future.set_exception(res)
+            else:
+                future.set_result(self._make_job(res))
+
+    def _make_job(self, res):
+        if self.job and 'jid' in res:
+            return self.job(conn=self, **res)
+        return res
+
+    def _do_interaction(self, line, handler):
+        future = asyncio.Future(loop=self.loop)
+        if self.transport is None:
+            future.set_exception(errors.NotConnected('Not connected'))
+            return future
+        self._reader.expect(handler)
+        self._waiting.append(future)
+        self.transport.write(line)
+        return future
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+AsyncioConn = protohandler.protProvider(AsyncioConn)
+
+
+class AsyncioJob(Job):
+    """A job.Job for AsyncioConn. Finish, Return, Delay, Bury and Touch send
+    their command and return a Future for the outcome: True once the server
+    has done it, False if the server doesn't have the job (any more), or the
+    error. Queue only requeues a job that came from a queue, as Delay does.
+
+    Unlike job.Job, an AsyncioJob isn't deleted when it is garbage collected
+    without having been handled: the command could only be sent from there,
+    with nothing to wait for its reply.
+    """
+    def __del__(self):
+        pass
+
+    def _outcome(self, future, handles = True):
+        outcome = asyncio.Future(loop=self._conn.loop)
+
+        def done(future):
+            if future.cancelled():
+                outcome.cancel()
+            elif isinstance(future.exception(), errors.NotFound):
+                outcome.set_result(False)
+            elif future.exception() is not None:
+                outcome.set_exception(future.exception())
+            else:
+                if handles:
+                    self._handled = True
+                outcome.set_result(True)
+
+        future.add_done_callback(done)
+        return outcome
+
+    def Queue(self):
+        if not self._from_queue:
+            raise NotImplementedError("AsyncioJob can only requeue a job "
+                                      "that came from a queue")
+        return self.Delay(self.delay)
+
+    @honorimmutable
+    def Return(self):
+        return self._outcome(self.Server.release(self.jid, self.pri, 0))
+
+    @honorimmutable
+    def Delay(self, delay):
+        return self._outcome(self.Server.release(self.jid, self.pri, delay))
+
+    @honorimmutable
+    def Finish(self):
+        return self._outcome(self.Server.delete(self.jid))
+
+    @honorimmutable
+    def Touch(self):
+        return self._outcome(self.Server.touch(self.jid), handles=False)
+
+    @honorimmutable
+    def Bury(self, newpri = 0):
+        if newpri:
+            self.pri = newpri
+        return self._outcome(self.Server.bury(self.jid, newpri))
+
+
+def connect(host, port, job = False, loop = None):
+    """Connects to beanstalkd at host:port, returning a Future for the
+    AsyncioConn."""
+    loop = loop or asyncio.get_event_loop()
+    connected = asyncio.Future(loop=loop)
+
+    def made(future):
+        if future.cancelled():
+            connected.cancel()
+        elif future.exception() is not None:
+            connected.set_exception(future.exception())
+        else:
+            transport, conn = future.result()
+            connected.set_result(conn)
+
+    asyncio.ensure_future(
+        loop.create_connection(lambda: AsyncioConn(job, loop), host, port),
+        loop=loop).add_done_callback(made)
+    return connected
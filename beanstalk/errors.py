@@ -6,6 +6,7 @@ class ProtoError(BeanStalkError): pass
 class ServerError(BeanStalkError): pass
 
 class NotConnected(BeanStalkError): pass
+class CommandTimeout(BeanStalkError): pass
 
 class OutOfMemory(ServerError): pass
 class InternalError(ServerError): pass
@@ -21,17 +22,25 @@ class DeadlineSoon(ProtoError):pass
 
 class UnexpectedResponse(ProtoError): pass
 
+# the error replies beanstalkd can send, and the exception raised for each
+ERRORS = {
+    'OUT_OF_MEMORY': OutOfMemory,
+    'INTERNAL_ERROR': InternalError,
+    'DRAINING': Draining,
+    'BAD_FORMAT': BadFormat,
+    'UNKNOWN_COMMAND': UnknownCommand,
+    'EXPECTED_CRLF': ExpectedCrlf,
+    'JOB_TOO_BIG': JobTooBig,
+    'NOT_FOUND': NotFound,
+    'NOT_IGNORED': NotIgnored,
+    'DEADLINE_SOON': DeadlineSoon,
+}
+
 def checkError(linestr):
-    '''Note, this will throw an error internally for every case that is a
-    response that is NOT an error response, and that error will be caught,
-    and checkError will return happily.
-
-    In the case that an error was returned by beanstalkd, an appropriate error
-    will be raised'''
-
-    try:
-        errname = ''.join([x.capitalize() for x in linestr.split('_')])
-        err = eval(errname)('Server returned: %s' % (linestr,))
-    except Exception, e:
-        return
-    raise err
+    '''Raises the appropriate error if linestr is an error response from
+    beanstalkd, and returns happily otherwise. Only the first word of the
+    line is looked at.'''
+
+    err = ERRORS.get(linestr.partition(' ')[0])
+    if err:
+        raise err('Server returned: %s' % (linestr,))
@@ -0,0 +1,97 @@
+"""
+Health tracking for the servers of a ServerPool.
+
+Each server has a ServerHealth, a circuit breaker fed with the outcome of
+the commands sent to it:
+
+    healthy     the last command worked
+    degraded    some commands in a row failed (connection lost, timed out,
+                or the server couldn't be reached), fewer than threshold
+    open        threshold failures in a row: the server is left alone until
+                a backoff delay, doubled after each failure, has passed
+    half-open   the delay has passed and one command (a probe) is let
+                through; it closes the circuit if it works, and opens it
+                again for twice as long if it doesn't
+
+A server that answers DRAINING or OUT_OF_MEMORY is alive, but is kept out of
+put routing for drain_delay seconds.
+"""
+
+import random
+import time
+
+HEALTHY = 'healthy'
+DEGRADED = 'degraded'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+def backoff(attempt, base = .1, maximum = 30.0, jitter = .5):
+    """Returns the delay before retry number attempt (from 0): base doubled
+    attempt times, up to maximum, less a random part of up to jitter of it,
+    so that clients don't all retry at the same time."""
+    delay = min(maximum, base * 2 ** attempt)
+    return delay * (1 - jitter * random.random())
+
+
+class ServerHealth(object):
+    """The circuit breaker of one server, see the module docs. The pool calls
+    attempt() before it sends a server a command, and success() or failure()
+    with the outcome."""
+    def __init__(self, threshold = 3, base_delay = .1, max_delay = 30.0,
+                 jitter = .5, drain_delay = 5.0, clock = time.time):
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.drain_delay = drain_delay
+        self.clock = clock
+        self.state = HEALTHY
+        self.failures = 0       # in a row
+        self.trips = 0          # times opened since the last success
+        self.retry_at = 0
+        self.draining_until = 0
+
+    def __repr__(self):
+        return "<%s %s, %s failures>" % (self.__class__.__name__, self.state,
+                                         self.failures)
+
+    def available(self, now = None):
+        """Whether a command may be sent to the server."""
+        if self.state in (HEALTHY, DEGRADED):
+            return True
+        return (now or self.clock()) >= self.retry_at
+
+    def accepts_puts(self, now = None):
+        now = now or self.clock()
+        return self.available(now) and now >= self.draining_until
+
+    def attempt(self, now = None):
+        """Called before a command is sent. Past the delay of an open
+        circuit, this is the probe: the circuit is half-open, and no other
+        probe is let through for another delay."""
+        if self.state in (OPEN, HALF_OPEN):
+            self.state = HALF_OPEN
+            self.retry_at = (now or self.clock()) + self._delay()
+
+    def success(self):
+        self.state = HEALTHY
+        self.failures = 0
+        self.trips = 0
+
+    def failure(self, now = None):
+        self.failures += 1
+        if self.state in (OPEN, HALF_OPEN) or self.failures >= self.threshold:
+            self.state = OPEN
+            self.retry_at = (now or self.clock()) + self._delay()
+            self.trips += 1
+        else:
+            self.state = DEGRADED
+
+    def drain(self, now = None):
+        """Called when the server answers DRAINING or OUT_OF_MEMORY."""
+        self.draining_until = (now or self.clock()) + self.drain_delay
+
+    def _delay(self):
+        return backoff(self.trips, self.base_delay, self.max_delay,
+                       self.jitter)
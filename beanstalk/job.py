@@ -49,6 +49,10 @@ class Job(object):
         self.state = state
         self.data = data if data else ''
 
+        # set once the job has been deleted, released or buried, after which
+        # it isn't ours to finish any more
+        self._handled = False
+
         self.imutable = bool(kw.get('imutable', False))
         self._from_queue = bool(kw.get('from_queue', False))
         self.tube = kw.get('tube', 'default')
@@ -63,7 +67,8 @@ class Job(object):
                         cmp(self.data, comparable.data)])
 
     def __del__(self):
-        self.Finish()
+        if not self._handled:
+            self.Finish()
 
     def __str__(self):
         return pformat(self._serialize())
@@ -102,11 +107,14 @@ class Job(object):
             self.Delay(self.delay)
             return
         oldtube = self.Server.tube
-        if oldtube != self.tube:
-            self.Server.use(self.tube)
-        self.Server.put(self._serialize(), self.pri, self.delay, self.ttr)
-        if oldtube != self.tube:
-            self.Server.use(oldtube)
+        if oldtube == self.tube:
+            self.Server.put(self._serialize(), self.pri, self.delay, self.ttr)
+            return
+        # one round trip, and the tube is switched back even if the put fails
+        with self.Server.pipeline() as p:
+            p.use(self.tube)
+            p.put(self._serialize(), self.pri, self.delay, self.ttr)
+            p.use(oldtube)
 
     @honorimmutable
     def Return(self):
@@ -117,6 +125,7 @@ class Job(object):
         except:
             raise
         else:
+            self._handled = True
             return True
 
     @honorimmutable
@@ -128,6 +137,7 @@ class Job(object):
         except:
             raise
         else:
+            self._handled = True
             return True
 
     @honorimmutable
@@ -139,6 +149,7 @@ class Job(object):
         except:
             raise
         else:
+            self._handled = True
             return True
 
     @honorimmutable
@@ -164,6 +175,7 @@ class Job(object):
         except:
             raise
         else:
+            self._handled = True
             return True
 
     @property
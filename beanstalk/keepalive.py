@@ -0,0 +1,263 @@
+"""
+TTR keepalive for reserved jobs.
+
+A job still being worked on when its time to run (TTR) runs out is released
+by the server, and another consumer ends up doing the same work again.
+Keepalive touches the jobs reserved on a ServerConn from a background
+thread, each time a fraction of their TTR has passed, until they are
+deleted, released or buried:
+
+    conn = serverconn.ServerConn('localhost', 11300, job=job.Job)
+    keepalive = Keepalive(conn).start()
+    job = conn.reserve()
+    job.run()       # may take longer than the TTR
+    job.Finish()    # no more touches for it
+    keepalive.stop()
+
+twisted_client.TwistedKeepalive does the same for the Twisted client.
+"""
+
+import logging
+import socket
+import threading
+import time
+from itertools import izip
+
+import errors
+import protohandler
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+RESERVE_COMMANDS = frozenset(['reserve', 'reserve-with-timeout'])
+ACK_COMMANDS = frozenset(['delete', 'release', 'bury'])
+
+
+class KeepaliveSchedule(object):
+    """Keeps track of the jobs reserved on one connection, and of when each
+    is due for a touch: after fraction of its TTR has passed since it was
+    reserved or last touched.
+
+    Reserve replies don't include the TTR. Jobs added without one get
+    default_ttr, if it is set; otherwise their TTR is unknown until it is
+    looked up (stats-job), and they are not due before that. observe()
+    tracks the jobs a connection reserves and acknowledges from the commands
+    it sends, so the connection doesn't have to do anything extra.
+
+    clock returns the current time, time.time by default.
+    """
+    def __init__(self, fraction = .5, default_ttr = None, clock = time.time):
+        self.fraction = fraction
+        self.default_ttr = default_ttr
+        self.clock = clock
+        self.jobs = {}      # jid -> [time of the next touch, ttr]
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __contains__(self, jid):
+        return jid in self.jobs
+
+    def add(self, jid, ttr = None, now = None):
+        ttr = ttr or self.default_ttr
+        now = now or self.clock()
+        self.jobs[jid] = [now + ttr * self.fraction if ttr else now, ttr]
+
+    def discard(self, jid):
+        self.jobs.pop(jid, None)
+
+    def unknown(self):
+        """Returns the jids whose TTR has to be looked up."""
+        return [jid for jid, (when, ttr) in self.jobs.iteritems()
+                if ttr is None]
+
+    def known(self, jid, ttr, time_left, now = None):
+        """Sets the TTR looked up for jid, with the seconds it has left."""
+        entry = self.jobs.get(jid)
+        if entry is None:
+            return
+        now = now or self.clock()
+        entry[0] = now + max(0, time_left - ttr * (1 - self.fraction))
+        entry[1] = ttr
+
+    def touched(self, jid, now = None):
+        entry = self.jobs.get(jid)
+        if entry is not None:
+            entry[0] = (now or self.clock()) + entry[1] * self.fraction
+
+    def due(self, now = None):
+        now = now or self.clock()
+        return [jid for jid, (when, ttr) in self.jobs.iteritems()
+                if ttr is not None and when <= now]
+
+    def next_due(self):
+        """Returns when the next touch is due, None if no job is tracked."""
+        times = [when for when, ttr in self.jobs.itervalues()
+                 if ttr is not None]
+        return min(times) if times else None
+
+    def observe(self, line, res):
+        """Updates the schedule from a command line sent and its reply (or
+        the exception it raised): reserved jobs are added, and deleted,
+        released and buried ones are dropped, whether that worked or not (if
+        it didn't, the job isn't ours any more)."""
+        words = line.split()
+        if words[0] in RESERVE_COMMANDS:
+            if not isinstance(res, Exception) and res['state'] == 'ok':
+                self.add(res['jid'])
+        elif words[0] in ACK_COMMANDS:
+            self.discard(int(words[1]))
+
+
+class Keepalive(object):
+    """Touches the jobs reserved on a ServerConn from a background thread.
+
+    start() puts a wrapper around the connection's commands, including
+    pipelines and the *_many methods, which keeps the schedule (a
+    KeepaliveSchedule) up to date and takes lock, so that the touches are
+    never sent in the middle of another command; stop() takes it off again.
+    A hook should be set (set_hook) before starting the keepalive, not while
+    it runs.
+
+    The thread wakes up at least every max_wait seconds, looks up the TTRs
+    not known yet and sends the touches that are due in one pipelined
+    batch. A touch can't be sent while the connection waits in a reserve, so
+    reserve timeouts should be kept well below the TTRs of the jobs held;
+    beanstalkd answers a waiting reserve with DEADLINE_SOON when one of them
+    is about to run out.
+
+    touches counts the touches sent. The thread stops by itself when the
+    connection is closed or lost.
+    """
+    def __init__(self, conn, fraction = .5, default_ttr = None,
+                 max_wait = 1.0):
+        self.conn = conn
+        self.schedule = KeepaliveSchedule(fraction, default_ttr)
+        self.max_wait = max_wait
+        self.lock = threading.RLock()
+        self.touches = 0
+        self.thread = None
+        self._stopping = threading.Event()
+        self._saved = None
+
+    def __repr__(self):
+        return "<%s(%r) %s jobs>" % (self.__class__.__name__, self.conn,
+                                     len(self.schedule))
+
+    def _wrap(self):
+        conn = self.conn
+        self._saved = dict((name, conn.__dict__.get(name))
+                           for name in ('_do_interaction', '_interact_many'))
+        do, many = conn._do_interaction, conn._interact_many
+        self._many = many
+        observe = self.schedule.observe
+
+        def _do_interaction(line, handler):
+            self.lock.acquire()
+            try:
+                try:
+                    res = do(line, handler)
+                except errors.BeanStalkError, e:
+                    observe(line, e)
+                    raise
+                observe(line, res)
+                return res
+            finally:
+                self.lock.release()
+
+        def _interact_many(commands):
+            self.lock.acquire()
+            try:
+                results = many(commands)
+                for (line, handler), res in izip(commands, results):
+                    observe(line, res)
+                return results
+            finally:
+                self.lock.release()
+
+        conn._do_interaction = _do_interaction
+        conn._interact_many = _interact_many
+
+    def _unwrap(self):
+        for name, saved in self._saved.iteritems():
+            if saved is None:
+                self.conn.__dict__.pop(name, None)
+            else:
+                setattr(self.conn, name, saved)
+        self._saved = None
+
+    def tick(self):
+        """Looks up the unknown TTRs, and touches the jobs that are due.
+        Returns a (jid, outcome) pair per touch sent, as
+        ServerConn.touch_many does."""
+        self.lock.acquire()
+        try:
+            schedule = self.schedule
+            unknown = schedule.unknown()
+            if unknown:
+                results = self._many([protohandler.process_stats_job(jid)
+                                      for jid in unknown])
+                now = time.time()
+                for jid, res in izip(unknown, results):
+                    if isinstance(res, Exception):
+                        schedule.discard(jid)
+                    else:
+                        schedule.known(jid, res['data']['ttr'],
+                                       res['data']['time-left'], now)
+
+            now = time.time()
+            due = schedule.due(now)
+            if not due:
+                return []
+            results = self._many([protohandler.process_touch(jid)
+                                  for jid in due])
+            outcomes = []
+            for jid, res in izip(due, results):
+                if isinstance(res, Exception):
+                    schedule.discard(jid)
+                    outcomes.append((jid, res))
+                else:
+                    schedule.touched(jid, now)
+                    outcomes.append((jid, res['state']))
+            self.touches += len(due)
+            return outcomes
+        finally:
+            self.lock.release()
+
+    def _wait(self):
+        next_due = self.schedule.next_due()
+        if next_due is None:
+            return self.max_wait
+        return max(0, min(self.max_wait, next_due - time.time()))
+
+    def _run(self):
+        while not self._stopping.isSet():
+            if self.conn._socket is None:
+                break
+            try:
+                self.tick()
+            except (errors.BeanStalkError, socket.error), e:
+                if self.conn._socket is not None:
+                    logger.warning("Keepalive for %r stopped: %s",
+                                   self.conn, e)
+                break
+            self._stopping.wait(self._wait())
+
+    def start(self):
+        self._stopping.clear()
+        self._wrap()
+        self.thread = threading.Thread(target=self._run,
+                                       name=self.__class__.__name__)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops the thread, and takes the wrapper off the connection. The
+        jobs still tracked are not touched any more."""
+        self._stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self._saved is not None:
+            self._unwrap()
@@ -0,0 +1,230 @@
+"""
+Multiplexer: runs commands on many connections at once.
+
+A Multiplexer keeps the sockets of a set of connections (ServerConns, or
+subclasses such as multiserverconn.AsyncServerConn) registered with one
+poller for as long as they are open: epoll where there is one, poll or
+select elsewhere. run() sends each connection its commands in one write,
+then reads the replies from whichever sockets are ready, feeding them to the
+protohandler handlers, until every command has its reply or its deadline
+has passed. Nothing is set up per call, so a round of commands costs a poll
+per batch of replies however many servers there are.
+"""
+
+import errno
+import select
+import socket
+import threading
+import time
+
+import errors
+import serverconn
+
+
+class Poller(object):
+    """The read readiness part of epoll, poll or select (the first of them
+    the platform has), behind one interface. kind says which it is."""
+    def __init__(self):
+        self._fds = set()
+        if hasattr(select, 'epoll'):
+            self.kind = 'epoll'
+            self._poller = select.epoll()
+            self._events = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+        elif hasattr(select, 'poll'):
+            self.kind = 'poll'
+            self._poller = select.poll()
+            self._events = select.POLLIN | select.POLLERR | select.POLLHUP
+        else:
+            self.kind = 'select'
+            self._poller = None
+
+    def __len__(self):
+        return len(self._fds)
+
+    def register(self, fd):
+        if self._poller is not None:
+            self._poller.register(fd, self._events)
+        self._fds.add(fd)
+
+    def unregister(self, fd):
+        if fd not in self._fds:
+            return
+        self._fds.discard(fd)
+        if self._poller is not None:
+            try:
+                self._poller.unregister(fd)
+            except (IOError, OSError, KeyError):
+                # closed already, which unregisters it from epoll
+                pass
+
+    def poll(self, timeout = None):
+        """Returns the fds that are readable, closed or in error, waiting up
+        to timeout seconds for one, or for as long as it takes if timeout is
+        None."""
+        try:
+            if self.kind == 'epoll':
+                events = self._poller.poll(-1 if timeout is None else timeout)
+            elif self.kind == 'poll':
+                events = self._poller.poll(None if timeout is None
+                                           else timeout * 1000)
+            else:
+                return select.select(list(self._fds), [], [], timeout)[0]
+        except (select.error, IOError, OSError), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        return [fd for fd, event in events]
+
+    def close(self):
+        if self.kind == 'epoll':
+            self._poller.close()
+        self._fds.clear()
+
+
+class Multiplexer(object):
+    """Runs commands on many connections at once, see the module docs.
+
+    Connections are registered once, when they are connected, and
+    unregistered when they are closed. A connection that is lost, or that
+    misses a deadline, is closed by run() itself: the replies still to come
+    would otherwise be taken for those of the next commands.
+
+    Only one run() goes at a time; a connection must not be used on its
+    own, e.g. by another thread, while it is in one.
+    """
+    def __init__(self):
+        self.poller = Poller()
+        self.conns = {}     # fd -> conn
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<%s(%s) %s connections>" % (self.__class__.__name__,
+                                            self.poller.kind, len(self.conns))
+
+    def __len__(self):
+        return len(self.conns)
+
+    def register(self, conn):
+        fd = conn.fileno()
+        self.conns[fd] = conn
+        self.poller.register(fd)
+
+    def unregister(self, conn):
+        for fd, registered in self.conns.items():
+            if registered is conn:
+                del self.conns[fd]
+                self.poller.unregister(fd)
+
+    def _drop(self, conn, replies, expected, error):
+        replies.extend([error] * (expected - len(replies)))
+        self.unregister(conn)
+        if conn._socket is not None:
+            conn.close()
+
+    def run(self, requests, timeout = None):
+        """Runs the commands of requests, a sequence of (conn, commands)
+        pairs, or (conn, commands, timeout) for a connection with a deadline
+        of its own. commands are (line, handler) pairs, as the protohandler
+        process_* functions make them. A connection gets timeout seconds
+        from the start of the run to answer all its commands, or as long as
+        it takes if timeout is None.
+
+        Returns a dict mapping each conn to the list of its replies, in the
+        order of its commands, with the exception in place of an error
+        reply. Commands not answered in time get a CommandTimeout, and those
+        on a connection that was lost get NotConnected; either way the
+        connection is closed.
+        """
+        self.lock.acquire()
+        try:
+            return self._run(requests, timeout)
+        finally:
+            self.lock.release()
+
+    def _run(self, requests, timeout):
+        start = time.time()
+        results = {}
+        pending = {}        # fd -> (conn, number of commands, deadline)
+
+        for request in requests:
+            conn, commands = request[:2]
+            limit = request[2] if len(request) > 2 else timeout
+            results[conn] = replies = []
+            if not commands:
+                continue
+            if conn._socket is None:
+                self._drop(conn, replies, len(commands),
+                           errors.NotConnected('%r is not connected' % (conn,),
+                                               conn))
+                continue
+
+            reader = conn._reader
+            for line, handler in commands:
+                reader.expect(handler)
+            try:
+                conn._writeline(''.join(line for line, handler in commands))
+            except errors.NotConnected, e:
+                self._drop(conn, replies, len(commands), e)
+                continue
+            # there may be replies left over from the last read already
+            replies.extend(reader.feed(''))
+            if len(replies) < len(commands):
+                pending[conn.fileno()] = (conn, len(commands),
+                                          None if limit is None
+                                          else start + limit)
+
+        while pending:
+            deadlines = [entry[2] for entry in pending.itervalues()
+                         if entry[2] is not None]
+            wait = None
+            if deadlines:
+                wait = max(0, min(deadlines) - time.time())
+
+            for fd in self.poller.poll(wait):
+                entry = pending.get(fd)
+                if entry is None:
+                    # nothing was asked of it, so it was closed, or is
+                    # sending what it shouldn't; either way it can't be used
+                    conn = self.conns.get(fd)
+                    if conn is not None:
+                        self._drop(conn, [], 0, None)
+                    continue
+
+                conn, expected, deadline = entry
+                replies = results[conn]
+                try:
+                    data = conn._socket.recv(conn.bufsize)
+                except socket.error:
+                    data = ''
+                if not data:
+                    del pending[fd]
+                    closedmsg = "Remote server %(server)s:%(port)s has "\
+                                "closed connection" % {"server" : conn.server,
+                                                       "port" : conn.port}
+                    self._drop(conn, replies, expected,
+                               errors.NotConnected(closedmsg, conn))
+                    continue
+                replies.extend(conn._reader.feed(data))
+                if len(replies) >= expected:
+                    del pending[fd]
+
+            now = time.time()
+            for fd, (conn, expected, deadline) in pending.items():
+                if deadline is not None and deadline <= now:
+                    del pending[fd]
+                    self._drop(conn, results[conn], expected,
+                               errors.CommandTimeout('%r did not answer in '
+                                                     'time' % (conn,), conn))
+
+        for request in requests:
+            conn, commands = request[:2]
+            for (line, handler), res in zip(commands, results[conn]):
+                if line.startswith(serverconn.TUBE_COMMANDS) and \
+                        not isinstance(res, Exception):
+                    conn._track(line)
+        return results
+
+    def close(self):
+        """Closes the poller. The connections are left open."""
+        self.conns.clear()
+        self.poller.close()
@@ -1,269 +1,119 @@
 import socket
-import select
 import random
 import logging
-import threading
-import asyncore
-import asynchat
-import errno
-import traceback
+import math
 import time
-import sys
-import copy
+from itertools import izip
 
+import health
 import protohandler
+import serverconn
+import routing
 from serverconn import ServerConn
+from multiplexer import Multiplexer
 from job import Job
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# This should be set to experiment with from the importing
-# module.
-# For example:
+# How many seconds a ServerPool gives the servers to answer a broadcast
+# command, by default. It can be set per pool, or here from the importing
+# module, e.g.:
+#
 # from beanstalk import multiserverconn
-# from multiserverconn import ServerPool ...
-# multiserverconn.ASYNCORE_TIMEOUT = 5
-
-ASYNCORE_TIMEOUT = 0.1
-ASYNCORE_COUNT   = 10
+# multiserverconn.TIMEOUT = 5
+
+TIMEOUT = 1.0
+
+# How long reserve_one and reserve_many sleep between rounds while no server
+# has a job ready: RESERVE_POLL_MIN seconds at first, doubling each round up
+# to RESERVE_POLL_MAX.
+
+RESERVE_POLL_MIN = 0.01
+RESERVE_POLL_MAX = 0.5
+
+# How many times a pool command is retried when the server it was sent to is
+# lost or draining, with a backoff of RETRY_DELAY seconds doubled each time.
+# How long the servers themselves are left alone after failing is up to
+# their health.ServerHealth.
+
+RETRIES = 3
+RETRY_DELAY = 0.05
+
+# How the stats of the servers are combined by ServerPool.stats and
+# stats_tube: the values in STATS_SETS are gathered in a set, the greatest
+# of those in STATS_MAX is taken, flags are or'ed together, and the other
+# numbers are added up.
+
+STATS_SETS = frozenset(['name', 'version', 'pid', 'hostname', 'id', 'os',
+                        'platform'])
+STATS_MAX = frozenset(['uptime', 'max-job-size', 'binlog-max-size',
+                       'binlog-oldest-index', 'binlog-current-index',
+                       'pause', 'pause-time-left'])
+
+def aggregate_stats(stats):
+    """Combines a list of stats dicts, of servers or of a tube on several
+    servers, into one; see STATS_SETS and STATS_MAX."""
+    combined = {}
+    for key in set(key for data in stats for key in data):
+        values = [data[key] for data in stats if key in data]
+        if key in STATS_SETS:
+            combined[key] = set(values)
+        elif all(isinstance(value, bool) for value in values):
+            combined[key] = any(values)
+        elif not all(isinstance(value, (int, long, float))
+                     for value in values):
+            combined[key] = set(values)
+        elif key in STATS_MAX:
+            combined[key] = max(values)
+        else:
+            combined[key] = sum(values)
+    return combined
 
 class ServerInUse(Exception): pass
 
-class AsyncServerConn(object, asyncore.dispatcher):
-    def __init__(self, server, port, job = False):
-        self.job = job
-        self.server = server
-        self.port = port
+class AsyncServerConn(ServerConn):
+    """AsyncServerConn is the ServerConn a ServerPool keeps for each of its
+    servers. It is registered with the pool's Multiplexer while it is
+    connected, which is how the pool runs a command on all its servers at
+    once. Used on its own it is a plain, blocking ServerConn.
 
-        self.__line = None
-        self.__handler = None
-        self.__result = None
-        self.__waiting = False
-        self.__mutex = threading.Lock()
+    timeout, if set, is how long this server is given to answer the pool's
+    broadcasts, instead of the pool's timeout (e.g. for a server further
+    away than the others).
 
-        self._socket  = None
-        asyncore.dispatcher.__init__(self)
+    waiting is only there for compatibility, it is always False: a command
+    either gets its reply or the connection is closed.
 
-    def __repr__(self):
-        s = "<0x%(id)s %(object)s>"
-        return s % {'id' : id(self), 'object' : self }
+    health is the health.ServerHealth the pool keeps for the server.
+    """
+    timeout = None
+    waiting = False
+
+    def __init__(self, server, port, job = False, multiplexer = None):
+        self.multiplexer = multiplexer
+        self.health = health.ServerHealth()
+        ServerConn.__init__(self, server, port, job)
 
     def __str__(self):
-        s = "%(class)s(%(ip)s:%(port)s#[%(active)s][%(waiting)s])"
+        s = "%(class)s(%(ip)s:%(port)s#[%(active)s])"
         active_ = "Open" if self._socket else "Closed"
-        waiting_ = "Waiting" if self.__waiting else "NotWaiting"
         return s % {"class" : self.__class__.__name__,
                     "active" : active_,
                     "ip" : self.server,
-                    "port" : self.port,
-                    "waiting" : waiting_}
-
-    def __getattribute__(self, attr):
-        res = getattr(protohandler, 'process_%s' % attr, None)
-        if res:
-            def caller(*args, **kw):
-                logger.info("Calling %s on %r with args(%s), kwargs(%s)",
-                             res.__name__, self, args, kw)
-
-                func = self._do_interaction
-                func(*res(*args, **kw))
-                asyncore.loop(use_poll=True,
-                              timeout=ASYNCORE_TIMEOUT,
-                              count=ASYNCORE_COUNT)
-                return self.result
-            return caller
-
-        return super(AsyncServerConn, self).__getattribute__(attr)
-
-    def __eq__(self, comparable):
-        #for unit testing
-        assert isinstance(comparable, AsyncServerConn)
-        return not any([cmp(self.server, comparable.server),
-                        cmp(self.port, comparable.port)])
-
-    def __assert_not_waiting(self):
-        if self.waiting:
-            raise ServerInUse, ("%s is currently in use!" % self, self)
-
-    def _get_response(self):
-        while True:
-            recv = self._socket.recv(self.handler.remaining)
-
-            if not recv:
-                closedmsg = "Remote server %(server)s:%(port)s has "\
-                            "closed connection" % { "server" : self.server,
-                                                    "port" : self.port}
-                self.close()
-                raise protohandler.errors.NotConnected, (closedmsg, self)
-
-            res = self.handler(recv)
-            if res: break
-
-        if self.job and 'jid' in res:
-            res = self.job(conn=self,**res)
-        return res
-
-    def _do_interaction(self, line, handler):
-        self.__assert_not_waiting()
-        self.__result = None
-        self.line = line
-        self.handler = handler
-
-    def _get_watchlist(self):
-        return self.list_tubes_watched()['data']
-
-    def _set_watchlist(self, seq):
-        if len(seq) == 0:
-            seq.append('default')
-        seq = set(seq)
-        current = set(self._get_watchlist())
-        add = seq - current
-        rem = current - seq
-
-        for x in add:
-            self.watch(x)
-        for x in rem:
-            self.ignore(x)
-        return
-
-    watchlist = property(_get_watchlist, _set_watchlist)
-
-    def threadsafe(func):
-        def make_threadsafe(self, *args, **kwargs):
-            logger.debug("Acquiring mutex")
-            self.__mutex.acquire()
-            try:
-                logger.info("Calling %s with args: %s kwargs: %s",
-                             func.__name__, args, kwargs)
-                return func(self, *args, **kwargs)
-            finally:
-                logger.debug("Releasing mutex")
-                self.__mutex.release()
-        return make_threadsafe
-
-    @threadsafe
-    def _set_waiting(self, waiting):
-        self.__waiting = waiting
-
-    def _get_waiting(self):
-        return self.__waiting
-
-    waiting = property(_get_waiting, _set_waiting)
-
-    @threadsafe
-    def _set_line(self, line):
-        self.__line = line
-
-    def _get_line(self):
-        return self.__line
+                    "port" : self.port}
 
-    line = property(_get_line, _set_line)
-
-    @threadsafe
-    def _set_handler(self, handler):
-        self.__handler = handler
-
-    def _get_handler(self):
-        return self.__handler
-
-    handler = property(_get_handler, _set_handler)
-
-    def _get_result(self):
-        return self.__result
-
-    result = property(_get_result)
-
-    @property
-    def tube(self):
-        return self.list_tube_used()['tube']
-
-    def post_connection(func):
-        def handle_post_connect(self, *args, **kwargs):
-            value = func(self, *args, **kwargs)
-            protohandler.MAX_JOB_SIZE = self.stats()['data']['max-job-size']
-            return value
-        return handle_post_connect
-
-    @post_connection
     def connect(self):
-        # else the socket is not open at all
-        # so, open the socket, and add it to the dispatcher
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.set_socket(self._socket) # set socket to asyncore.dispatcher
-        self.set_reuse_addr() # try to re-use the address
-        self._socket.connect((self.server, self.port))
-
-    def interact(self, line):
-        self.__assert_not_waiting()
-        try:
-            self._socket.sendall(line)
-        except Exception, e:
-            raise protohandler.errors.ProtoError(e)
+        ServerConn.connect(self)
+        if self.multiplexer is not None:
+            self.multiplexer.register(self)
 
     def close(self):
-        self._socket.close()
-        self.del_channel()
-        # very important in python to set to None
-        # if socket is not set to None, then it will try to re-use the same
-        # file descriptor...
-        self._socket = None
-
-    def fileno(self):
-        return self._socket.fileno()
-
-    @threadsafe
-    def handle_read(self):
-        logger.info("Handling read on %s", self)
-        try:
-            self.__result = self._get_response()
-            logger.info("Results are: %s", self.result)
-        finally:
-            # must make sure that waiting is set to false!
-            self.__waiting = False
-
-    @threadsafe
-    def handle_write(self):
-        logger.info("writing: %s to %s", self.line, self)
-        self.interact(self.line)
-        self.__waiting = True
-        self.__line = None
-        logger.info("Handled write")
-
-    def handle_connect(self):
-        logger.info("Connected to: %s", self)
-
-    def handle_close(self):
-        logger.info("Closing connection to: %s", self)
-
-    def handle_error(self):
-        # get exception information
-        exctype, value = sys.exc_info()[:2]
-        # if we disconnected..
-        if exctype == protohandler.errors.NotConnected:
-            msg, server = value
-            logger.warn("Got %s, so, reconnecting to: %s", msg, server)
-            assert server == self # sanity 
-            # remove from the socket map
-            del asyncore.socket_map[self.fileno()]
-            # reconnect
-            self.connect()
-        else:
-            raise
-            asyncore.dispatcher.handle_error(self)
-
-    def handle_accept(self):
-        logger.info("Handle socket accept...")
-
-    def readable(self):
-        """This socket is only readable if it's waiting."""
-        logger.debug("Checking if %s is readable.", self)
-        return self.waiting
-
-    def writable(self):
-        """This socket is only writeable if something gave a line"""
-        logger.debug("Checking if %s is writeable.", self)
-        return self.line
+        if self._socket is None:
+            return
+        if self.multiplexer is not None:
+            self.multiplexer.unregister(self)
+        ServerConn.close(self)
 
 class ServerPool(object):
     """ServerPool is a queue implementation of ServerConns with distributed
@@ -271,8 +121,37 @@ class ServerPool(object):
 
     @serverlist is a list of tuples as so: (ip, port, job)
 
+    Broadcast commands are sent to all the servers at once through a
+    Multiplexer, and wait up to timeout seconds (TIMEOUT by default) for the
+    replies. Servers that don't answer in time are left out of the results,
+    and reconnected before the next command.
+
+    Jobs are put on the server router picks (see the routing module), a
+    routing.RandomRouter by default. put and put_many take a key to route
+    on; a HashRouter sends jobs with the same key to the same server, and
+    uses the tube name when there is no key. A LoadRouter sends them to the
+    least loaded servers:
+
+        pool = ServerPool(servers, router=routing.LoadRouter().start())
+
+    stats and stats_tube combine the stats of all the servers, and keep
+    them for stats_ttl seconds if it is set, for callers that poll them.
+
+    The health of each server is tracked (see the health module): servers
+    that keep failing are left out of routing, reserves and broadcasts, and
+    reconnected with a backoff; draining ones get no puts for a while. Pool
+    commands are retried up to retries times (RETRIES by default).
+
     """
-    def __init__(self, serverlist):
+    def __init__(self, serverlist, timeout=None, router=None, stats_ttl=0):
+        self.timeout = TIMEOUT if timeout is None else timeout
+        self.stats_ttl = stats_ttl
+        self.retries = RETRIES
+        self._stats_cache = {}
+        self.multiplexer = Multiplexer()
+        self.router = router or routing.RandomRouter()
+        self.used_tube = 'default'
+        self._reserve_start = 0
         # build servers into the self.servers list
         self.servers = []
         for ip, port, job in serverlist:
@@ -283,15 +162,41 @@ class ServerPool(object):
         # TODO: it's late and I'm getting tired, going to just make
         # a list for now and see maybe later if I want to do a dict
         # with the server IPs as the keys as well as their watchlist..
+        # from what each connection knows, see ServerConn.sync_tubes
         L = []
         for server in self.servers:
-            L.extend(server.watchlist)
+            L.extend(server.watched_tubes)
         return list(set(L))
 
     def _set_watchlist(self, value):
-        """Sets the watchlist for all global servers"""
+        """Sets the watchlist for all global servers, on all of them at once.
+        Servers that aren't connected, or don't answer in time, get it when
+        they are reconnected."""
+        self._reconnect()
+        requests = []
         for server in self.servers:
-            server.watchlist = value
+            commands = server._watchlist_commands(value)
+            if server._socket is None:
+                server.watched_tubes = set(value) or set(['default'])
+            elif commands:
+                requests.append((server, commands, self._timeout_for(server)))
+
+        replies = self.multiplexer.run(requests)
+        error = None
+        for server, commands, timeout in requests:
+            for res in replies[server]:
+                if isinstance(res, (protohandler.errors.CommandTimeout,
+                                    protohandler.errors.NotConnected)):
+                    logger.warning("No reply from %s: %s", server, res)
+                    self._record(server, res)
+                    server.watched_tubes = set(value) or set(['default'])
+                    break
+                elif isinstance(res, Exception):
+                    error = error or res
+            else:
+                self._record(server)
+        if error:
+            raise error
 
     watchlist = property(_get_watchlist, _set_watchlist)
 
@@ -307,15 +212,74 @@ class ServerPool(object):
         for server in self.servers:
             server.close()
         del self.servers[:]
+        self.router.close()
 
     def clone(self):
-        return ServerPool(map(lambda s: (s.server, s.port, s.job), self.servers))
+        return ServerPool(map(lambda s: (s.server, s.port, s.job), self.servers),
+                          self.timeout, self.router.clone(), self.stats_ttl)
+
+    def _reconnect_server(self, server):
+        """Reconnects server if its connection was closed or lost, and its
+        health allows it. Returns whether it is connected. A server that
+        fails is always disconnected, so a connected one is usable."""
+        if server._socket is not None:
+            return True
+        if not server.health.available():
+            return False
+        server.health.attempt()
+        try:
+            server.connect()
+        except (socket.error, protohandler.errors.BeanStalkError), e:
+            logger.warning("Could not reconnect to %s: %s", server, e)
+            server.health.failure()
+            return False
+        return True
+
+    def _reconnect(self):
+        """Reconnects the servers whose connection was closed or lost."""
+        for server in self.servers:
+            self._reconnect_server(server)
+
+    def _connected(self):
+        self._reconnect()
+        return [server for server in self.servers
+                if server._socket is not None]
+
+    def _record(self, server, error=None):
+        """Updates the health of server with the outcome of a command: its
+        reply, or error. Server errors also go to the router."""
+        if isinstance(error, protohandler.errors.ServerError):
+            server.health.drain()
+            self.router.failed(server, error)
+        elif isinstance(error, (protohandler.errors.NotConnected,
+                                protohandler.errors.CommandTimeout,
+                                socket.error)):
+            server.health.failure()
+            return
+        server.health.success()
+
+    def _send(self, server, cmd, *args, **kwargs):
+        """Sends server the command cmd, keeping track of its health. A lost
+        connection is closed, and raised as NotConnected."""
+        server.health.attempt()
+        try:
+            value = getattr(server, cmd)(*args, **kwargs)
+        except (protohandler.errors.NotConnected, socket.error), e:
+            self._record(server, e)
+            if server._socket is not None:
+                server.close()
+            NotConnected = protohandler.errors.NotConnected
+            raise NotConnected("Lost connection to %s: %s" % (server, e),
+                               server)
+        except protohandler.errors.BeanStalkError, e:
+            self._record(server, e)
+            raise
+        self._record(server)
+        return value
 
     def get_random_server(self):
-        #random seed by local time
-        random.seed()
         try:
-            choice = random.choice(self.servers)
+            choice = random.choice(self._connected())
         except IndexError, e:
             # implicitly convert IndexError to BeanStalkError
             NotConnected = protohandler.errors.NotConnected
@@ -335,6 +299,8 @@ class ServerPool(object):
             for t in target:
                 t.close()
                 self.servers.remove(t)
+            self.router.update(self.servers)
+            self._stats_cache.clear()
         return bool(target)
 
     def add_server(self, ip, port, job=Job):
@@ -348,16 +314,22 @@ class ServerPool(object):
         target = filter(self._server_cmp(ip, port), self.servers)
         # if we got a server back
         if not target:
-            server = AsyncServerConn(ip, port, job)
+            server = AsyncServerConn(ip, port, job, self.multiplexer)
             server.pool_instance = self
-            server.connect()
             self.servers.append(server)
+            self.router.update(self.servers)
+            self._stats_cache.clear()
 
         # return the opposite of target
         return not bool(target)
 
     def retry_until_succeeds(func):
+        """Retries the command if the server it went to was lost or is
+        draining, up to the pool's retries times, backing off between the
+        tries. The server's health has been updated by then, so the retry
+        goes elsewhere or waits for a reconnect."""
         def retrier(self, *args, **kwargs):
+            attempt = 0
             while True:
                 try:
                     value = func(self, *args, **kwargs)
@@ -366,46 +338,124 @@ class ServerPool(object):
                     # this should be caught in the function..
                     # clean this up a bit?
                     raise
-                except protohandler.errors.Draining, e:
-                    # ignore
-                    pass
-                except protohandler.errors.NotConnected, e:
-                    # not connected..
-                    logger.warning(e[0])
-                    server = e[1]
-                    self.remove_server(server.server, server.port)
-                    logger.warn("Attempting to re-connect to: %s", server)
-                    server.connect()
-                    self.servers.append(server)
+                except (protohandler.errors.Draining,
+                        protohandler.errors.NotConnected), e:
+                    if attempt >= self.retries:
+                        raise
+                    logger.warning("Retrying %s: %s", func.__name__, e[0])
+                    time.sleep(health.backoff(attempt, RETRY_DELAY))
+                    attempt += 1
                 else:
                     return value
         return retrier
 
-    def multi_interact(self, line, handler):
+    def _timeout_for(self, server):
+        timeout = getattr(server, 'timeout', None)
+        return self.timeout if timeout is None else timeout
+
+    def _broadcast(self, line, handler, wait=0):
+        """Sends the command to all the servers at once. Returns a dict
+        mapping each server to a (status, value) pair, see broadcast."""
+        self._reconnect()
+        results = {}
+        requests = []
         for server in self.servers:
-            logger.warn("Sending %s to: %s", line, server)
-            try:
-                server._do_interaction(line, handler.clone())
-            except ServerInUse, (msg, server):
-                logger.info(msg)
-                # ignore
-                pass
-
-        asyncore.loop(use_poll=True,
-                      timeout=ASYNCORE_TIMEOUT,
-                      count=ASYNCORE_COUNT)
-        results = filter(None, (s.result for s in self.servers))
+            if server._socket is None:
+                NotConnected = protohandler.errors.NotConnected
+                results[server] = ('error', NotConnected(
+                    '%s is not connected' % (server,), server))
+            else:
+                server.health.attempt()
+                requests.append((server, [(line, handler.clone())],
+                                 self._timeout_for(server) + wait))
+
+        replies = self.multiplexer.run(requests)
+        for server, commands, timeout in requests:
+            res = replies[server][0]
+            self._record(server, res if isinstance(res, Exception) else None)
+            if isinstance(res, protohandler.errors.CommandTimeout):
+                results[server] = ('timeout', res)
+            elif isinstance(res, Exception):
+                results[server] = ('error', res)
+            else:
+                results[server] = ('ok', server._make_job(res))
         return results
 
+    def broadcast(self, cmd, *args, **kwargs):
+        """Sends the command cmd (the name of a protocol method, e.g.
+        'stats') to all the servers at once, and returns a dict mapping each
+        server to a (status, value) pair:
+
+            ('ok', reply)             the server answered
+            ('error', exception)      an error reply, or the server is lost
+            ('timeout', exception)    no reply in time (CommandTimeout)
+
+        Each server has its own deadline: its timeout attribute if it has
+        one set, the pool's timeout otherwise, plus the wait of a
+        reserve-with-timeout. So the call takes as long as the slowest
+        server to answer, and no longer than the longest deadline. Servers
+        that time out are reconnected before the next command.
+        """
+        func = getattr(protohandler, "process_%s" % cmd)
+        wait = 0
+        if cmd == 'reserve_with_timeout':
+            wait = args[0] if args else kwargs.get('timeout', 0)
+        return self._broadcast(*func(*args, **kwargs), wait=wait)
+
+    def multi_interact(self, line, handler, wait=0):
+        """Sends the command to all the servers at once, and returns the
+        replies as a list, in the order of the servers. Servers that didn't
+        answer in time or were lost are left out. An error reply is raised,
+        once all the replies are in."""
+        results = self._broadcast(line, handler, wait)
+        replies = []
+        error = None
+        for server in self.servers:
+            status, value = results.get(server, (None, None))
+            if status == 'ok':
+                replies.append(value)
+            elif status == 'timeout' or \
+                    isinstance(value, protohandler.errors.NotConnected):
+                logger.warning("No reply from %s: %s", server, value)
+            elif status == 'error':
+                error = error or value
+        if error:
+            raise error
+        return replies
+
     @retry_until_succeeds
     def _all_broadcast(self, cmd, *args, **kwargs):
-        """Broadcast to all servers and return the results in a compacted
-        dictionary, where the keys are the server objects and the values are
-        the result of the command.
+        """Broadcast to all servers and return the replies in a list, as
+        multi_interact does.
 
         """
         func = getattr(protohandler, "process_%s" % cmd)
-        return self.multi_interact(*func(*args, **kwargs))
+        wait = 0
+        if cmd == 'reserve_with_timeout':
+            wait = args[0] if args else kwargs.get('timeout', 0)
+        return self.multi_interact(*func(*args, **kwargs), wait=wait)
+
+    def route(self, key=None):
+        """Returns the server the router picks for key, skipping those that
+        are unhealthy or draining, and those that can't be reconnected."""
+        exclude = set(server for server in self.servers
+                      if not server.health.accepts_puts())
+        while True:
+            server = self.router.route(key or self.used_tube, exclude)
+            if server is None:
+                NotConnected = protohandler.errors.NotConnected
+                raise NotConnected("Not connected to a server!")
+            if not self._reconnect_server(server):
+                exclude.add(server)
+                continue
+            return server
+
+    @retry_until_succeeds
+    def _routed(self, key, cmd, *args, **kwargs):
+        """Sends the command to the server routed to for key. Retries if
+        various error connections are encountered. Server errors are passed
+        on to the router, so that it can avoid the server."""
+        return self._send(self.route(key), cmd, *args, **kwargs)
 
     @retry_until_succeeds
     def _rand_broadcast(self, cmd, *args, **kwargs):
@@ -415,7 +465,7 @@ class ServerPool(object):
         Retries if various error connections are encountered.
         """
         random_server = self.get_random_server()
-        return getattr(random_server, cmd)(*args, **kwargs)
+        return self._send(random_server, cmd, *args, **kwargs)
 
     @retry_until_succeeds
     def _first_broadcast_response(self, cmd, *args, **kwargs):
@@ -436,17 +486,134 @@ class ServerPool(object):
 
         return []
 
-    def put(self, *args, **kwargs):
-        return self._rand_broadcast("put", *args, **kwargs)
-
-    def reserve(self, *args, **kwargs):
-        return self._all_broadcast("reserve", *args, **kwargs)
+    def put(self, data, pri=1, delay=0, ttr=60, key=None):
+        """Puts the job on the server the router picks for key."""
+        return self._routed(key, "put", data, pri, delay, ttr)
+
+    def put_many(self, items, pri=1, delay=0, ttr=60,
+                 window=serverconn.PIPELINE_WINDOW, key=None):
+        """Puts many jobs, each on the server the router picks as put does;
+        key, if given, is called with each item for the key to route it on.
+        The puts for each server are pipelined, see serverconn.put_many for
+        the items and the results. The results are in the order of items.
+        The items routed to a server that is lost get (None, NotConnected),
+        without stopping the puts on the other servers."""
+        groups = {}
+        for i, item in enumerate(items):
+            server = self.route(key(item) if key else None)
+            groups.setdefault(server, []).append((i, item))
+
+        results = {}
+        for server, group in groups.iteritems():
+            server.health.attempt()
+            try:
+                outcomes = serverconn.put_many(server,
+                                               [item for i, item in group],
+                                               pri, delay, ttr, window)
+            except (protohandler.errors.NotConnected, socket.error), e:
+                self._record(server, e)
+                if server._socket is not None:
+                    server.close()
+                NotConnected = protohandler.errors.NotConnected
+                outcomes = [(None, NotConnected("Lost connection to %s: %s"
+                                                % (server, e), server))
+                            ] * len(group)
+            else:
+                self._record(server)
+            for (i, item), outcome in izip(group, outcomes):
+                results[i] = outcome
+        return [results[i] for i in xrange(len(results))]
+
+    def reserve(self):
+        """Reserves a job on every server that has one ready within the
+        pool's timeout, and returns them in a list, which is empty if there
+        were none. It is sent as a reserve-with-timeout, so the servers that
+        have no job answer TIMED_OUT instead of being left waiting.
+
+        Use reserve_one or reserve_many to reserve no more jobs than will
+        be worked on."""
+        wait = int(math.ceil(self.timeout))
+        return [res for res in self._all_broadcast("reserve_with_timeout", wait)
+                if res['state'] != 'timeout']
+
+    def _poll_reserve(self, count):
+        """Asks the servers for a job without waiting, one after the other,
+        until count jobs are reserved. Each round starts at the next server,
+        so that all of them are served. A server that doesn't answer within
+        its timeout is skipped, and reconnected in the next round."""
+        servers = self._connected()
+        if not servers:
+            NotConnected = protohandler.errors.NotConnected
+            raise NotConnected("Not connected to a server!")
+        start = self._reserve_start % len(servers)
+        self._reserve_start += 1
+
+        jobs = []
+        for server in servers[start:] + servers[:start]:
+            if server._socket is None:
+                continue
+            server.health.attempt()
+            command = protohandler.process_reserve_with_timeout(0)
+            res = self.multiplexer.run([(server, [command],
+                                         self._timeout_for(server))])[server][0]
+            if not isinstance(res, Exception):
+                self._record(server)
+            else:
+                self._record(server, res)
+                if isinstance(res, (protohandler.errors.NotConnected,
+                                    protohandler.errors.CommandTimeout)):
+                    logger.warning("No reply from %s: %s", server, res[0])
+                    continue
+                if isinstance(res, protohandler.errors.DeadlineSoon):
+                    continue
+                raise res
+            if res['state'] == 'ok':
+                jobs.append(server._make_job(res))
+                if len(jobs) >= count:
+                    break
+        return jobs
+
+    def reserve_many(self, count, timeout=None):
+        """Reserves up to count jobs from the servers, and returns them in a
+        list. No more than count jobs are ever reserved: the servers are
+        asked one at a time with a reserve-with-timeout 0, starting at a
+        different one each round. If none has a job, it waits for one,
+        polling every RESERVE_POLL_MIN to RESERVE_POLL_MAX seconds, for up to
+        timeout seconds (forever if it is None). Returns an empty list if
+        there was no job in that time."""
+        deadline = None if timeout is None else time.time() + timeout
+        wait = RESERVE_POLL_MIN
+        while True:
+            jobs = self._poll_reserve(count)
+            if jobs:
+                return jobs
+            now = time.time()
+            if deadline is not None:
+                if now >= deadline:
+                    return []
+                wait = min(wait, deadline - now)
+            time.sleep(wait)
+            wait = min(wait * 2, RESERVE_POLL_MAX)
+
+    def reserve_one(self, timeout=None):
+        """Reserves a single job, see reserve_many. Returns None if there
+        was none within timeout seconds."""
+        jobs = self.reserve_many(1, timeout)
+        return jobs[0] if jobs else None
 
     def reserve_with_timeout(self, *args, **kwargs):
         return self._all_broadcast("reserve_with_timeout", *args, **kwargs)
 
-    def use(self, *args, **kwargs):
-        return self._all_broadcast("use", *args, **kwargs)
+    def use(self, tube):
+        """Uses tube on all the servers. Servers that aren't connected, or
+        don't answer in time, use it when they are reconnected."""
+        try:
+            return self._all_broadcast("use", tube)
+        finally:
+            self.used_tube = tube
+            for server in self.servers:
+                if server._socket is None:
+                    server.used_tube = tube
 
     def peek(self, *args, **kwargs):
         return self._all_broadcast("peek", *args, **kwargs)
@@ -461,62 +628,95 @@ class ServerPool(object):
         return self._first_broadcast_response("peek_ready", *args, **kwargs)
 
     def combine_stats(func):
-        def combiner(self, *args, **kwargs):
-            appendables = set(['name', 'version', 'pid'])
-            returned = func(self, *args, **kwargs)
+        """Broadcasts func's func.__name__ (stats or stats_tube) to all the
+        servers at once, and combines their stats with aggregate_stats. The
+        result has the combined stats as its data, and the stats of each
+        server that answered in servers, keyed by server.
+
+        Servers that don't answer in time are left out, as are those where
+        a stats_tube's tube doesn't exist, unless it exists on none of them
+        (NotFound is raised then). Other error replies are raised.
 
-            if not returned:
+        The result is cached for the pool's stats_ttl seconds, if that is
+        set, and is then shared by the callers: it shouldn't be changed.
+
+        """
+        def combiner(self, *args, **kwargs):
+            key = (func.__name__,) + args + tuple(sorted(kwargs.items()))
+            if self.stats_ttl:
+                cached = self._stats_cache.get(key)
+                if cached and time.time() - cached[0] < self.stats_ttl:
+                    return cached[1]
+
+            servers = {}
+            error = notfound = None
+            for server, (status, value) in \
+                    self.broadcast(func.__name__, *args, **kwargs).iteritems():
+                if status == 'ok':
+                    servers[server] = value['data']
+                elif status == 'timeout' or \
+                        isinstance(value, protohandler.errors.NotConnected):
+                    logger.warning("No reply from %s: %s", server, value)
+                elif isinstance(value, protohandler.errors.NotFound):
+                    notfound = value
+                else:
+                    error = error or value
+            if error:
+                raise error
+            if not servers:
+                if notfound:
+                    raise notfound
                 return {}
 
-            # need to combine these results
-            result = dict(reduce(lambda x, y: x.items() + y.items(), returned))
-            # set-ify that which we want to add
-            for a in appendables:
-                try:
-                    result['data'][a] = set(map(lambda x: x['data'][a],
-                                                returned))
-                except KeyError:
-                    # if the appendable key isnt in the result..
-                    # ignore
-                    pass
-
-            del returned[:]
+            result = {'state': 'ok',
+                      'data': aggregate_stats(servers.values()),
+                      'servers': servers}
+            if self.stats_ttl:
+                self._stats_cache[key] = (time.time(), result)
             return result
         return combiner
 
     @combine_stats
-    def stats(self, *args, **kwargs):
-        return self._all_broadcast("stats", *args, **kwargs)
+    def stats(self):
+        # see combine_stats
+        pass
 
     @combine_stats
-    def stats_tube(self, *args, **kwargs):
-        return self._all_broadcast("stats_tube", *args, **kwargs)
+    def stats_tube(self, tube):
+        pass
 
-    @retry_until_succeeds
     def apply_and_compact(func):
-        """Applies func's func.__name__ to all servers in the server pool
-        and tallies results into a dictionary.
+        """Broadcasts func's func.__name__ to all servers in the server pool
+        at once and tallies results into a dictionary, keyed by server.
 
-        Returns a dictionary of all results tallied into one.
+        Servers that don't answer in time are left out (broadcast has them
+        all, with their status). An error reply is raised.
 
         """
         def generic_applier(self, *args, **kwargs):
-            cmd = func.__name__
             results = {}
-            for server in self.servers:
-                results[server] = getattr(server, cmd)(*args, **kwargs)
+            error = None
+            for server, (status, value) in \
+                    self.broadcast(func.__name__, *args, **kwargs).iteritems():
+                if status == 'ok':
+                    results[server] = value
+                elif status == 'timeout' or \
+                        isinstance(value, protohandler.errors.NotConnected):
+                    logger.warning("No reply from %s: %s", server, value)
+                else:
+                    error = error or value
+            if error:
+                raise error
             return results
         return generic_applier
 
     @apply_and_compact
     def list_tubes(self, *args, **kwargs):
         # instead of having to repeating myself by writing an iteration of
-        # all servers to execute and store results in a hash, the decorator 
-        # apply_and_compact will apply the function name (e.g. list_tubes)
-        # to all servers and compact/tally them all into a dictionary
-        #
-        # we don't use multi_interact here because we don't need to handle
-        # a response explicitly
+        # all servers to execute and store results in a hash, the decorator
+        # apply_and_compact will broadcast the function name (e.g.
+        # list_tubes) to all servers and compact/tally the replies into a
+        # dictionary
         pass
 
     @apply_and_compact
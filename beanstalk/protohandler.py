@@ -32,6 +32,7 @@ my code...
 
 import StringIO
 import re
+from collections import deque
 from itertools import izip, imap
 from functools import wraps
 
@@ -48,18 +49,35 @@ def load_yaml(yaml_string):
     return yaml.load(handler)
 
 
+def protMethod(func):
+    '''Turns the protocol function func (i.e. a process_* function) into a
+    method that sends the command through self._do_interaction, and returns
+    whatever that returns.'''
+    @wraps(func)
+    def method(self, *args, **kw):
+        return self._do_interaction(*func(*args, **kw))
+    method.__name__ = func.__name__.partition('_')[2]
+    return method
+
 def protProvider(cls):
     ''' Class decorator to be applied to anything that we want to provide the
     beanstalk protocol (e.g. connections).  This will implement all the
     protocol functions (i.e. process_*) as methods in the class that is
-    decorated. in ver < py2.6 this should be cls = protProvider(cls), in
+    decorated. The methods are built once, here, and each one passes the
+    (line, handler) pair from its process_* function to the instance's
+    _do_interaction method, which the class has to implement. A protocol
+    method the class defines itself (e.g. to pass extra arguments to the
+    process_* function) is left alone.
+    in ver < py2.6 this should be cls = protProvider(cls), in
     2.6 and higher, they got all nice and implemented the decorator sugar for
     classes'''
     for name, value in globals().items():
         if not name.startswith('process_'):
             continue
         name = name.partition('_')[2]
-        setattr(cls, name, staticmethod(value))
+        if name in cls.__dict__:
+            continue
+        setattr(cls, name, protMethod(value))
 
     return cls
 
@@ -139,22 +157,25 @@ class Handler(object):
     def handler(self):
         eol = '\r\n'
 
-        response = ''
-        sep = ''
+        # the reply line usually comes in one piece, but when it doesn't the
+        # pieces are only joined once the eol has been seen
+        chunks = [(yield None)]
+        while eol not in chunks[-1] and not (len(chunks) > 1 and
+                chunks[-2].endswith('\r') and chunks[-1].startswith('\n')):
+            chunks.append((yield None))
+        response, sep, data = ''.join(chunks).partition(eol)
+        del chunks
 
         # TODO: figure out the max possible response line, and set the default
         # remaining to that amount. check for sep or that amount of data...
         # its a bit of a sanity check, as this could be attacked.
         #
-        while not sep:
-            response += (yield None)
-            response, sep, data = response.partition(eol)
-
-        checkError(response)
 
         response = response.split(' ')
         word = response.pop(0)
 
+        checkError(word)
+
         resp = self.lookup.get(word, None)
 
         # sanity checks
@@ -176,20 +197,104 @@ class Handler(object):
             yield reply
             return
 
-        self.remaining = (reply['bytes'] + 2) - len(data)
+        # The data (and its trailing eol) is copied straight into a buffer of
+        # the size the server announced, so a job body is never concatenated
+        # or copied more than once on its way to the reply.
+        size = reply['bytes'] + 2
+        body = bytearray(size)
+        filled = len(data)
+        if filled > size:
+            raise errors.ExpectedCrlf('Data not properly sent from server')
+        body[:filled] = data
+        del data
 
+        self.remaining = size - filled
         while self.remaining > 0:
             newdata = (yield None)
-            self.remaining -= len(newdata)
-            data += newdata
-
-        if not data.endswith(eol) or not (len(data) == reply['bytes']+2):
+            n = len(newdata)
+            if n > self.remaining:
+                raise errors.ExpectedCrlf('Data not properly sent from server')
+            body[filled:filled + n] = newdata
+            filled += n
+            self.remaining -= n
+
+        if body[-2:] != eol:
             raise errors.ExpectedCrlf('Data not properly sent from server')
+        del body[-2:]
 
-        reply['data'] = resp.parsefunc(data.rstrip(eol))
+        reply['data'] = resp.parsefunc(str(body))
         yield reply
         return
 
+class ResponseReader(object):
+    '''
+    ResponseReader: splits the stream of bytes sent back by a server into
+    replies, and feeds each reply to the handler of the command it answers.
+
+    Handlers are queued with expect(), in the same order the commands were
+    sent. Whatever is read from the server is given to feed(), in chunks of
+    any size. Each handler gets its reply line and then exactly as much data
+    as it still expects, so several replies can arrive in one chunk (e.g. when
+    commands are pipelined). Bytes that are not a complete reply line yet are
+    kept until the next feed.
+
+    feed() returns the replies completed by that chunk, in order. If a handler
+    raises (e.g. the server sent NOT_FOUND), the exception is returned in
+    place of the reply; the stream stays in sync either way, and it is up to
+    the caller to raise it.
+    '''
+    def __init__(self):
+        self.handlers = deque()
+        self._buf = ''
+        self._indata = False
+
+    def __len__(self):
+        return len(self.handlers)
+
+    def expect(self, handler):
+        self.handlers.append(handler)
+
+    def reset(self):
+        self.handlers.clear()
+        self._buf = ''
+        self._indata = False
+
+    def feed(self, data):
+        eol = '\r\n'
+        buf = self._buf + data if self._buf else data
+        end = len(buf)
+        pos = 0
+        results = []
+
+        while self.handlers and pos < end:
+            handler = self.handlers[0]
+            if not self._indata:
+                i = buf.find(eol, pos)
+                if i < 0:
+                    break
+                chunk = buf[pos:i + 2]
+            else:
+                # data is passed on as a buffer, the handler copies it into
+                # the job body itself
+                chunk = buffer(buf, pos, handler.remaining)
+            pos += len(chunk)
+
+            try:
+                res = handler(chunk)
+            except Exception, e:
+                res = e
+
+            if res is None:
+                self._indata = True
+                continue
+
+            self._indata = False
+            self.handlers.popleft()
+            results.append(res)
+
+        self._buf = buf[pos:] if pos else buf
+        return results
+
 # since the beanstalk protocol uses a simple command-response structure,
 # this decorator makes life easy.  The function it wraps corresponds to a
 # beanstalk command, and returns the appropriate command text.
@@ -223,7 +328,7 @@ def check_name(name):
         raise errors.BadFormat('Illegal tube name %r' % name)
 
 @interaction(OK('INSERTED',['jid']), Buried('BURIED', ['jid']))
-def process_put(data, pri=1, delay=0, ttr=60):
+def process_put(data, pri=1, delay=0, ttr=60, max_size=None):
     """
     put
         send:
@@ -234,12 +339,14 @@ def process_put(data, pri=1, delay=0, ttr=60):
             INSERTED <jid>
             BURIED <jid>
     NOTE: this function does a check for job size <= max job size, and
-    raises a protocol error when the size is too big.
+    raises a protocol error when the size is too big. The max job size is
+    max_size, if given (e.g. the connection's), MAX_JOB_SIZE otherwise.
     """
     dlen = len(data)
-    if dlen >= MAX_JOB_SIZE:
+    limit = MAX_JOB_SIZE if max_size is None else max_size
+    if dlen >= limit:
         raise errors.JobTooBig('Job size is %s (max allowed is %s' %\
-            (dlen, MAX_JOB_SIZE))
+            (dlen, limit))
     putline = 'put %(pri)s %(delay)s %(ttr)s %(dlen)s\r\n%(data)s\r\n'
     return putline % locals()
 
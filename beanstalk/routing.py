@@ -0,0 +1,361 @@
+"""
+Routing strategies for ServerPool: which server a job is put on.
+
+A router is told the pool's servers with update() whenever they change, and
+route() picks one, for a key if it is given one:
+
+    RandomRouter       a server picked at random
+    RoundRobinRouter   each server in turn, as often as its weight says
+    HashRouter         consistent hashing of the key (e.g. the tube name) on
+                       a ketama style ring, so that jobs with the same key
+                       go to the same server, and adding or removing one of
+                       N servers only moves about 1/N of the keys
+    LoadRouter         the least loaded server, from stats sampled in the
+                       background, keeping away from servers that are
+                       draining or out of memory
+
+weights map a (host, port) pair to a relative weight, 1 for servers not in
+it. route() is also given the servers to exclude, e.g. the ones that can't
+be reached, and returns None if that leaves none.
+"""
+
+import copy
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+from bisect import bisect_left
+from hashlib import md5
+
+import errors
+import protohandler
+import serverconn
+from multiplexer import Multiplexer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def server_name(server):
+    return '%s:%s' % (server.server, server.port)
+
+
+class Router(object):
+    """The base router: it keeps the server list and the weights."""
+    def __init__(self, weights = None):
+        self.weights = dict(weights or {})
+        self.servers = []
+
+    def __repr__(self):
+        return "<%s %s servers>" % (self.__class__.__name__, len(self.servers))
+
+    def weight(self, server):
+        return self.weights.get((server.server, server.port), 1)
+
+    def update(self, servers):
+        """Called with the pool's servers whenever they change."""
+        self.servers = list(servers)
+
+    def route(self, key = None, exclude = ()):
+        raise NotImplementedError
+
+    def failed(self, server, error):
+        """Called with the server error (e.g. Draining) a command routed to
+        server got."""
+        pass
+
+    def clone(self):
+        """Returns a router like this one for another pool."""
+        return copy.copy(self)
+
+    def close(self):
+        """Called when the pool is closed."""
+        pass
+
+
+class RandomRouter(Router):
+    """Picks a server at random, with a chance in proportion to its weight.
+    It has a random.Random of its own, seeded once."""
+    def __init__(self, weights = None, seed = None):
+        Router.__init__(self, weights)
+        self.random = random.Random(seed)
+        self._choices = []
+
+    def update(self, servers):
+        Router.update(self, servers)
+        self._choices = [server for server in self.servers
+                         for i in xrange(self.weight(server))]
+
+    def route(self, key = None, exclude = ()):
+        choices = self._choices
+        if exclude:
+            choices = [server for server in choices if server not in exclude]
+        if not choices:
+            return None
+        return choices[int(self.random.random() * len(choices))]
+
+
+class RoundRobinRouter(Router):
+    """Hands out the servers in turn, each as often as its weight, spread
+    out evenly (the smooth weighted round robin nginx uses: with weights
+    5, 1, 1 the order is a a b a c a a, not a a a a a b c)."""
+    def __init__(self, weights = None):
+        Router.__init__(self, weights)
+        self._current = []
+
+    def update(self, servers):
+        Router.update(self, servers)
+        self._current = [0] * len(self.servers)
+
+    def route(self, key = None, exclude = ()):
+        best = None
+        total = 0
+        current = self._current
+        for i, server in enumerate(self.servers):
+            if exclude and server in exclude:
+                continue
+            weight = self.weight(server)
+            current[i] += weight
+            total += weight
+            if best is None or current[i] > current[best]:
+                best = i
+        if best is None:
+            return None
+        current[best] -= total
+        return self.servers[best]
+
+
+class HashRouter(Router):
+    """Consistent hashing on a ketama style ring: each server has vnodes
+    points on it (times its weight), and a key goes to the server of the
+    first point at or after the key's hash, or the next one along that isn't
+    excluded. A route without a key is sent to the ring as key ''."""
+    def __init__(self, weights = None, vnodes = 160):
+        Router.__init__(self, weights)
+        self.vnodes = vnodes
+        self._points = []
+        self._owners = []
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return struct.unpack('<I', md5(str(key)).digest()[:4])[0]
+
+    def update(self, servers):
+        Router.update(self, servers)
+        ring = []
+        for server in self.servers:
+            name = server_name(server)
+            # four points per digest, as ketama does
+            for i in xrange((self.vnodes * self.weight(server) + 3) // 4):
+                digest = md5('%s-%s' % (name, i)).digest()
+                for point in struct.unpack('<4I', digest):
+                    ring.append((point, server))
+        ring.sort(key=lambda entry: entry[0])
+        self._points = [point for point, server in ring]
+        self._owners = [server for point, server in ring]
+
+    def route(self, key = None, exclude = ()):
+        owners = self._owners
+        if not owners:
+            return None
+        start = bisect_left(self._points, self._hash(key or ''))
+        for i in xrange(start, start + len(owners)):
+            server = owners[i % len(owners)]
+            if not exclude or server not in exclude:
+                return server
+        return None
+
+
+class LoadRouter(Router):
+    """Routes to the least loaded server, by the stats of each server
+    sampled every interval seconds from a background thread (start() it),
+    over connections of its own so that the pool's are never used by two
+    threads. The load of a server is
+
+        current-jobs-ready (of tube, if one is given, from stats-tube)
+        + connection_cost * current-connections
+        + binlog_cost * the number of binlog files not yet compacted
+
+    divided by its weight. Each job routed to a server counts as one more
+    ready job on it until the next sample, so that puts are spread out
+    between samples instead of all going to the same server.
+
+    Samples older than ttl seconds are not used: servers without a recent
+    one are only routed to when no server has one. Servers that report
+    they are draining, or answer a command with DRAINING or OUT_OF_MEMORY
+    (see failed()), are avoided for ttl seconds.
+    """
+    connection_cost = 1
+    binlog_cost = 50
+
+    def __init__(self, weights = None, interval = 1.0, ttl = 5.0, tube = None,
+                 timeout = None, clock = time.time):
+        Router.__init__(self, weights)
+        self.interval = interval
+        self.ttl = ttl
+        self.tube = tube
+        self.timeout = interval if timeout is None else timeout
+        self.clock = clock
+        self.samples = {}       # server -> (time, load)
+        self.routed = {}        # server -> jobs routed since the sample
+        self.avoided = {}       # server -> time until which it is avoided
+        self.multiplexer = Multiplexer()
+        self.lock = threading.Lock()
+        self.thread = None
+        self._conns = {}        # server -> the sampler's ServerConn
+        self._stopping = threading.Event()
+
+    def load(self, stats, tube_stats = None):
+        """Returns the load of a server from its stats, and the stats of
+        the tube if there is one."""
+        ready = (tube_stats or stats).get('current-jobs-ready', 0)
+        binlogs = stats.get('binlog-current-index', 0) - \
+                  stats.get('binlog-oldest-index', 0)
+        return ready + \
+               self.connection_cost * stats.get('current-connections', 0) + \
+               self.binlog_cost * max(0, binlogs)
+
+    def sampled(self, server, stats, tube_stats = None, now = None):
+        """Records the stats sampled for server."""
+        now = now or self.clock()
+        if stats.get('draining'):
+            self.avoided[server] = now + self.ttl
+        self.samples[server] = (now, self.load(stats, tube_stats))
+        self.routed[server] = 0
+
+    def failed(self, server, error):
+        if isinstance(error, (errors.Draining, errors.OutOfMemory)):
+            logger.warning("Avoiding %s for %ss: %r", server_name(server),
+                           self.ttl, error)
+            self.avoided[server] = self.clock() + self.ttl
+
+    def update(self, servers):
+        self.lock.acquire()
+        try:
+            Router.update(self, servers)
+            for server in self._conns.keys():
+                if server not in self.servers:
+                    conn = self._conns.pop(server)
+                    self.multiplexer.unregister(conn)
+                    if conn._socket is not None:
+                        conn.close()
+            for table in (self.samples, self.routed, self.avoided):
+                for server in table.keys():
+                    if server not in self.servers:
+                        del table[server]
+        finally:
+            self.lock.release()
+
+    def route(self, key = None, exclude = ()):
+        now = self.clock()
+        best = None
+        for server in self.servers:
+            if exclude and server in exclude or \
+                    self.avoided.get(server, 0) > now:
+                continue
+            when, load = self.samples.get(server, (None, 0))
+            stale = when is None or now - when > self.ttl
+            if stale:
+                load = 0
+            score = (stale, float(load + self.routed.get(server, 0)) /
+                            self.weight(server))
+            if best is None or score < best[0]:
+                best = score, server
+        if best is None:
+            return None
+        server = best[1]
+        self.routed[server] = self.routed.get(server, 0) + 1
+        return server
+
+    def _conn(self, server):
+        conn = self._conns.get(server)
+        if conn is not None and conn._socket is not None:
+            return conn
+        try:
+            if conn is None:
+                conn = serverconn.ServerConn(server.server, server.port)
+                self._conns[server] = conn
+            else:
+                conn.connect()
+        except (socket.error, errors.BeanStalkError), e:
+            logger.warning("Could not sample %s: %s", server_name(server), e)
+            return None
+        self.multiplexer.register(conn)
+        return conn
+
+    def sample(self):
+        """Samples the stats of all the servers at once, waiting up to
+        timeout seconds for them."""
+        self.lock.acquire()
+        try:
+            requests = []
+            servers = {}
+            for server in self.servers:
+                conn = self._conn(server)
+                if conn is None:
+                    continue
+                commands = [protohandler.process_stats()]
+                if self.tube:
+                    commands.append(protohandler.process_stats_tube(self.tube))
+                requests.append((conn, commands))
+                servers[conn] = server
+            replies = self.multiplexer.run(requests, self.timeout)
+            now = self.clock()
+            for conn, results in replies.iteritems():
+                stats = results[0]
+                if isinstance(stats, Exception):
+                    logger.warning("Could not sample %s: %r",
+                                   server_name(servers[conn]), stats)
+                    continue
+                tube_stats = results[1] if self.tube else None
+                if isinstance(tube_stats, errors.NotFound):
+                    # the tube doesn't exist there (yet)
+                    tube_stats = {'current-jobs-ready': 0}
+                elif isinstance(tube_stats, Exception):
+                    continue
+                elif tube_stats is not None:
+                    tube_stats = tube_stats['data']
+                self.sampled(servers[conn], stats['data'], tube_stats, now)
+        finally:
+            self.lock.release()
+
+    def _run(self):
+        while not self._stopping.isSet():
+            start = time.time()
+            try:
+                self.sample()
+            except Exception, e:
+                logger.exception(e)
+            self._stopping.wait(max(0, self.interval - (time.time() - start)))
+
+    def start(self):
+        """Starts sampling in a background thread. Returns the router."""
+        self._stopping.clear()
+        self.thread = threading.Thread(target=self._run,
+                                       name=self.__class__.__name__)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def clone(self):
+        router = self.__class__(self.weights, self.interval, self.ttl,
+                                self.tube, self.timeout, self.clock)
+        if self.thread is not None:
+            router.start()
+        return router
+
+    def close(self):
+        """Stops sampling and closes the sampler's connections."""
+        self.stop()
+        self.update([])
+        self.multiplexer.close()
@@ -1,12 +1,42 @@
+import heapq
 import socket
 import select
-import protohandler
+import threading
+import time
 import logging
+from contextlib import contextmanager
+from itertools import islice, izip
+
+import health
+import protohandler
 
 _debug = False
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# how much to ask the socket for at once. Replies are read in chunks of this
+# size, and anything read past the reply is kept for the next one.
+RECV_SIZE = 2**16
+
+# how many commands the *_many methods send at once
+PIPELINE_WINDOW = 500
+
+# the commands that can be sent again after a reconnect: they change nothing
+# on the server, or nothing the lost connection didn't undo (the jobs reserved
+# on it are released)
+IDEMPOTENT = frozenset(['use', 'watch', 'ignore', 'reserve',
+                        'reserve-with-timeout', 'peek', 'peek-ready',
+                        'peek-delayed', 'peek-buried', 'stats', 'stats-job',
+                        'stats-tube', 'list-tubes', 'list-tube-used',
+                        'list-tubes-watched'])
+
+# the commands that change the used tube or the watchlist
+TUBE_COMMANDS = ('use ', 'watch ', 'ignore ')
+
+# the max-job-size of each server, by (host, port), as the connections to it
+# found it out; see ServerConn.max_job_size
+MAX_JOB_SIZES = {}
+
 class ConnectionError(Exception): pass
 
 
@@ -23,15 +53,36 @@ class ServerConn(object):
     to be used as a callback. This should greatly simplify the writing of a
     twisted or libevent serverconn class
 
+    The tube used and the tubes watched are kept in used_tube and
+    watched_tubes, and set up again whenever the connection is remade. With
+    reconnect set, a lost connection is remade by the command that finds it
+    lost, up to reconnect_tries times with a backoff from reconnect_delay
+    seconds, and the command is sent again if it is in IDEMPOTENT; other
+    commands raise NotConnected, as they do without reconnect.
+
+    Jobs bigger than max_job_size are refused without being sent, see
+    there.
+
     """
-    def __init__(self, server, port, job = False):
+    reconnect_tries = 5
+    reconnect_delay = .1
+
+    def __init__(self, server, port, job = False, bufsize = RECV_SIZE,
+                 reconnect = False, max_job_size = None):
         self.poller = getattr(select, 'poll', lambda : None)()
         self.job = job
         self.server = server
         self.port = port
+        self.bufsize = bufsize
+        self.reconnect = reconnect
+        self._max_job_size = max_job_size
+        self.used_tube = 'default'
+        self.watched_tubes = set(['default'])
 
         self._socket  = None
-        self.__makeConn()
+        self._reader = protohandler.ResponseReader()
+        self._reconnecting = False
+        self.connect()
 
     def __repr__(self):
         s = "<[%(active)s]%(class)s(%(ip)s:%(port)s)>"
@@ -39,39 +90,130 @@ class ServerConn(object):
         return s % {"class" : self.__class__.__name__,
                     "active" : active_, "ip" : self.server, "port" : self.port}
 
-    def __getattribute__(self, attr):
-        logger.debug("Fetching: %s", attr)
-        res = super(ServerConn, self).__getattribute__(attr)
-        logger.debug("Attribute found: %s...", res)
-        if not hasattr(res, "__name__") or not res.__name__.startswith('process_'):
-            return res
-        def caller(*args, **kw):
-            logger.info("Calling %s with: args(%s), kwargs(%s)",
-                         res.__name__, args, kw)
-            return self._do_interaction(*res(*args, **kw))
-        return caller
-
     def __eq__(self, comparable):
         # for unit testing
         assert isinstance(comparable, ServerConn)
         return not any([cmp(self.server, comparable.server),
                         cmp(self.port, comparable.port)])
 
+    def connect(self):
+        """Connects to the server, closing the current connection first if
+        there is one. The connection is made when the ServerConn is created,
+        this is for reconnecting; the used tube and the watchlist are set up
+        as they were. If that fails, the connection is closed again."""
+        if self._socket is not None:
+            self.close()
+        self.__makeConn()
+        try:
+            self._restore_state()
+        except:
+            self.close()
+            raise
+
+    def _restore_state(self):
+        """Sends the use, watch and ignore commands that set the tubes up as
+        used_tube and watched_tubes say, all in one go."""
+        commands = []
+        if self.used_tube != 'default':
+            commands.append(protohandler.process_use(self.used_tube))
+        for tube in self.watched_tubes - set(['default']):
+            commands.append(protohandler.process_watch(tube))
+        if 'default' not in self.watched_tubes:
+            commands.append(protohandler.process_ignore('default'))
+        if not commands:
+            return
+        self._writeline(''.join(line for line, handler in commands))
+        for res in self._get_responses([handler for line, handler in commands]):
+            if isinstance(res, Exception):
+                raise res
+
+    def _track(self, line):
+        """Keeps used_tube and watched_tubes up to date with a use, watch or
+        ignore command that worked."""
+        cmd, tube = line.split()
+        if cmd == 'use':
+            self.used_tube = tube
+        elif cmd == 'watch':
+            self.watched_tubes.add(tube)
+        else:
+            self.watched_tubes.discard(tube)
+
+    def _reconnect(self):
+        """Remakes the lost connection, see reconnect. Raises NotConnected
+        if it can't."""
+        for attempt in xrange(self.reconnect_tries):
+            if attempt:
+                time.sleep(health.backoff(attempt - 1, self.reconnect_delay))
+            try:
+                self.connect()
+            except (socket.error, protohandler.errors.BeanStalkError), e:
+                logger.warning("Could not reconnect to %s:%s: %s",
+                               self.server, self.port, e)
+                self.close()
+                continue
+            logger.info("Reconnected to %s:%s", self.server, self.port)
+            return
+        raise protohandler.errors.NotConnected(
+            "Could not reconnect to %s:%s" % (self.server, self.port), self)
+
+    def _recover(self, lines):
+        """Called when the connection was lost in the middle of the commands
+        in lines. Reconnects if reconnect is set, and returns whether the
+        commands can be sent again."""
+        if not self.reconnect or self._reconnecting:
+            return False
+        self._reconnecting = True
+        try:
+            self._reconnect()
+        finally:
+            self._reconnecting = False
+        return all(line.split(None, 1)[0] in IDEMPOTENT for line in lines)
+
     def __makeConn(self):
-        self._socket = socket.socket()
-        self._socket.connect((self.server, self.port))
+        self._reader.reset()
+        sock = socket.socket()
+        try:
+            sock.connect((self.server, self.port))
+        except socket.error:
+            sock.close()
+            raise
+        self._socket = sock
         if self.poller:
             self.poller.register(self._socket, select.POLLIN)
-        protohandler.MAX_JOB_SIZE = self.stats()['data']['max-job-size']
 
-    def __writeline(self, line):
+    @property
+    def max_job_size(self):
+        """The size of the biggest job the server takes: the max_job_size
+        the connection was made with, if any, or else the server's
+        max-job-size. That is asked for (with stats) when the first job is
+        put, and kept in MAX_JOB_SIZES for the connections made later, and
+        reconnects."""
+        if self._max_job_size is None:
+            key = (self.server, self.port)
+            size = MAX_JOB_SIZES.get(key)
+            if size is None:
+                size = MAX_JOB_SIZES[key] = \
+                    self.stats()['data']['max-job-size']
+            self._max_job_size = size
+        return self._max_job_size
+
+    def put(self, data, pri=1, delay=0, ttr=60):
+        return self._do_interaction(*protohandler.process_put(
+            data, pri, delay, ttr, self.max_job_size))
+
+    def _lost(self, msg):
+        if self._socket is not None:
+            self.close()
+        return protohandler.errors.NotConnected(msg, self)
+
+    def _writeline(self, line):
         try:
             self._socket.sendall(line)
-        except:
-            raise protohandler.errors.ProtoError
+        except (socket.error, AttributeError), e:
+            raise self._lost("Could not send to %s:%s: %s" % (self.server,
+                                                              self.port, e))
 
-    def _get_response(self, handler):
-        data = ''
+    def _recv(self, size):
         pcount = 0
         while True:
             if _debug and self.poller and not self.poller.poll(1):
@@ -79,51 +221,223 @@ class ServerConn(object):
                 if pcount >= 20:
                     raise Exception('poller timeout %s times in a row' % (pcount,))
                 else: continue
-            pcount = 0
-            recv = self._socket.recv(handler.remaining)
+            try:
+                recv = self._socket.recv(size)
+            except socket.error:
+                recv = ''
             if not recv:
                 closedmsg = "Remote server %(server)s:%(port)s has "\
-                            "closed connection" % { "server" : server.ip,
-                                                    "port" : server.port}
-                self.close()
-                raise protohandler.errors.ProtoError(closedmsg)
-            res = handler(recv)
-            if res: break
+                            "closed connection" % { "server" : self.server,
+                                                    "port" : self.port}
+                raise self._lost(closedmsg)
+            return recv
+
+    def _get_responses(self, handlers):
+        """Reads the replies for handlers, which must be in the order their
+        commands were sent. Returns a list with a reply (or an exception
+        instance, for error replies) per handler."""
+        reader = self._reader
+        for handler in handlers:
+            reader.expect(handler)
+
+        results = reader.feed('')
+        while len(results) < len(handlers):
+            results.extend(reader.feed(self._recv(self.bufsize)))
+        return results
+
+    def _get_response(self, handler):
+        res = self._get_responses([handler])[0]
+        if isinstance(res, Exception):
+            raise res
+        return self._make_job(res)
 
-        if self.job and 'jid' in res:
-            res = self.job(conn=self,**res)
+    def _make_job(self, res):
+        """Turns a reply about a job into a job object, if self.job is set"""
+        if self.job and isinstance(res, dict) and 'jid' in res:
+            return self.job(conn=self, **res)
         return res
 
     def _do_interaction(self, line, handler):
-        self.__writeline(line)
-        return self._get_response(handler)
+        try:
+            self._writeline(line)
+            res = self._get_response(handler)
+        except protohandler.errors.NotConnected:
+            if not self._recover([line]):
+                raise
+            self._writeline(line)
+            res = self._get_response(handler.clone())
+        if line.startswith(TUBE_COMMANDS):
+            self._track(line)
+        return res
+
+    def _interact_many(self, commands):
+        """Sends the (line, handler) pairs in commands in one write, and
+        returns the replies as _get_responses does."""
+        data = ''.join(line for line, handler in commands)
+        try:
+            self._writeline(data)
+            results = self._get_responses([handler
+                                           for line, handler in commands])
+        except protohandler.errors.NotConnected:
+            if not self._recover([line for line, handler in commands]):
+                raise
+            self._writeline(data)
+            results = self._get_responses([handler.clone()
+                                           for line, handler in commands])
+        for (line, handler), res in izip(commands, results):
+            if line.startswith(TUBE_COMMANDS) and \
+                    not isinstance(res, Exception):
+                self._track(line)
+        return results
+
+    def put_many(self, items, pri=1, delay=0, ttr=60, window=PIPELINE_WINDOW):
+        """Puts many jobs, pipelining the put commands window jobs at a time.
+        See put_many for details."""
+        return put_many(self, items, pri, delay, ttr, window)
+
+    def reserve_batch(self, max_jobs, timeout=0, window=PIPELINE_WINDOW):
+        """Reserves up to max_jobs jobs that are ready, in about one round
+        trip per window of them. Only the first reserve waits for a job:
+        up to timeout seconds, or for as long as it takes if timeout is
+        None. The rest are reserve-with-timeout 0, and the batch ends at the
+        first of those that times out.
+
+        Returns the list of jobs reserved (job objects if self.job is set,
+        reply dicts otherwise), which is empty if none were ready. An error
+        reply such as DEADLINE_SOON also ends the batch, and is only raised
+        if no job was reserved, so reserved jobs are never lost.
+        """
+        jobs = []
+        error = None
+        while len(jobs) < max_jobs:
+            n = min(window, max_jobs - len(jobs))
+            commands = [protohandler.process_reserve_with_timeout(0)
+                        for i in xrange(n)]
+            if not jobs and timeout is None:
+                commands[0] = protohandler.process_reserve()
+            elif not jobs:
+                commands[0] = protohandler.process_reserve_with_timeout(timeout)
+
+            done = False
+            # a job may still come after a timeout, so every reply is looked at
+            for res in self._interact_many(commands):
+                if isinstance(res, Exception):
+                    error = error or res
+                    done = True
+                elif res['state'] == 'timeout':
+                    done = True
+                else:
+                    jobs.append(self._make_job(res))
+            if done:
+                break
+
+        if error and not jobs:
+            raise error
+        return jobs
+
+    # The *_many acknowledgements below pipeline one command per jid, and
+    # return a (jid, outcome) pair for each. The outcome is the state of the
+    # reply ('ok', or 'buried' when a release had to bury the job), or the
+    # error for that jid, e.g. NotFound; errors are returned, not raised.
+
+    def delete_many(self, jids, window=PIPELINE_WINDOW):
+        jids = list(jids)
+        return _outcomes(jids, pipelined(self, protohandler.process_delete,
+                                         [(jid,) for jid in jids], window))
+
+    def release_many(self, jids, pri=1, delay=0, window=PIPELINE_WINDOW):
+        jids = list(jids)
+        return _outcomes(jids, pipelined(self, protohandler.process_release,
+                                         [(jid, pri, delay) for jid in jids],
+                                         window))
+
+    def bury_many(self, jids, pri=1, window=PIPELINE_WINDOW):
+        jids = list(jids)
+        return _outcomes(jids, pipelined(self, protohandler.process_bury,
+                                         [(jid, pri) for jid in jids], window))
+
+    def touch_many(self, jids, window=PIPELINE_WINDOW):
+        jids = list(jids)
+        return _outcomes(jids, pipelined(self, protohandler.process_touch,
+                                         [(jid,) for jid in jids], window))
+
+    def set_hook(self, hook=None):
+        """Installs hook around every command this connection sends on its
+        own (pipelines aren't hooked), e.g. for logging or timing. The hook is
+        called as hook(conn, line, handler, interact), and must return the
+        result of interact(line, handler), which sends the command and reads
+        its reply. set_hook() with no hook removes it again.
+
+        When no hook is set the commands don't go through any extra code, so
+        there is no cost to having this. See log_interaction for an example.
+        """
+        if hook is None:
+            self.__dict__.pop('_do_interaction', None)
+            return
+        interact = ServerConn._do_interaction.__get__(self)
+        def hooked(line, handler):
+            return hook(self, line, handler, interact)
+        self._do_interaction = hooked
+
+    def pipeline(self):
+        """Returns a Pipeline for this connection. Commands called on the
+        pipeline are queued and sent together when it is executed, see
+        Pipeline for details."""
+        return Pipeline(self)
+
+    def sync_tubes(self):
+        """Asks the server for the tube used and the tubes watched, and sets
+        used_tube and watched_tubes from its replies. They are kept up to
+        date by the connection itself, this is for when they may not be,
+        e.g. after commands were sent behind its back."""
+        used, watched = self._interact_many([
+            protohandler.process_list_tube_used(),
+            protohandler.process_list_tubes_watched()])
+        for res in used, watched:
+            if isinstance(res, Exception):
+                raise res
+        self.used_tube = used['tube']
+        self.watched_tubes = set(watched['data'])
 
     def _get_watchlist(self):
-        return self.list_tubes_watched()['data']
+        return sorted(self.watched_tubes)
+
+    def _watchlist_commands(self, seq):
+        """Returns the watch and ignore commands that make the watchlist
+        seq, watches first so that the connection never watches no tube
+        (which the server refuses with NOT_IGNORED)."""
+        seq = set(seq) or set(['default'])
+        current = self.watched_tubes
+        return [protohandler.process_watch(tube)
+                for tube in sorted(seq - current)] + \
+               [protohandler.process_ignore(tube)
+                for tube in sorted(current - seq)]
 
     def _set_watchlist(self, seq):
-        if len(seq) == 0:
-            seq.append('default')
-        seq = set(seq)
-        current = set(self._get_watchlist())
-        add = seq - current
-        rem = current - seq
-
-        for x in add:
-            self.watch(x)
-        for x in rem:
-            self.ignore(x)
-        return
+        commands = self._watchlist_commands(seq)
+        error = None
+        for i in xrange(0, len(commands), PIPELINE_WINDOW):
+            for res in self._interact_many(commands[i:i + PIPELINE_WINDOW]):
+                if isinstance(res, Exception):
+                    error = error or res
+        if error:
+            raise error
 
     watchlist = property(_get_watchlist, _set_watchlist)
 
     @property
     def tube(self):
-        return self.list_tube_used()['tube']
+        """The tube used, as the connection knows it (see sync_tubes)."""
+        return self.used_tube
 
     def close(self):
-        self.poller.unregister(self._socket)
+        if self._socket is None:
+            return
+        if self.poller:
+            self.poller.unregister(self._socket)
         self._socket.close()
+        self._socket = None
+        self._reader.reset()
 
     def fileno(self):
         return self._socket.fileno()
@@ -132,50 +446,602 @@ class ServerConn(object):
 ServerConn = protohandler.protProvider(ServerConn)
 
 
-class ThreadedConn(ServerConn):
-    def __init__(self, *args, **kw):
-        if 'pool' in kw:
-            self.__pool = kw.pop('pool')
-        super(ThreadedConn, self).__init__(*args, **kw)
+def pipelined(conn, func, arglists, window=PIPELINE_WINDOW):
+    """Calls the protocol function func (e.g. protohandler.process_delete)
+    with each of the argument tuples in arglists, and sends the commands to
+    conn pipelined, window of them at a time. conn must have an
+    _interact_many method, like ServerConn.
+
+    Returns the reply for each command, in order. An error, either an error
+    reply or one raised making the command (e.g. JobTooBig), is returned in
+    place of the reply, and does not stop the rest from being sent.
+    """
+    results = []
+    arglists = iter(arglists)
+    while True:
+        batch = list(islice(arglists, window))
+        if not batch:
+            return results
+
+        commands = []
+        slots = []
+        for args in batch:
+            try:
+                commands.append(func(*args))
+            except protohandler.errors.BeanStalkError, e:
+                results.append(e)
+            else:
+                slots.append(len(results))
+                results.append(None)
+
+        if commands:
+            for i, res in zip(slots, conn._interact_many(commands)):
+                results[i] = res
+
+def put_many(conn, items, pri=1, delay=0, ttr=60, window=PIPELINE_WINDOW):
+    """Puts a job for each of items on conn. An item is either the job data,
+    or a (data[, pri[, delay[, ttr]]]) tuple, with pri, delay and ttr
+    defaulting to the arguments given here.
+
+    The put commands are pipelined, window of them at a time, so there is a
+    round trip per window rather than per job (see pipelined).
+
+    Returns a list with the outcome for each item, in order: (jid, 'ok') for
+    an inserted job, (jid, 'buried') for a job the server had to bury, and
+    (None, exception) for a job that was not put, e.g. because it was too big
+    or the server is draining. These don't stop the rest of the batch.
+    """
+    def arglists():
+        size = (conn.max_job_size,)
+        for item in items:
+            if isinstance(item, basestring):
+                yield (item, pri, delay, ttr) + size
+            else:
+                yield tuple(item) + (pri, delay, ttr)[len(item) - 1:] + size
+
+    return [(None, res) if isinstance(res, Exception)
+            else (res['jid'], res['state'])
+            for res in pipelined(conn, protohandler.process_put, arglists(),
+                                 window)]
+
+def _outcomes(jids, results):
+    return [(jid, res if isinstance(res, Exception) else res['state'])
+            for jid, res in izip(jids, results)]
+
+
+def log_interaction(conn, line, handler, interact):
+    """A hook for ServerConn.set_hook that logs the commands sent and the
+    replies to them."""
+    logger.info("Sending to %r: %r", conn, line)
+    res = interact(line, handler)
+    logger.info("Reply from %r: %s", conn, res)
+    return res
+
+
+class Pipeline(object):
+    """Pipeline queues protocol commands for a ServerConn and sends them in a
+    single write, then reads the replies back in the order the commands were
+    queued. This saves a network round trip for every command but the first.
+
+    It has the same protocol methods as the connection, but they return
+    nothing; the replies are returned by execute(), and also kept in the
+    results attribute. Used as a context manager, the pipeline is executed
+    when the with block exits without an exception, e.g.:
+
+        with conn.pipeline() as p:
+            p.put('foo')
+            p.delete(jid)
+        inserted, deleted = p.results
+
+    An error reply from the server (e.g. NOT_FOUND) does not stop the replies
+    to the remaining commands from being read. The exception is put in the
+    results in place of that command's reply, and unless execute is called
+    with raise_errors=False the first one is raised after all the replies
+    are read.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.commands = []
+        self.results = None
+
+    def __repr__(self):
+        return "<%s(%r) %s commands>" % (self.__class__.__name__, self.conn,
+                                         len(self.commands))
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
 
-    def __del__(self):
-        self.__pool.release(self)
-        super(ThreadedConn, self).__del__()
+    def __exit__(self, exctype, value, traceback):
+        if exctype is None:
+            self.execute()
+        else:
+            self.reset()
+        return False
+
+    def _do_interaction(self, line, handler):
+        self.commands.append((line, handler))
+
+    def put(self, data, pri=1, delay=0, ttr=60):
+        self._do_interaction(*protohandler.process_put(
+            data, pri, delay, ttr, self.conn.max_job_size))
+
+    def reset(self):
+        """Drops all the queued commands without sending them."""
+        del self.commands[:]
+
+    def execute(self, raise_errors=True):
+        commands, self.commands = self.commands, []
+        self.results = []
+        if not commands:
+            return self.results
+
+        self.results = map(self.conn._make_job,
+                           self.conn._interact_many(commands))
+
+        if raise_errors:
+            for res in self.results:
+                if isinstance(res, Exception):
+                    raise res
+        return self.results
+
+Pipeline = protohandler.protProvider(Pipeline)
+
+
+class AckBatch(object):
+    """AckBatch collects the acknowledgements a consumer sends for the jobs
+    it has handled (delete, release, bury, touch) and sends them to the
+    connection as one pipelined batch. The batch is flushed as soon as
+    max_count acknowledgements are waiting, or when one is added and the
+    oldest waiting has been there max_delay seconds or more.
+
+    Nothing is sent in the background, so the last acknowledgements could
+    wait until their jobs' TTR runs out if no more are added. Used as a
+    context manager, the batch is flushed before every reserve sent on the
+    connection (a consumer that goes back for a job has nothing left to
+    acknowledge for a while), and when the with block exits. Used without
+    one, the consumer has to flush() before it blocks, or call tick(), which
+    flushes only if max_delay has passed. A keepalive.Keepalive for the
+    connection should be started before the with block, and stopped after.
+
+    flush() returns a (jid, outcome) pair per acknowledgement, like the
+    ServerConn *_many methods; errors such as NotFound are returned, not
+    raised. When flushes happen automatically the results go to on_flush, if
+    it is given.
+
+        with AckBatch(conn, max_count=50) as acks:
+            while working:
+                job = conn.reserve()
+                ...
+                acks.delete(job['jid'])
+    """
+    def __init__(self, conn, max_count=100, max_delay=1.0, on_flush=None):
+        self.conn = conn
+        self.max_count = max_count
+        self.max_delay = max_delay
+        self.on_flush = on_flush
+        self.pending = []     # (jid, (line, handler))
+        self.oldest = None
+        self._saved = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __enter__(self):
+        self._wrap()
+        return self
+
+    def __exit__(self, exctype, value, traceback):
+        self._unwrap()
+        self.flush()
+        return False
+
+    def _wrap(self):
+        conn = self.conn
+        self._saved = dict((name, conn.__dict__.get(name))
+                           for name in ('_do_interaction', '_interact_many'))
+        do, many = conn._do_interaction, conn._interact_many
+
+        def _do_interaction(line, handler):
+            if self.pending and line.startswith('reserve'):
+                self._autoflush()
+            return do(line, handler)
+
+        def _interact_many(commands):
+            if self.pending and any(line.startswith('reserve')
+                                    for line, handler in commands):
+                self._autoflush()
+            return many(commands)
+
+        conn._do_interaction = _do_interaction
+        conn._interact_many = _interact_many
+
+    def _unwrap(self):
+        for name, saved in self._saved.iteritems():
+            if saved is None:
+                self.conn.__dict__.pop(name, None)
+            else:
+                setattr(self.conn, name, saved)
+        self._saved = None
+
+    def _add(self, jid, func, *args):
+        self.pending.append((jid, func(jid, *args)))
+        if self.oldest is None:
+            self.oldest = time.time()
+        if len(self.pending) >= self.max_count:
+            self._autoflush()
+        else:
+            self.tick()
+
+    def delete(self, jid):
+        self._add(jid, protohandler.process_delete)
+
+    def release(self, jid, pri=1, delay=0):
+        self._add(jid, protohandler.process_release, pri, delay)
+
+    def bury(self, jid, pri=1):
+        self._add(jid, protohandler.process_bury, pri)
+
+    def touch(self, jid):
+        self._add(jid, protohandler.process_touch)
+
+    def tick(self):
+        """Flushes if the oldest acknowledgement has waited max_delay."""
+        if self.oldest is not None and \
+                time.time() - self.oldest >= self.max_delay:
+            self._autoflush()
+
+    def _autoflush(self):
+        results = self.flush()
+        if self.on_flush:
+            self.on_flush(results)
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        self.oldest = None
+        if not pending:
+            return []
+        return _outcomes([jid for jid, command in pending],
+                         self.conn._interact_many(
+                             [command for jid, command in pending]))
+
+
+class PrefetchQueue(object):
+    """PrefetchQueue keeps up to max_jobs jobs reserved ahead on a
+    connection, so that most reserves are answered from a local buffer
+    rather than by a round trip to the server. With max_bytes, it stops
+    reserving ahead once about that many bytes of job data are buffered
+    (the job sizes are only known once they are reserved, so the batch size
+    is worked out from the average so far, and the first batch is a single
+    job).
+
+    When the buffer runs out it is refilled with reserve_batch, and the
+    priorities, TTRs and time left of the new jobs are looked up with one
+    pipelined round of stats-job. The buffer hands jobs out in priority
+    order (oldest first within a priority). A job that has less than
+    min_time_left seconds of its TTR left by the time it would be handed
+    out is released rather than started late; expired counts those.
+
+    Jobs reserved ahead are held, and not run by other consumers, until
+    they are handed out, so max_jobs should be about the number of jobs
+    done in a small fraction of their TTR. close() releases the jobs still
+    buffered, with the priority they had, and is called when the queue is
+    used as a context manager:
+
+        with PrefetchQueue(conn, max_jobs=50) as queue:
+            while working:
+                job = queue.reserve()
+                ...
+    """
+    def __init__(self, conn, max_jobs=10, max_bytes=None, min_time_left=1,
+                 window=PIPELINE_WINDOW):
+        self.conn = conn
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.min_time_left = min_time_left
+        self.window = window
+        self.buffer = []        # heap of (pri, seq, deadline, size, job)
+        self.bytes = 0
+        self.expired = 0
+        self._seq = 0
+        self._seen = [0, 0]     # jobs, bytes reserved so far
+
+    def __repr__(self):
+        return "<%s(%r) %s jobs>" % (self.__class__.__name__, self.conn,
+                                     len(self.buffer))
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, value, traceback):
+        self.close()
+        return False
+
+    def _batch_size(self):
+        n = self.max_jobs
+        if self.max_bytes:
+            if not self._seen[0]:
+                # nothing to go by yet
+                return 1
+            average = max(1, self._seen[1] // self._seen[0])
+            n = min(n, (self.max_bytes - self.bytes) // average)
+        return max(1, n)
+
+    def _refill(self, timeout):
+        jobs = self.conn.reserve_batch(self._batch_size(), timeout,
+                                       self.window)
+        if not jobs:
+            return
+        p = self.conn.pipeline()
+        for job in jobs:
+            p.stats_job(job['jid'])
+        results = p.execute(raise_errors=False)
+        now = time.time()
+        for job, stats in izip(jobs, results):
+            if isinstance(stats, Exception):
+                # gone already, its ttr must have been tiny
+                if hasattr(job, '_handled'):
+                    job._handled = True
+                self.expired += 1
+                continue
+            stats = stats['data']
+            if hasattr(job, 'pri'):
+                job.pri = stats['pri']
+                job.ttr = stats['ttr']
+            size = len(job['data'])
+            self._seq += 1
+            heapq.heappush(self.buffer, (stats['pri'], self._seq,
+                                         now + stats['time-left'], size, job))
+            self.bytes += size
+            self._seen[0] += 1
+            self._seen[1] += size
+
+    def _pop(self):
+        pri, seq, deadline, size, job = heapq.heappop(self.buffer)
+        self.bytes -= size
+        return pri, deadline, job
+
+    def _release(self, entries):
+        """Releases the (pri, job) entries with the priority each had. The
+        ones whose TTR is up already are NOT_FOUND, which is ignored."""
+        p = self.conn.pipeline()
+        for pri, job in entries:
+            p.release(job['jid'], pri, 0)
+        p.execute(raise_errors=False)
+        for pri, job in entries:
+            if hasattr(job, '_handled'):
+                job._handled = True
+
+    def reserve(self, timeout=None):
+        """Returns the next job, reserving more if the buffer is empty: the
+        first of them waits up to timeout seconds for a job, forever if
+        timeout is None. Returns None if none came in time."""
+        stale = []
+        try:
+            while True:
+                if not self.buffer:
+                    # released first, the server would answer DEADLINE_SOON
+                    # while they are held
+                    if stale:
+                        self._release(stale)
+                        stale = []
+                    self._refill(timeout)
+                    if not self.buffer:
+                        return None
+                pri, deadline, job = self._pop()
+                left = deadline - time.time()
+                if left >= self.min_time_left:
+                    return job
+                self.expired += 1
+                stale.append((pri, job))
+        finally:
+            if stale:
+                self._release(stale)
+
+    def close(self):
+        """Releases the jobs still buffered. Returns how many there were."""
+        entries = []
+        while self.buffer:
+            pri, deadline, job = self._pop()
+            entries.append((pri, job))
+        if entries:
+            self._release(entries)
+        return len(entries)
 
 
 class ThreadedConnPool(object):
     '''
-    ThreadedConnPool: A simple pool class for connection objects).
-    This object will create a pool of size nconns. It does no thread wrangling,
-    and no form of connection management, other than to get a unique connection
-    to the thread that calls get.  In fact this could probably be simplified
-    even more by subclassing Semaphore.
+    ThreadedConnPool: A thread safe pool of connections to one server.
+
+    Connections are made as they are needed, up to nconns of them (minconns
+    are made up front). get() checks a connection out for the calling thread,
+    waiting for one to be released if all nconns are in use, and release()
+    returns it. connection() does both, as a context manager:
+
+        pool = ThreadedConnPool(10, 'localhost', 11300)
+        with pool.connection() as conn:
+            conn.put('foo')
+
+    A connection is checked on its way out of the pool: if it was closed, or
+    the server sent something nobody asked for (e.g. it hung up), it is
+    replaced with a new one. Connections left unused for idle_timeout seconds
+    are closed, down to minconns of them.
+
+    With affinity, a thread is given back the connection it used last when
+    that one is free, so it keeps a warm connection along with the tube and
+    watchlist it set up on it. The connections are plain ServerConns (or
+    conntype), and job and any other keywords are passed on to them.
     '''
 
-    import threading
+    conntype = ServerConn
+
+    def __init__(self, nconns, server, port, job = False, minconns = 0,
+                 idle_timeout = None, affinity = False, **kw):
+        if not 0 <= minconns <= nconns:
+            raise ValueError('minconns must be between 0 and nconns')
+        self.nconns = nconns
+        self.minconns = minconns
+        self.idle_timeout = idle_timeout
+        self.affinity = affinity
+        self.server = server
+        self.port = port
+        self.job = job
+        self.connkw = kw
+
+        self.__cond = threading.Condition(threading.Lock())
+        self.__idle = []    # (conn, time it was released), oldest first
+        self.__size = 0     # connections made, in use or not
+        self.__closed = False
+        self.__local = threading.local()
 
-    def __init__(self, nconns, server, port, job = False):
-        self.__conns = list()
-        self.__lock = self.threading.Lock()
-        # threaded isn't defined here
-        if threaded: conntype = ThreadedConn
-        else: conntype = ServerConn
-        for a in range(nconns):
-            self.conns.append(conntype(server, port, job=job, pool=self))
+        for a in range(minconns):
+            self.__idle.append((self._make_conn(), time.time()))
+            self.__size += 1
 
-        self.useme = self.threading.Semaphore(nconns)
+    def __repr__(self):
+        s = "<%(class)s(%(ip)s:%(port)s) %(idle)s/%(size)s idle>"
+        return s % {"class" : self.__class__.__name__, "ip" : self.server,
+                    "port" : self.port, "idle" : len(self.__idle),
+                    "size" : self.__size}
+
+    def _make_conn(self):
+        return self.conntype(self.server, self.port, job=self.job,
+                             **self.connkw)
+
+    def _healthy(self, conn):
+        """A connection is healthy if it is open and idle: nothing is waiting
+        to be read from it, and no replies are half read."""
+        if conn._socket is None or len(conn._reader):
+            return False
+        try:
+            if conn.poller is not None:
+                readable = conn.poller.poll(0)
+            else:
+                readable = select.select([conn._socket], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            # select can't take file descriptors from FD_SETSIZE (1024) on
+            return False
+        return not readable
+
+    def __reap(self):
+        # called with the lock held
+        if self.idle_timeout is None:
+            return
+        cutoff = time.time() - self.idle_timeout
+        while self.__idle and self.__size > self.minconns and \
+                self.__idle[0][1] < cutoff:
+            conn, released = self.__idle.pop(0)
+            self.__size -= 1
+            conn.close()
 
-    def get(self):
-        self.useme.aquire()
-        self.lock.acquire()
-        ret = self.conns.pop(0)
-        self.lock.release()
+    def __take(self):
+        # called with the lock held
+        mine = getattr(self.__local, 'conn', None)
+        if self.affinity and mine is not None:
+            for i, (conn, released) in enumerate(self.__idle):
+                if conn is mine:
+                    return self.__idle.pop(i)[0]
+        if self.__idle:
+            # the most recently used, it is the least likely to have gone stale
+            return self.__idle.pop()[0]
+        return None
+
+    def get(self, timeout = None):
+        """Checks out a connection. If all nconns are in use, waits up to
+        timeout seconds (forever if it is None) for one to be released, then
+        raises ConnectionError."""
+        deadline = None if timeout is None else time.time() + timeout
+        self.__cond.acquire()
+        try:
+            while True:
+                if self.__closed:
+                    raise ConnectionError('%r is closed' % (self,))
+                self.__reap()
+                conn = self.__take()
+                if conn is not None:
+                    break
+                if self.__size < self.nconns:
+                    # reserve a slot, the connection is made without the lock
+                    self.__size += 1
+                    break
+                if deadline is None:
+                    self.__cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ConnectionError('No connection free in %r' %
+                                              (self,))
+                    self.__cond.wait(remaining)
+        finally:
+            self.__cond.release()
+
+        try:
+            if conn is not None and not self._healthy(conn):
+                logger.info("Replacing unhealthy connection %r", conn)
+                if conn._socket is not None:
+                    conn.close()
+                conn = None
+            if conn is None:
+                conn = self._make_conn()
+        except:
+            self.__discard()
+            raise
+
+        self.__local.conn = conn
+        return conn
 
     def release(self, conn):
-        self.lock.acquire()
-        self.conns.append(conn)
-        self.lock.release()
-        self.useme.release()
+        """Returns a connection to the pool. A connection that was closed
+        is dropped from the pool instead."""
+        if conn._socket is None:
+            self.__discard()
+            return
+        self.__cond.acquire()
+        try:
+            if self.__closed:
+                self.__size -= 1
+                conn.close()
+            else:
+                self.__idle.append((conn, time.time()))
+            self.__cond.notify()
+        finally:
+            self.__cond.release()
+
+    def __discard(self):
+        self.__cond.acquire()
+        try:
+            self.__size -= 1
+            self.__cond.notify()
+        finally:
+            self.__cond.release()
+
+    @contextmanager
+    def connection(self, timeout = None):
+        """Checks out a connection for the duration of a with block."""
+        conn = self.get(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Closes the idle connections, and any in use as they are
+        released. The pool can't be used after this."""
+        self.__cond.acquire()
+        try:
+            self.__closed = True
+            idle, self.__idle = self.__idle, []
+            self.__size -= len(idle)
+            self.__cond.notify_all()
+        finally:
+            self.__cond.release()
+        for conn, released in idle:
+            conn.close()
 
 
 try:
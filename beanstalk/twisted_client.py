@@ -2,6 +2,7 @@ from twisted.protocols import basic
 from twisted.internet import reactor, defer, protocol, error
 from twisted.python import log
 import protohandler
+import keepalive
 from waiting_deferred import WaitingDeferred
 
 # Stolen from memcached protocol
@@ -333,3 +334,135 @@ for command in protocol_commands:
         return caller
 
     setattr(BeanstalkClient, command, wrapper(command))
+
+
+class TwistedKeepalive(object):
+    """
+    Touches the jobs reserved on a connection from the reactor, as
+    L{keepalive.Keepalive} does for a ServerConn, so that jobs that take
+    longer than their TTR are not handed to another consumer.
+
+    The connection is a L{Beanstalk} protocol, or a L{BeanstalkClient}, whose
+    current protocol is used. The commands sent through the protocol are
+    watched to know which jobs are reserved, and every C{max_wait} seconds
+    at most the touches that are due are sent together. The jobs tracked
+    are forgotten when the client reconnects, as the server releases them.
+
+    @ivar schedule: the jobs tracked and when they are due for a touch
+    @type schedule: L{keepalive.KeepaliveSchedule}
+    @ivar touches: the number of touches sent
+    """
+
+    def __init__(self, conn, fraction=.5, default_ttr=None, max_wait=1.0,
+                 clock=reactor):
+        self.conn = conn
+        self.schedule = keepalive.KeepaliveSchedule(fraction, default_ttr,
+                                                   clock.seconds)
+        self.max_wait = max_wait
+        self.clock = clock
+        self.touches = 0
+        self._protocol = None
+        self._looking_up = set()
+        self._call = None
+
+    def _current_protocol(self):
+        if isinstance(self.conn, BeanstalkClient):
+            return self.conn.protocol
+        return self.conn
+
+    def _attach(self, proto):
+        """
+        Puts a wrapper around the commands of C{proto}, taking it off the
+        previous protocol.
+        """
+        if self._protocol is not None:
+            self._protocol.__dict__.pop('_cmd', None)
+        self.schedule.jobs.clear()
+        self._looking_up.clear()
+        self._protocol = proto
+        if proto is None:
+            return
+
+        cmd = proto._cmd
+        observe = self.schedule.observe
+
+        def _cmd(command, full_command, handler):
+            def observed(res):
+                observe(full_command, res)
+                return res
+
+            def failed(fail):
+                observe(full_command, fail.value)
+                return fail
+
+            return cmd(command, full_command, handler).addCallbacks(observed, failed)
+
+        proto._cmd = _cmd
+
+    def tick(self):
+        """
+        Looks up the unknown TTRs and sends the touches that are due.
+
+        @return: a L{Deferred} fired when the replies are in
+        """
+        proto = self._current_protocol()
+        if proto is not self._protocol:
+            self._attach(proto)
+        if proto is None:
+            return defer.succeed(None)
+
+        schedule = self.schedule
+        ds = []
+
+        def known(res, jid):
+            self._looking_up.discard(jid)
+            schedule.known(jid, res['data']['ttr'], res['data']['time-left'])
+
+        def gone(fail, jid):
+            self._looking_up.discard(jid)
+            schedule.discard(jid)
+
+        for jid in schedule.unknown():
+            if jid not in self._looking_up:
+                self._looking_up.add(jid)
+                ds.append(proto.stats_job(jid).addCallbacks(
+                    known, gone, callbackArgs=(jid,), errbackArgs=(jid,)))
+
+        now = self.clock.seconds()
+        for jid in schedule.due(now):
+            # counted as touched now, so it isn't sent again before the reply
+            schedule.touched(jid, now)
+            self.touches += 1
+            ds.append(proto.touch(jid).addErrback(gone, jid))
+
+        return defer.DeferredList(ds)
+
+    def _wait(self):
+        next_due = self.schedule.next_due()
+        if next_due is None:
+            return self.max_wait
+        return max(0, min(self.max_wait, next_due - self.clock.seconds()))
+
+    def _run(self):
+        self._call = None
+        self.tick()
+        self._call = self.clock.callLater(self._wait(), self._run)
+
+    def start(self):
+        """
+        Starts touching the jobs reserved from now on.
+
+        @return: C{self}
+        """
+        self._attach(self._current_protocol())
+        self._call = self.clock.callLater(0, self._run)
+        return self
+
+    def stop(self):
+        """
+        Stops touching jobs, and takes the wrapper off the protocol.
+        """
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self._attach(None)
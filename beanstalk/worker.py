@@ -0,0 +1,602 @@
+"""
+Worker runtime: the simple mainloop layer.
+
+ThreadedWorker reserves jobs and calls their run method in a pool of
+threads. When run returns the job is deleted; when it raises the job is
+released with a delay, to be retried, until it has failed max_failures
+times, when it is buried instead.
+
+The failures are counted by the worker (in a FailureCounts), not taken from
+the releases in stats-job: those also count the jobs released unstarted at
+shutdown, or by a prefetch queue. The count is shared by the threads of a
+ThreadedWorker and by all the processes of a PreforkWorker, and is bounded:
+a job's count starts over when its slot is taken by another job, when it
+has not failed for an hour, or when it fails on another worker altogether.
+
+In the simplest case a Job subclass with a run method is all that is needed:
+
+    class Resize(job.Job):
+        def run(self):
+            ...
+
+    beanstalk.main('localhost', 11300, job=Resize, nthreads=8)
+
+For CPU bound jobs, where the GIL would keep the threads on one core,
+PreforkWorker runs ThreadedWorkers in forked child processes:
+
+    beanstalk.main('localhost', 11300, job=Resize, processes=32, cpus=True)
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+import errors
+import keepalive as _keepalive
+import serverconn
+from job import Job
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# how long a worker with a reserve_timeout of 0 waits before asking again
+# when there was no job
+IDLE_WAIT = 0.05
+
+
+class FailureCounts(object):
+    """Counts the failures of jobs, by jid, in a table of size slots in
+    shared memory, so that the processes forked after it is made (the
+    children of a PreforkWorker) all see the same counts.
+
+    A jid goes in slot jid % size, so the table never grows: a job that lands
+    in a slot taken by another one replaces it, and the one replaced starts
+    over if it fails again. So does a job whose last failure was ttl seconds
+    ago or more. Jobs reserved at about the same time have jids close
+    together, and don't take each other's slots.
+    """
+    def __init__(self, size = 4096, ttl = 3600, clock = time.time):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self._jids = multiprocessing.Array('l', size, lock=False)
+        self._counts = multiprocessing.Array('l', size, lock=False)
+        self._times = multiprocessing.Array('d', size, lock=False)
+        self._lock = multiprocessing.Lock()
+
+    def __getitem__(self, jid):
+        slot = jid % self.size
+        self._lock.acquire()
+        try:
+            if self._jids[slot] != jid or \
+                    self.clock() - self._times[slot] >= self.ttl:
+                return 0
+            return self._counts[slot]
+        finally:
+            self._lock.release()
+
+    def add(self, jid):
+        """Counts a failure of jid. Returns how many times it has failed."""
+        slot = jid % self.size
+        now = self.clock()
+        self._lock.acquire()
+        try:
+            if self._jids[slot] != jid or now - self._times[slot] >= self.ttl:
+                self._jids[slot] = jid
+                self._counts[slot] = 0
+            self._counts[slot] += 1
+            self._times[slot] = now
+            return self._counts[slot]
+        finally:
+            self._lock.release()
+
+    def discard(self, jid):
+        slot = jid % self.size
+        self._lock.acquire()
+        try:
+            if self._jids[slot] == jid:
+                self._jids[slot] = 0
+        finally:
+            self._lock.release()
+
+
+# a cpu_set_t: 1024 bits, in unsigned longs
+CPU_SETSIZE = 1024
+_MASK_BITS = 8 * ctypes.sizeof(ctypes.c_ulong)
+_CPUMask = ctypes.c_ulong * (CPU_SETSIZE // _MASK_BITS)
+
+def _libc():
+    """Returns libc, for the sched_*affinity calls the os module only has
+    from Python 3.3 on. Raises OSError off Linux."""
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.ENOSYS, "sched_setaffinity is Linux only")
+    return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+
+def _check(ret):
+    if ret:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+def getaffinity():
+    """Returns the sorted list of the CPUs the calling process may run on,
+    which inside a cpuset or a container may be fewer than cpu_count().
+    Raises OSError if it can't tell."""
+    mask = _CPUMask()
+    _check(_libc().sched_getaffinity(0, ctypes.sizeof(mask),
+                                     ctypes.byref(mask)))
+    return [cpu for cpu in xrange(CPU_SETSIZE)
+            if mask[cpu // _MASK_BITS] >> (cpu % _MASK_BITS) & 1]
+
+def setaffinity(cpu):
+    """Pins the calling process to cpu, with sched_setaffinity. Raises
+    OSError if it can't."""
+    libc = _libc()
+    if not 0 <= cpu < CPU_SETSIZE:
+        raise OSError(errno.EINVAL, "No CPU %s" % cpu)
+    mask = _CPUMask()
+    mask[cpu // _MASK_BITS] = 1 << (cpu % _MASK_BITS)
+    _check(libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)))
+
+
+class ThreadedWorker(object):
+    """Runs jobs from one server in nthreads threads.
+
+    Each thread has its own connection (conntype, a ServerConn by default,
+    watching watchlist), as a job can only be deleted, released or buried on
+    the connection that reserved it. A thread reserves up to prefetch jobs at
+    once, and runs them one after the other. At most max_inflight jobs
+    (nthreads * prefetch by default) are reserved by the worker at any time;
+    threads wait for a slot before reserving more, which keeps a slow worker
+    from holding on to jobs other consumers could be running.
+
+    job is the class reserved jobs are made into, it has to implement run. A
+    job that raises is released with a delay of retry_delay seconds, doubled
+    for each time it failed before. Once it has failed max_failures times it
+    is buried. The failures are counted in failures, a FailureCounts (see
+    the module docs), a new one by default.
+
+    start() starts the threads and stop() shuts them down: jobs already
+    running are finished, jobs reserved but not started are released, and the
+    connections are closed. Threads wait for jobs up to reserve_timeout
+    seconds at a time, so stop() can take that long; with 0 they ask again
+    every IDLE_WAIT seconds while there is none.
+
+    With keepalive set, each connection gets a keepalive.Keepalive, which
+    touches the jobs it holds (running or prefetched) before their TTR runs
+    out, so that long jobs aren't handed to another consumer half way.
+
+    counts has the number of jobs done (deleted), released and buried.
+    """
+
+    conntype = serverconn.ServerConn
+
+    def __init__(self, server, port, job = Job, nthreads = 4, watchlist = None,
+                 prefetch = 1, max_inflight = None, retry_delay = 10,
+                 max_failures = 3, reserve_timeout = 1, keepalive = False,
+                 failures = None):
+        self.server = server
+        self.port = port
+        self.job = job
+        self.nthreads = nthreads
+        self.watchlist = list(watchlist or ['default'])
+        self.prefetch = prefetch
+        self.max_inflight = max_inflight or nthreads * prefetch
+        self.retry_delay = retry_delay
+        self.max_failures = max_failures
+        if reserve_timeout is None or reserve_timeout < 0:
+            # a reserve that never times out would keep stop() waiting
+            raise ValueError("reserve_timeout must be 0 or more seconds, "
+                             "not %r" % (reserve_timeout,))
+        self.reserve_timeout = reserve_timeout
+        self.keepalive = keepalive
+        self.failures = failures or FailureCounts()
+
+        self.counts = {'done' : 0, 'released' : 0, 'buried' : 0}
+        self.threads = []
+
+        self._stopping = threading.Event()
+        self._cond = threading.Condition(threading.Lock())
+        self._inflight = 0
+
+    def __repr__(self):
+        s = "<%(class)s(%(ip)s:%(port)s) %(threads)s threads %(counts)s>"
+        return s % {"class" : self.__class__.__name__, "ip" : self.server,
+                    "port" : self.port, "threads" : len(self.threads),
+                    "counts" : self.counts}
+
+    def _connect(self):
+        conn = self.conntype(self.server, self.port, job=self.job)
+        conn.watchlist = list(self.watchlist)
+        if self.keepalive:
+            _keepalive.Keepalive(conn).start()
+        return conn
+
+    def _count(self, what):
+        self._cond.acquire()
+        try:
+            self.counts[what] += 1
+        finally:
+            self._cond.release()
+
+    def _take(self, n):
+        """Waits for a free in-flight slot, and takes up to n of them. Returns
+        how many were taken, 0 if the worker is stopping."""
+        self._cond.acquire()
+        try:
+            while self._inflight >= self.max_inflight:
+                if self._stopping.isSet():
+                    return 0
+                self._cond.wait(.5)
+            if self._stopping.isSet():
+                return 0
+            n = min(n, self.max_inflight - self._inflight)
+            self._inflight += n
+            return n
+        finally:
+            self._cond.release()
+
+    def _give(self, n):
+        self._cond.acquire()
+        try:
+            self._inflight -= n
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _run_job(self, conn, job):
+        try:
+            job.run()
+        except Exception:
+            logger.exception("Job %s failed", job.jid)
+            self._failed(conn, job)
+        else:
+            self.failures.discard(job.jid)
+            job.Finish()
+            self._count('done')
+
+    def _failed(self, conn, job):
+        failures = self.failures.add(job.jid)
+        try:
+            stats = conn.stats_job(job.jid)['data']
+        except errors.NotFound:
+            # its ttr ran out, and someone else has it (or finished it)
+            self.failures.discard(job.jid)
+            job._handled = True
+            return
+        job.pri = stats['pri']
+        if failures >= self.max_failures:
+            self.failures.discard(job.jid)
+            job.Bury(stats['pri'])
+            self._count('buried')
+        else:
+            job.Delay(self.retry_delay * 2 ** (failures - 1))
+            self._count('released')
+
+    def _release_unstarted(self, conn, jobs):
+        # keep the priorities they had, reserve replies don't include them;
+        # jobs that are gone already (e.g. their ttr ran out) are skipped
+        try:
+            p = conn.pipeline()
+            for job in jobs:
+                p.stats_job(job.jid)
+            allstats = p.execute(raise_errors=False)
+            p = conn.pipeline()
+            for job, stats in zip(jobs, allstats):
+                if not isinstance(stats, Exception):
+                    p.release(job.jid, stats['data']['pri'], 0)
+            p.execute(raise_errors=False)
+        finally:
+            for job in jobs:
+                job._handled = True
+
+    def _work(self):
+        conn = None
+        while not self._stopping.isSet():
+            n = self._take(self.prefetch)
+            if not n:
+                continue
+            jobs = []
+            try:
+                if conn is None:
+                    conn = self._connect()
+                jobs = conn.reserve_batch(n, timeout=self.reserve_timeout)
+                if not jobs and not self.reserve_timeout:
+                    self._stopping.wait(IDLE_WAIT)
+            except errors.DeadlineSoon:
+                pass
+            except (errors.BeanStalkError, socket.error), e:
+                logger.warning("Lost connection to %s:%s (%s), reconnecting",
+                               self.server, self.port, e)
+                if conn is not None and conn._socket is not None:
+                    conn.close()
+                conn = None
+                self._stopping.wait(1)
+            self._give(n - len(jobs))
+
+            while jobs:
+                if self._stopping.isSet():
+                    try:
+                        self._release_unstarted(conn, jobs)
+                    except (errors.BeanStalkError, socket.error), e:
+                        logger.warning("Could not release unstarted jobs "
+                                       "(%s), the server will", e)
+                    self._give(len(jobs))
+                    break
+                job = jobs.pop(0)
+                try:
+                    self._run_job(conn, job)
+                except (errors.BeanStalkError, socket.error), e:
+                    # the server releases the rest of them when it sees
+                    # the connection go
+                    logger.warning("Lost connection to %s:%s (%s)",
+                                   self.server, self.port, e)
+                    if conn._socket is not None:
+                        conn.close()
+                    conn = None
+                    self._give(len(jobs))
+                    for job in jobs:
+                        job._handled = True
+                    jobs = []
+                finally:
+                    self._give(1)
+                    del job
+
+        if conn is not None:
+            conn.close()
+
+    def start(self):
+        self._stopping.clear()
+        for i in xrange(self.nthreads):
+            thread = threading.Thread(target=self._work, name='%s-%s' %
+                                      (self.__class__.__name__, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self, timeout = None):
+        """Shuts the threads down, waiting up to timeout seconds (forever by
+        default) for the jobs that are running to finish."""
+        self._stopping.set()
+        self._cond.acquire()
+        try:
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None
+                        else max(0, deadline - time.time()))
+        self.threads = [t for t in self.threads if t.isAlive()]
+
+    def wait(self):
+        """Blocks until the worker is stopped, e.g. from another thread or
+        with ctrl-c (which stops it)."""
+        try:
+            # joining with a timeout lets KeyboardInterrupt through
+            while any(t.isAlive() for t in self.threads):
+                for thread in self.threads:
+                    thread.join(1)
+        except KeyboardInterrupt:
+            self.stop()
+
+
+class PreforkWorker(object):
+    """Runs jobs from one server in processes forked child processes.
+
+    Each child runs a ThreadedWorker with nthreads threads (one by default,
+    the children are there to spread CPU bound jobs over the cores); kw are
+    passed on to it. The parent only supervises: a child that dies is
+    started again, after restart_delay seconds if it lived less than that,
+    until the worker is stopped.
+
+    cpus pins the children to CPUs: True spreads them over the CPUs this
+    process may run on (see getaffinity), child i on the i-th of them modulo
+    their number; a list of CPU numbers puts child i on cpus[i % len(cpus)].
+    This works on Linux only (see setaffinity); elsewhere, or if the CPU
+    doesn't exist, the children run unpinned.
+
+    The children share one FailureCounts, so a job that keeps failing is
+    buried after max_failures runs, whichever children ran it.
+
+    counts adds up the children's counts, child_counts() has them per child.
+    They are kept in shared memory, which each child updates every
+    publish_interval seconds and when it exits; the counts of a child that
+    was restarted carry over to its replacement.
+    """
+
+    workertype = ThreadedWorker
+    fields = ('done', 'released', 'buried')
+
+    def __init__(self, server, port, job = Job, processes = None,
+                 nthreads = 1, cpus = None, restart_delay = 1,
+                 publish_interval = .5, **kw):
+        self.server = server
+        self.port = port
+        self.job = job
+        self.processes = processes or multiprocessing.cpu_count()
+        self.nthreads = nthreads
+        self.cpus = cpus
+        self._allowed = None
+        self.restart_delay = restart_delay
+        self.publish_interval = publish_interval
+        self.kw = kw
+
+        self.children = {}
+        self.restarts = 0
+        self._started = {}
+        self._stopping = False
+        self._counts = multiprocessing.Array('l',
+                           self.processes * len(self.fields), lock=False)
+        self.failures = kw.pop('failures', None) or FailureCounts()
+
+    def __repr__(self):
+        s = "<%(class)s(%(ip)s:%(port)s) %(procs)s processes %(counts)s>"
+        return s % {"class" : self.__class__.__name__, "ip" : self.server,
+                    "port" : self.port, "procs" : len(self.children),
+                    "counts" : self.counts}
+
+    def child_counts(self):
+        n = len(self.fields)
+        return [dict(zip(self.fields, self._counts[i * n:(i + 1) * n]))
+                for i in xrange(self.processes)]
+
+    @property
+    def counts(self):
+        total = dict.fromkeys(self.fields, 0)
+        for counts in self.child_counts():
+            for field, value in counts.iteritems():
+                total[field] += value
+        return total
+
+    def _cpu_for(self, slot):
+        if self.cpus is None or self.cpus is False:
+            return None
+        cpus = self.cpus
+        if cpus is True:
+            if self._allowed is None:
+                try:
+                    self._allowed = getaffinity()
+                except OSError:
+                    self._allowed = range(multiprocessing.cpu_count())
+            cpus = self._allowed
+        return cpus[slot % len(cpus)]
+
+    def _spawn(self, slot):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = slot
+            self._started[slot] = time.time()
+            return pid
+        status = 1
+        try:
+            try:
+                self._child(slot)
+                status = 0
+            except:
+                logger.exception("Worker process %s failed", slot)
+        finally:
+            # never fall back into the parent's code
+            os._exit(status)
+
+    def _child(self, slot):
+        # the parent tells the children to stop, ctrl-c goes to all of them
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        cpu = self._cpu_for(slot)
+        if cpu is not None:
+            try:
+                setaffinity(cpu)
+            except OSError, e:
+                logger.warning("Cannot pin worker process %s to CPU %s: %s",
+                               slot, cpu, e)
+
+        worker = self.workertype(self.server, self.port, self.job,
+                                 nthreads=self.nthreads,
+                                 failures=self.failures, **self.kw)
+        signal.signal(signal.SIGTERM, lambda signum, frame:
+                      worker._stopping.set())
+
+        n = len(self.fields)
+        base = self._counts[slot * n:(slot + 1) * n]
+        def publish():
+            for i, field in enumerate(self.fields):
+                self._counts[slot * n + i] = base[i] + worker.counts[field]
+
+        worker.start()
+        try:
+            while any(t.isAlive() for t in worker.threads):
+                for thread in worker.threads:
+                    thread.join(self.publish_interval)
+                publish()
+        finally:
+            publish()
+
+    def _reap(self, block):
+        """Collects the children that exited, and starts them again unless
+        the worker is stopping. Returns how many were collected."""
+        reaped = 0
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0 if block and not reaped
+                                         else os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not pid:
+                break
+            slot = self.children.pop(pid, None)
+            if slot is None:
+                continue
+            reaped += 1
+            if self._stopping:
+                continue
+            logger.warning("Worker process %s (pid %s) exited with status "
+                           "%s, restarting it", slot, pid, status)
+            lived = time.time() - self._started[slot]
+            if lived < self.restart_delay:
+                time.sleep(self.restart_delay - lived)
+            self.restarts += 1
+            self._spawn(slot)
+        return reaped
+
+    def poll(self):
+        """Restarts the children that died, without blocking."""
+        return self._reap(False)
+
+    def start(self):
+        self._stopping = False
+        for slot in xrange(self.processes):
+            self._spawn(slot)
+        return self
+
+    def stop(self, timeout = None):
+        """Tells the children to stop, and waits up to timeout seconds
+        (forever by default) for them to finish their running jobs. Those
+        still running after that are killed."""
+        self._stopping = True
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        deadline = None if timeout is None else time.time() + timeout
+        while self.children:
+            if deadline is not None and time.time() >= deadline:
+                for pid in self.children.keys():
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                deadline = None
+            if not self._reap(False):
+                time.sleep(.05)
+
+    def wait(self):
+        """Supervises the children until the worker is stopped or
+        interrupted with ctrl-c (which stops it)."""
+        try:
+            while self.children and not self._stopping:
+                self._reap(True)
+        except KeyboardInterrupt:
+            self.stop()
+
+
+def main(server = 'localhost', port = 11300, job = Job, processes = None,
+         **kw):
+    """Runs a ThreadedWorker (kw are passed on to it) until interrupted. With
+    processes, runs a PreforkWorker with that many child processes instead."""
+    if processes:
+        worker = PreforkWorker(server, port, job, processes, **kw)
+    else:
+        worker = ThreadedWorker(server, port, job, **kw)
+    worker.start().wait()
@@ -0,0 +1,98 @@
+"""
+AsyncioConn tests.
+
+These run the futures returned by the connection to completion on an event
+loop, so they work with asyncio as well as with trollius on Python 2.
+"""
+
+import sys
+sys.path.append('tests')
+
+from nose.tools import assert_raises
+
+from beanstalk import asyncio_client
+from beanstalk.asyncio_client import asyncio
+from beanstalk import errors
+from beanstalk import job
+from spawner import spawner
+from config import get_config
+
+config = get_config("ServerConn")
+
+loop = None
+conn = None
+
+def run(future):
+    return loop.run_until_complete(future)
+
+def setup():
+    global loop, conn
+    spawner.spawn(host=config.BEANSTALKD_HOST, port=config.BEANSTALKD_PORT,
+                  path=config.BEANSTALKD)
+    loop = asyncio.new_event_loop()
+    conn = run(asyncio_client.connect(config.BEANSTALKD_HOST,
+                                      int(config.BEANSTALKD_PORT), loop=loop))
+
+def teardown():
+    conn.close()
+    loop.close()
+    spawner.terminate_all()
+
+def test_put_reserve_delete():
+    jid = run(conn.put('abc\r\nabc'))['jid']
+    res = run(conn.reserve())
+    assert res['jid'] == jid
+    assert res['data'] == 'abc\r\nabc'
+    assert run(conn.delete(jid))['state'] == 'ok'
+    assert_raises(errors.NotFound, run, conn.delete(jid))
+
+def test_concurrent_commands_are_pipelined():
+    puts = [conn.put('job %s' % i) for i in range(50)]
+    assert len(conn._waiting) == 50
+    jids = [res['jid'] for res in run(asyncio.gather(*puts, loop=loop))]
+    assert jids == sorted(jids)
+
+    # an error in the middle doesn't disturb the replies around it
+    futures = [conn.reserve_with_timeout(0), conn.delete(0),
+               conn.reserve_with_timeout(0)]
+    results = run(asyncio.gather(*futures, loop=loop, return_exceptions=True))
+    assert [res['jid'] for res in results[::2]] == jids[:2]
+    assert isinstance(results[1], errors.NotFound)
+
+    futures = [conn.delete(jid) for jid in jids]
+    assert all(res['state'] == 'ok'
+               for res in run(asyncio.gather(*futures, loop=loop)))
+
+def test_job_objects():
+    jid = run(conn.put('job data'))['jid']
+    conn.job = asyncio_client.AsyncioJob
+    try:
+        res = run(conn.reserve())
+        assert isinstance(res, asyncio_client.AsyncioJob)
+        assert res.jid == jid and res.data == 'job data'
+        assert res.Server is conn
+
+        touched = res.Touch()
+        assert isinstance(touched, asyncio.Future)
+        assert run(touched) is True
+        assert not res._handled
+        assert run(res.Bury(5)) is True
+        assert res._handled and res.pri == 5
+        # a buried job can still be deleted, once
+        assert run(res.Finish()) is True
+        assert run(res.Finish()) is False
+        assert_raises(errors.NotFound, run, conn.stats_job(jid))
+    finally:
+        conn.job = False
+
+def test_unhandled_job_is_not_deleted_when_collected():
+    jid = run(conn.put('job data'))['jid']
+    conn.job = asyncio_client.AsyncioJob
+    try:
+        res = run(conn.reserve())
+    finally:
+        conn.job = False
+    del res
+    assert not conn._waiting
+    assert run(conn.stats_job(jid))['data']['state'] == 'reserved'
+    assert run(conn.delete(jid))['state'] == 'ok'
@@ -0,0 +1,56 @@
+"""
+Microbenchmark for the protohandler reply parsing path.
+
+Run it from the top of the tree:
+    python tests/bench_protohandler.py
+
+It times feeding typical replies to fresh Handlers, once with the eval()
+based error check pybeanstalk used to have, and once with the current
+errors.checkError.
+"""
+
+import sys
+import timeit
+
+sys.path.insert(0, '.')
+from beanstalk import protohandler
+from beanstalk import errors
+
+def legacy_checkError(linestr):
+    # errors.checkError as it was before the ERRORS table
+    try:
+        errname = ''.join([x.capitalize() for x in linestr.split('_')])
+        err = eval(errname, vars(errors))('Server returned: %s' % (linestr,))
+    except Exception, e:
+        return
+    raise err
+
+replies = [
+    ('process_put', ('abcde',), 'INSERTED 1234\r\n'),
+    ('process_delete', (1234,), 'DELETED\r\n'),
+    ('process_reserve', (), 'RESERVED 1234 5\r\nabcde\r\n'),
+    ('process_touch', (1234,), 'NOT_FOUND\r\n'),
+]
+
+def parse():
+    for name, args, reply in replies:
+        line, handler = getattr(protohandler, name)(*args)
+        try:
+            handler(reply)
+        except errors.NotFound:
+            pass
+
+def bench(number=20000, repeat=5):
+    best = min(timeit.repeat(parse, number=number, repeat=repeat))
+    return best / (number * len(replies)) * 1e6
+
+if __name__ == '__main__':
+    current = protohandler.checkError
+    protohandler.checkError = legacy_checkError
+    try:
+        before = bench()
+    finally:
+        protohandler.checkError = current
+    after = bench()
+    print 'eval checkError:  %.2f usec per reply' % (before,)
+    print 'table checkError: %.2f usec per reply' % (after,)
@@ -0,0 +1,52 @@
+"""
+Microbenchmark for the ServerPool routing strategies.
+
+Run it from the top of the tree:
+    python tests/bench_routing.py
+
+It times picking a server for a put with each router, and with the
+random.seed() and random.choice() the pool used to call for every put. It
+also shows how many keys move when an eleventh server is added.
+"""
+
+import random
+import sys
+import timeit
+
+sys.path.insert(0, '.')
+from beanstalk import routing
+
+class Server(object):
+    def __init__(self, i):
+        self.server = '10.0.0.%s' % (i,)
+        self.port = 11300
+
+servers = [Server(i) for i in xrange(10)]
+keys = ['tube-%s' % i for i in xrange(1000)]
+
+def legacy():
+    random.seed()
+    return random.choice(servers)
+
+def bench(func, number=100000, repeat=5):
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    return best / number * 1e6
+
+if __name__ == '__main__':
+    print 'reseed + choice:      %.2f usec per route' % (bench(legacy, 2000),)
+    for router in (routing.RandomRouter(), routing.RoundRobinRouter(),
+                   routing.HashRouter()):
+        router.update(servers)
+        key = iter(keys * 1000).next
+        print '%-21s %.2f usec per route' % (
+            router.__class__.__name__ + ':',
+            bench(lambda: router.route(key())))
+
+    router = routing.HashRouter()
+    router.update(servers)
+    before = [router.route(key) for key in keys]
+    router.update(servers + [Server(10)])
+    moved = sum(1 for key, server in zip(keys, before)
+                if router.route(key) is not server)
+    print 'keys moved adding an 11th server: %.1f%% (1/11 is 9.1%%)' % (
+        moved * 100.0 / len(keys),)
@@ -0,0 +1,38 @@
+"""
+Benchmark for the per-call overhead of ServerConn's protocol methods.
+
+Run it from the top of the tree:
+    python tests/bench_serverconn.py
+
+It times conn.put against a loopback stand-in server, and compares it with
+sending the same command through conn._do_interaction directly, which is
+the floor for a round trip through the connection.
+"""
+
+import sys
+import timeit
+
+sys.path.insert(0, '.')
+sys.path.insert(0, 'tests')
+from beanstalk import serverconn
+from beanstalk import protohandler
+from standin import StandIn
+
+def bench(func, number=20000, repeat=5):
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    return best / number * 1e6
+
+if __name__ == '__main__':
+    standin = StandIn().start()
+    try:
+        conn = serverconn.ServerConn(standin.host, standin.port)
+        direct = bench(lambda: conn._do_interaction(
+            *protohandler.process_put('abcde', 0, 0, 60)))
+        put = bench(lambda: conn.put('abcde', 0, 0, 60))
+        conn.close()
+    finally:
+        standin.stop()
+
+    print 'conn._do_interaction: %.2f usec per put' % (direct,)
+    print 'conn.put:             %.2f usec per put' % (put,)
+    print 'overhead:             %.2f usec per put' % (put - direct,)
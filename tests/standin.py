@@ -0,0 +1,73 @@
+import socket
+import threading
+import SocketServer
+
+STATS = '---\nmax-job-size: 65535\ncurrent-jobs-ready: 0\n'
+
+class StandIn(object):
+    """
+    Stand-in for beanstalkd, listening on the loopback interface, that sends
+    back a canned reply for every command it gets. It knows nothing about
+    jobs or tubes, it is meant for measuring the client side of things.
+
+    replies maps a command name to the reply line sent for it (without eol),
+    to None for a command that is never answered, or to CLOSE for one that
+    makes it close the connection. received has the command lines it got.
+    """
+
+    CLOSE = object()
+
+    default_replies = {
+        'put': 'INSERTED 1',
+        'delete': 'DELETED',
+        'release': 'RELEASED',
+        'bury': 'BURIED',
+        'touch': 'TOUCHED',
+        'use': 'USING default',
+        'watch': 'WATCHING 1',
+        'ignore': 'WATCHING 1',
+        'reserve-with-timeout': 'TIMED_OUT',
+        'stats': 'OK %s\r\n%s' % (len(STATS), STATS),
+    }
+
+    def __init__(self, replies=None, host='127.0.0.1', port=0):
+        self.replies = dict(self.default_replies)
+        self.replies.update(replies or {})
+        self.received = []
+        standin = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    standin.received.append(line.rstrip('\r\n'))
+                    cmd = line.split()
+                    if cmd[0] == 'put':
+                        # skip the job body
+                        self.rfile.read(int(cmd[-1]) + 2)
+                    reply = standin.replies.get(cmd[0], 'UNKNOWN_COMMAND')
+                    if reply is StandIn.CLOSE:
+                        return
+                    if reply is not None:
+                        self.wfile.write(reply + '\r\n')
+
+        class Server(SocketServer.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+            # connections are made without waiting for a reply, many at once
+            request_queue_size = 1024
+
+        self.server = Server((host, port), Handler)
+        self.host, self.port = self.server.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
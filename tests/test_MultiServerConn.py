@@ -15,6 +15,7 @@ import socket
 import time
 import random
 import subprocess
+import threading
 import itertools
 
 from nose.tools import with_setup, assert_raises
@@ -22,9 +23,13 @@ import nose
 
 from beanstalk import multiserverconn
 from beanstalk import errors
+from beanstalk import health
 from beanstalk import job
+from beanstalk import protohandler
+from beanstalk import routing
 
 from config import get_config
+from standin import StandIn
 
 
 # created during setup
@@ -332,6 +337,18 @@ def test_reserve_timeout_works():
         assert server['state'] == 'timeout'
     _clean_up()
 
+def test_reserve_without_jobs_leaves_servers_connected():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    start = time.time()
+    assert conn.reserve() == []
+    # the servers are asked to time out themselves, after the pool's timeout
+    assert time.time() - start < conn.timeout + 1
+    for server in conn.servers:
+        assert server._socket is not None
+    assert len(conn.multiplexer) == len(conn.servers)
+    _clean_up()
+
 def test_reserve_deadline_soon():
 
     # Put a short running job
@@ -351,3 +368,367 @@ def test_reserve_deadline_soon():
     assert x['state'] == 'ok', "Didn't delete the job right. This could break future tests"
     _clean_up()
 
+
+def test_put_many():
+    results = conn.put_many(['job %s' % i for i in range(50)] + [('a' * (2**16),)])
+    assert len(results) == 51
+    assert results[-1][0] is None
+    assert isinstance(results[-1][1], errors.JobTooBig)
+    assert [state for jid, state in results[:-1]] == ['ok'] * 50
+
+    ready = sum(server.stats()['data']['current-jobs-ready']
+                for server in conn.servers)
+    assert ready == 50
+    # jids are per server, and every server got some of them
+    for server in conn.servers:
+        server._interact_many([protohandler.process_delete(jid)
+                               for jid, state in results[:-1]])
+    ready = sum(server.stats()['data']['current-jobs-ready']
+                for server in conn.servers)
+    assert ready == 0
+    _clean_up()
+
+def test_put_many_reports_a_lost_server_per_item():
+    standins = [StandIn({'put': StandIn.CLOSE}).start(), StandIn().start()]
+    try:
+        pool = multiserverconn.ServerPool(
+            [(s.host, s.port, False) for s in standins],
+            router=routing.RoundRobinRouter())
+        lost, ok = pool.servers
+        results = pool.put_many(['job %s' % i for i in range(10)])
+        assert len(results) == 10
+        for i, (jid, state) in enumerate(results):
+            if i % 2:
+                assert (jid, state) == (1, 'ok')
+            else:
+                assert jid is None
+                assert isinstance(state, errors.NotConnected)
+        assert lost._socket is None
+        assert lost.health.failures == 1
+        assert ok.health.state == health.HEALTHY
+        pool.close()
+    finally:
+        for standin in standins:
+            standin.stop()
+
+def test_hash_routing_keeps_keys_together():
+    router, conn.router = conn.router, routing.HashRouter()
+    conn.router.update(conn.servers)
+    try:
+        jobs = [conn.put('job %s' % i, key='foo') for i in range(10)]
+        server = conn.route('foo')
+        assert [job_.Server for job_ in jobs] == [server] * 10
+
+        # put_many routes each item on its key
+        items = ['foo', 'foo', 'bar']
+        results = conn.put_many(items, key=lambda item: item)
+        assert [state for jid, state in results] == ['ok'] * 3
+        ready = server.stats()['data']['current-jobs-ready']
+        assert ready == (12 if conn.route('bar') is not server else 13)
+
+        # without a key, the used tube is the key
+        assert conn.route() is conn.route('default')
+
+        for job_ in jobs:
+            assert job_.Finish()
+        for item, (jid, state) in zip(items, results):
+            conn.route(item).delete(jid)
+    finally:
+        conn.router = router
+    _clean_up()
+
+def test_load_routing_avoids_backlogged_server():
+    backlogged = conn.servers[0]
+    backlog = [backlogged.put('backlog %s' % i) for i in range(20)]
+    router, conn.router = conn.router, routing.LoadRouter(tube='default')
+    conn.router.update(conn.servers)
+    try:
+        conn.router.sample()
+        assert set(conn.router.samples) == set(conn.servers)
+        jobs = [conn.put('job %s' % i) for i in range(10)]
+        assert backlogged not in [job_.Server for job_ in jobs]
+
+        # sampling in the background
+        conn.router.samples.clear()
+        conn.router.start()
+        time.sleep(.2)
+        assert set(conn.router.samples) == set(conn.servers)
+
+        for job_ in backlog + jobs:
+            assert job_.Finish()
+    finally:
+        conn.router.close()
+        conn.router = router
+    _clean_up()
+
+def _reserved():
+    return sum(server.stats()['data']['current-jobs-reserved']
+               for server in conn.servers)
+
+def test_reserve_one_does_not_over_reserve():
+    for server in conn.servers:
+        for i in range(2):
+            server._interact_many([protohandler.process_put('job %s' % i,
+                                                            1, 0, 60)])
+    first = conn.reserve_one()
+    assert first['data'] == 'job 0'
+    assert _reserved() == 1
+    # the next round starts at the next server
+    second = conn.reserve_one()
+    assert second.Server is not first.Server
+    assert _reserved() == 2
+
+    jobs = conn.reserve_many(3)
+    assert len(jobs) == min(3, 2 * len(conn.servers) - 2)
+    assert _reserved() == 2 + len(jobs)
+    for job_ in [first, second] + jobs:
+        assert job_.Finish()
+    _clean_up()
+
+def test_reserve_one_waits_for_a_job():
+    start = time.time()
+    assert conn.reserve_one(timeout=.3) is None
+    assert conn.reserve_many(5, timeout=0) == []
+    assert .3 <= time.time() - start < 1
+
+    putter = threading.Timer(.3, conn.servers[-1]._interact_many,
+                             [[protohandler.process_put('late', 1, 0, 60)]])
+    putter.start()
+    job_ = conn.reserve_one(timeout=5)
+    putter.join()
+    assert job_['data'] == 'late'
+    assert .3 <= time.time() - start < 2
+    assert job_.Finish()
+    _clean_up()
+
+def test_reserve_one_skips_a_server_that_does_not_answer():
+    standins = [StandIn({'reserve-with-timeout': None}).start(),
+                StandIn().start()]
+    try:
+        pool = multiserverconn.ServerPool(
+            [(s.host, s.port, False) for s in standins], timeout=.1)
+        hung, ok = pool.servers
+        start = time.time()
+        assert pool.reserve_one(timeout=.5) is None
+        assert time.time() - start < 1.5
+        assert hung.health.failures >= 1
+        assert ok.health.state == health.HEALTHY
+
+        standins[1].replies['reserve-with-timeout'] = 'RESERVED 7 3\r\nabc'
+        job_ = pool.reserve_one(timeout=.5)
+        assert job_['jid'] == 7
+        assert job_['data'] == 'abc'
+        pool.close()
+    finally:
+        for standin in standins:
+            standin.stop()
+
+def test_aggregate_stats():
+    combined = multiserverconn.aggregate_stats([
+        {'current-jobs-ready': 3, 'cmd-put': 10, 'uptime': 50, 'pid': 1,
+         'version': '1.10', 'draining': False, 'rusage-utime': 0.5},
+        {'current-jobs-ready': 4, 'cmd-put': 1, 'uptime': 20, 'pid': 2,
+         'version': '1.10', 'draining': True, 'rusage-utime': 0.25},
+        {'current-jobs-ready': 1, 'pid': 3}])
+    assert combined == {'current-jobs-ready': 8, 'cmd-put': 11, 'uptime': 50,
+                        'pid': set([1, 2, 3]), 'version': set(['1.10']),
+                        'draining': True, 'rusage-utime': 0.75}
+
+def _stats_reply(**stats):
+    body = '---\n' + ''.join('%s: %s\n' % (key.replace('_', '-'), value)
+                             for key, value in stats.items())
+    return 'OK %s\r\n%s' % (len(body), body)
+
+def test_pool_stats_are_combined_and_cached():
+    standins = [
+        StandIn({'stats': _stats_reply(current_jobs_ready=3, uptime=9),
+                 'stats-tube': _stats_reply(name='foo', current_jobs_ready=3)
+                 }).start(),
+        StandIn({'stats': _stats_reply(current_jobs_ready=4, uptime=5),
+                 'stats-tube': 'NOT_FOUND'}).start()]
+    try:
+        pool = multiserverconn.ServerPool(
+            [(s.host, s.port, False) for s in standins], stats_ttl=10)
+        first, second = pool.servers
+        stats = pool.stats()
+        assert stats['data'] == {'current-jobs-ready': 7, 'uptime': 9}
+        assert stats['servers'][first] == {'current-jobs-ready': 3,
+                                           'uptime': 9}
+        assert stats['servers'][second]['current-jobs-ready'] == 4
+
+        # the tube is only on the first server
+        stats = pool.stats_tube('foo')
+        assert stats['data']['name'] == set(['foo'])
+        assert stats['data']['current-jobs-ready'] == 3
+        assert stats['servers'].keys() == [first]
+
+        # cached until stats_ttl has passed
+        standins[0].replies['stats'] = _stats_reply(current_jobs_ready=0)
+        assert pool.stats()['data']['current-jobs-ready'] == 7
+        pool.stats_ttl = 0
+        assert pool.stats()['data']['current-jobs-ready'] == 4
+
+        standins[0].replies['stats-tube'] = 'NOT_FOUND'
+        assert_raises(errors.NotFound, pool.stats_tube, 'foo')
+        pool.close()
+    finally:
+        for standin in standins:
+            standin.stop()
+
+def test_draining_server_gets_no_puts():
+    standins = [StandIn({'put': 'DRAINING'}).start(), StandIn().start()]
+    try:
+        pool = multiserverconn.ServerPool(
+            [(s.host, s.port, False) for s in standins])
+        draining, ok = pool.servers
+        results = [pool.put('job') for i in range(10)]
+        assert [res['state'] for res in results] == ['ok'] * 10
+        assert not draining.health.accepts_puts()
+        assert ok.health.state == health.HEALTHY
+
+        # with no server to take them, puts give up after the retries
+        pool.remove_server(ok.server, ok.port)
+        start = time.time()
+        assert_raises(errors.NotConnected, pool.put, 'job')
+        assert time.time() - start < 1
+        pool.close()
+    finally:
+        for standin in standins:
+            standin.stop()
+
+def test_dead_server_circuit():
+    standins = [StandIn().start(), StandIn({'touch': None}).start()]
+    try:
+        pool = multiserverconn.ServerPool(
+            [(s.host, s.port, False) for s in standins], timeout=.1)
+        ok, dead = pool.servers
+        for i in range(dead.health.threshold):
+            assert pool.broadcast('touch', 1)[dead][0] == 'timeout'
+        assert dead.health.state == health.OPEN
+
+        # left alone while the circuit is open
+        start = time.time()
+        results = pool.broadcast('touch', 1)
+        assert time.time() - start < .1
+        assert results[ok][0] == 'ok'
+        assert isinstance(results[dead][1], errors.NotConnected)
+        assert dead._socket is None
+
+        # then probed, which closes the circuit if it works
+        standins[1].replies['touch'] = 'TOUCHED'
+        dead.health.retry_at = 0
+        assert pool.broadcast('touch', 1)[dead][0] == 'ok'
+        assert dead.health.state == health.HEALTHY
+        pool.close()
+    finally:
+        for standin in standins:
+            standin.stop()
+
+def test_watchlist_is_set_on_all_servers_at_once():
+    standins = [StandIn().start(), StandIn({'watch': None}).start()]
+    try:
+        pool = multiserverconn.ServerPool(
+            [(s.host, s.port, False) for s in standins], timeout=.2)
+        ok, slow = pool.servers
+        start = time.time()
+        pool.watchlist = ['foo', 'bar']
+        assert time.time() - start < .4
+        assert ok.watched_tubes == set(['foo', 'bar'])
+        # set up when it is reconnected
+        assert slow._socket is None
+        assert slow.watched_tubes == set(['foo', 'bar'])
+        assert set(pool.watchlist) == set(['foo', 'bar'])
+        pool.close()
+    finally:
+        for standin in standins:
+            standin.stop()
+
+def test_failed_tube_restore_leaves_server_disconnected():
+    standins = [StandIn().start(), StandIn().start()]
+    try:
+        pool = multiserverconn.ServerPool(
+            [(s.host, s.port, False) for s in standins], timeout=.2)
+        ok, full = pool.servers
+        pool.watchlist = ['foo']
+        standins[1].replies['watch'] = 'OUT_OF_MEMORY'
+        full.close()
+
+        for i in range(2):
+            results = pool.broadcast('stats')
+            assert results[ok][0] == 'ok'
+            assert results[full][0] == 'error'
+            assert full._socket is None
+            assert len(pool.multiplexer) == 1
+        assert full.watched_tubes == set(['foo'])
+        pool.close()
+    finally:
+        for standin in standins:
+            standin.stop()
+
+def test_use_reaches_servers_that_were_down():
+    standins = [StandIn().start(), StandIn().start()]
+    try:
+        pool = multiserverconn.ServerPool(
+            [(s.host, s.port, False) for s in standins], timeout=.2)
+        up, down = pool.servers
+        down.close()
+        standins[1].stop()
+        pool.use('foo')
+        assert up.used_tube == 'foo'
+        assert down._socket is None
+
+        standins[1] = StandIn({'use': 'USING foo'}, port=down.port).start()
+        results = pool.broadcast('stats')
+        assert results[down][0] == 'ok'
+        assert down.used_tube == 'foo'
+        assert standins[1].received[0] == 'use foo'
+        pool.close()
+    finally:
+        for standin in standins:
+            standin.stop()
+
+def test_broadcast():
+    results = conn.broadcast('stats')
+    assert set(results) == set(conn.servers)
+    for server, (status, stats) in results.iteritems():
+        assert status == 'ok'
+        assert stats['data']['current-connections'] >= 1
+
+    tubes = conn.list_tubes()
+    assert set(tubes) == set(conn.servers)
+    for server, res in tubes.iteritems():
+        assert 'default' in res['data']
+    _clean_up()
+
+def test_broadcast_statuses_and_deadlines():
+    standins = [StandIn().start(),
+                StandIn({'touch': 'NOT_FOUND'}).start(),
+                StandIn({'touch': None}).start(),
+                StandIn({'touch': None}).start()]
+    try:
+        pool = multiserverconn.ServerPool(
+            [(s.host, s.port, False) for s in standins], timeout=.2)
+        ok, error, slow, slower = pool.servers
+        slower.timeout = .5
+
+        start = time.time()
+        results = pool.broadcast('touch', 1)
+        elapsed = time.time() - start
+        # bounded by the longest deadline, not the sum of them
+        assert .5 <= elapsed < 1, elapsed
+
+        assert results[ok] == ('ok', {'state': 'ok'})
+        assert results[error][0] == 'error'
+        assert isinstance(results[error][1], errors.NotFound)
+        for server in slow, slower:
+            assert results[server][0] == 'timeout'
+            assert isinstance(results[server][1], errors.CommandTimeout)
+            assert server._socket is None
+
+        # the servers that timed out are reconnected for the next command
+        results = pool.broadcast('use', 'foo')
+        assert [results[s][0] for s in pool.servers] == ['ok'] * 4
+        pool.close()
+    finally:
+        for standin in standins:
+            standin.stop()
@@ -209,5 +209,77 @@ def test_put_extra():
     protohandler.MAX_JOB_SIZE = 10
     tools.assert_raises(errors.JobTooBig, protohandler.process_put,'a' * 11,0,0,0)
     protohandler.MAX_JOB_SIZE = oldmax
+    #or the size it is given
+    tools.assert_raises(errors.JobTooBig, protohandler.process_put,'a' * 11,0,0,0,10)
+    line, handler = protohandler.process_put('a' * (2**16),0,0,0,2**17)
+    assert line.startswith('put 0 0 0 65536\r\n')
 
 
+
+def check_reader(chunksize):
+    reader = protohandler.ResponseReader()
+    stream = ''
+    expected = []
+    for test in prototest_info:
+        callinfo, commandline, responseinfo = test
+        func = getattr(protohandler, callinfo[0])
+        for response, resultcomp in responseinfo:
+            line, handler = func(*callinfo[1])
+            reader.expect(handler)
+            stream += response
+            expected.append(resultcomp)
+    # an error reply in the middle of the stream
+    line, handler = protohandler.process_delete(12)
+    reader.expect(handler)
+    stream += 'NOT_FOUND\r\n'
+    expected.append(errors.NotFound)
+    line, handler = protohandler.process_use('bar')
+    reader.expect(handler)
+    stream += 'USING bar\r\n'
+    expected.append({'state':'ok', 'tube':'bar'})
+
+    results = []
+    while stream:
+        results.extend(reader.feed(stream[:chunksize]))
+        stream = stream[chunksize:]
+
+    assert len(reader) == 0
+    assert len(results) == len(expected)
+    for res, cv in zip(results, expected):
+        if isinstance(cv, dict):
+            assert res == cv, '%s %s' % (res, cv)
+        else:
+            assert isinstance(res, cv), '%s %s' % (res, cv)
+
+def test_response_reader():
+    for chunksize in (1, 2, 7, 10, 4096):
+        yield check_reader, chunksize
+
+def test_handler_body():
+    # a body near the max job size, fed in chunks
+    body = ''.join(chr(i % 256) for i in xrange(protohandler.MAX_JOB_SIZE - 1))
+    data = body + '\r\n'
+    line, handler = protohandler.process_reserve()
+    res = handler('RESERVED 7 %s\r\n' % (len(body),))
+    while res is None:
+        res = handler(data[:1000])
+        data = data[1000:]
+    assert res['data'] == body
+    assert res['bytes'] == len(body)
+
+    # eols at the end of the data belong to the job
+    line, handler = protohandler.process_reserve()
+    res = handler('RESERVED 7 4\r\nab\r\n\r\n')
+    assert res['data'] == 'ab\r\n'
+
+    # the reply line split in the middle of its eol
+    line, handler = protohandler.process_use('foo')
+    assert handler('USING foo\r') is None
+    assert handler('\n') == {'state':'ok', 'tube':'foo'}
+
+    # more data than the server announced
+    line, handler = protohandler.process_reserve()
+    tools.assert_raises(errors.ExpectedCrlf, handler, 'RESERVED 7 2\r\nabcd\r\n')
+    line, handler = protohandler.process_reserve()
+    handler('RESERVED 7 2\r\n')
+    tools.assert_raises(errors.ExpectedCrlf, handler, 'ab__')
@@ -12,14 +12,18 @@ import os
 import signal
 import socket
 import time
+import threading
+import subprocess
 
 from nose.tools import with_setup, assert_raises
 import nose
 
 from beanstalk import serverconn
 from beanstalk import errors
+from beanstalk import protohandler
 from spawner import spawner
 from config import get_config
+from standin import StandIn
 
 config = get_config("ServerConn")
 
@@ -225,3 +229,473 @@ def test_reserve_deadline_soon():
     x = conn.delete(jid)
     assert x['state'] == 'ok', "Didn't delete the job right. This could break future tests"
 
+
+def test_pipeline_sends_commands_and_reads_replies_in_order():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+
+    with conn.pipeline() as p:
+        for payload in ('foo', 'bar\r\nbar', 'baz'*100):
+            p.put(payload)
+    jids = [res['jid'] for res in p.results]
+    assert [res['state'] for res in p.results] == ['ok'] * 3
+    assert conn.stats()['data']['current-jobs-ready'] == 3
+
+    with conn.pipeline() as p:
+        for jid in jids:
+            p.reserve()
+    assert [res['jid'] for res in p.results] == jids
+    assert [res['data'] for res in p.results] == ['foo', 'bar\r\nbar', 'baz'*100]
+
+    # an error reply doesn't desync the replies that follow it
+    p = conn.pipeline()
+    p.delete(jids[0])
+    p.delete(jids[0])
+    p.delete(jids[1])
+    assert_raises(errors.NotFound, p.execute)
+    assert p.results[0]['state'] == 'ok'
+    assert isinstance(p.results[1], errors.NotFound)
+    assert p.results[2]['state'] == 'ok'
+
+    p.delete(jids[2])
+    p.stats_job(jids[2])
+    results = p.execute(raise_errors=False)
+    assert results[0]['state'] == 'ok'
+    assert isinstance(results[1], errors.NotFound)
+    assert conn.stats()['data']['current-jobs-ready'] == 0
+
+def test_set_hook():
+    seen = []
+    def hook(conn_, line, handler, interact):
+        assert conn_ is conn
+        seen.append(line)
+        return interact(line, handler)
+
+    conn.set_hook(hook)
+    try:
+        conn.list_tube_used()
+        conn.list_tubes_watched()
+    finally:
+        conn.set_hook()
+    assert seen == ['list-tube-used\r\n', 'list-tubes-watched\r\n']
+
+    conn.list_tube_used()
+    assert len(seen) == 2, "the hook wasn't removed"
+
+def _count_writes(c):
+    writes = []
+    def writeline(line, write=c._writeline):
+        writes.append(line)
+        return write(line)
+    c._writeline = writeline
+    return writes
+
+def test_tubes_are_cached():
+    writes = _count_writes(conn)
+    try:
+        conn.use('foo')
+        conn.watchlist = ['bar']
+        del writes[:]
+        assert conn.tube == 'foo'
+        assert conn.watchlist == ['bar']
+        assert writes == []
+
+        # out of step behind the connection's back, until it syncs
+        conn.used_tube = 'stale'
+        conn.sync_tubes()
+        assert len(writes) == 1
+        assert conn.tube == 'foo'
+        assert conn.watched_tubes == set(['bar'])
+    finally:
+        del conn._writeline
+        conn.use('default')
+        conn.watchlist = ['default']
+
+def test_watchlist_is_set_in_one_go():
+    tubes = ['tube%03d' % i for i in range(200)]
+    writes = _count_writes(conn)
+    try:
+        # default is ignored after the others are watched
+        conn.watchlist = tubes
+        assert len(writes) == 1
+        assert set(conn.list_tubes_watched()['data']) == set(tubes)
+        conn.watchlist = ['default']
+        assert len(writes) == 3
+        assert conn.list_tubes_watched()['data'] == ['default']
+    finally:
+        del conn._writeline
+        conn.watchlist = ['default']
+
+def test_job_queue_in_one_round_trip():
+    from beanstalk import job
+    class Job(job.Job):
+        def _serialize(self):
+            return self.data
+    j = Job(conn, data='queued', tube='foo')
+    writes = _count_writes(conn)
+    try:
+        j.Queue()
+        assert len(writes) == 1
+        assert conn.tube == 'default'
+        assert conn.stats_tube('foo')['data']['current-jobs-ready'] == 1
+        conn.use('foo')
+        conn.delete(conn.peek_ready()['jid'])
+    finally:
+        del conn._writeline
+        conn.use('default')
+        j._handled = True
+
+def _make_pool(*args, **kw):
+    return serverconn.ThreadedConnPool(args[0] if args else 2,
+                                       config.BEANSTALKD_HOST,
+                                       int(config.BEANSTALKD_PORT), **kw)
+
+def test_pool_checkout_and_release():
+    pool = _make_pool(2)
+    with pool.connection() as a:
+        assert a.stats()['state'] == 'ok'
+        with pool.connection() as b:
+            assert a is not b
+            assert_raises(serverconn.ConnectionError, pool.get, 0.1)
+    # connections are reused, not made again
+    with pool.connection() as c:
+        assert c in (a, b)
+    pool.close()
+    assert a._socket is None and b._socket is None
+    assert_raises(serverconn.ConnectionError, pool.get)
+
+def test_pool_waits_for_a_release():
+    pool = _make_pool(1)
+    conn_ = pool.get()
+    got = []
+    t = threading.Thread(target=lambda: got.append(pool.get(5)))
+    t.start()
+    time.sleep(.1)
+    assert not got
+    pool.release(conn_)
+    t.join()
+    assert got == [conn_]
+    pool.release(conn_)
+    pool.close()
+
+def test_pool_replaces_unhealthy_connections():
+    pool = _make_pool(2, minconns=1)
+    a = pool.get()
+    a.close()
+    pool.release(a)
+    b = pool.get()
+    assert b is not a and b._socket is not None
+
+    # unread data (e.g. the server hung up) makes a connection unhealthy too
+    b._writeline('list-tube-used\r\n')
+    time.sleep(.1)
+    pool.release(b)
+    c = pool.get()
+    assert c is not b
+    assert c.list_tube_used()['state'] == 'ok'
+    pool.release(c)
+    pool.close()
+
+def test_pool_checks_connections_past_fd_1024():
+    # push the connection's file descriptor past what select can take
+    filler = [open(os.devnull) for i in range(1030)]
+    try:
+        pool = _make_pool(1)
+        a = pool.get()
+        assert a.fileno() >= 1024
+        pool.release(a)
+        assert pool.get() is a
+        pool.release(a)
+        pool.close()
+    finally:
+        for f in filler:
+            f.close()
+
+def test_pool_idle_timeout():
+    pool = _make_pool(3, minconns=1, idle_timeout=.1)
+    a, b = pool.get(), pool.get()
+    pool.release(a)
+    pool.release(b)
+    time.sleep(.2)
+    c = pool.get()
+    # one of them was closed for being idle, the other is kept for minconns
+    assert [a._socket is None, b._socket is None].count(True) == 1
+    assert c._socket is not None
+    pool.release(c)
+    pool.close()
+
+def test_pool_thread_affinity():
+    pool = _make_pool(4, affinity=True)
+    other = pool.get()
+    mine = pool.get()
+    pool.release(mine)
+    pool.release(other)
+    # without affinity the most recently released would be handed out
+    assert pool.get() is mine
+    pool.release(mine)
+    pool.close()
+
+def test_put_many():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    conn.use('default')
+    conn.watchlist = ['default']
+
+    items = ['job %s' % i for i in range(20)]
+    items[3] = ('pri job', 5)
+    items[7] = ('a' * (2**16),)     # too big, never sent
+    items[9] = ('delayed job', 0, 100, 10)
+    results = conn.put_many(items, pri=10, window=6)
+
+    assert len(results) == len(items)
+    assert results[7][0] is None and isinstance(results[7][1], errors.JobTooBig)
+    jids = [jid for jid, state in results if jid]
+    assert len(jids) == 19
+    assert [state for jid, state in results if jid] == ['ok'] * 19
+    assert jids == sorted(jids)
+
+    assert conn.stats_job(results[3][0])['data']['pri'] == 5
+    assert conn.stats_job(results[0][0])['data']['pri'] == 10
+    assert conn.stats_job(results[9][0])['data']['state'] == 'delayed'
+    assert conn.stats()['data']['current-jobs-ready'] == 18
+
+    for jid in jids:
+        conn.delete(jid)
+    assert conn.put_many([]) == []
+
+def test_ack_many():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    conn.use('default')
+    conn.watchlist = ['default']
+
+    jids = [jid for jid, state in conn.put_many(['job %s' % i for i in range(8)])]
+    with conn.pipeline() as p:
+        for jid in jids:
+            p.reserve()
+
+    assert conn.touch_many(jids[:2]) == [(jid, 'ok') for jid in jids[:2]]
+    assert conn.bury_many(jids[:2], pri=3) == [(jid, 'ok') for jid in jids[:2]]
+    assert conn.stats()['data']['current-jobs-buried'] == 2
+    assert conn.release_many(jids[2:4], delay=0) == [(jid, 'ok') for jid in jids[2:4]]
+    assert conn.stats()['data']['current-jobs-ready'] == 2
+
+    results = conn.delete_many(jids + [jids[0]], window=3)
+    assert results[:-1] == [(jid, 'ok') for jid in jids]
+    assert results[-1][0] == jids[0]
+    assert isinstance(results[-1][1], errors.NotFound)
+    assert conn.stats()['data']['current-jobs-ready'] == 0
+
+def test_ack_batch():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    conn.use('default')
+    conn.watchlist = ['default']
+
+    flushed = []
+    jids = [jid for jid, state in conn.put_many(['job %s' % i for i in range(5)])]
+    with serverconn.AckBatch(conn, max_count=3, max_delay=60,
+                             on_flush=flushed.append) as acks:
+        for jid in jids:
+            acks.delete(jid)
+        # three were flushed for reaching max_count
+        assert len(acks) == 2
+        assert flushed == [[(jid, 'ok') for jid in jids[:3]]]
+        assert conn.stats()['data']['current-jobs-ready'] == 2
+    assert len(acks) == 0
+    assert conn.stats()['data']['current-jobs-ready'] == 0
+
+    # the last ones are flushed before the next reserve
+    jids = [jid for jid, state in conn.put_many(['job %s' % i for i in range(2)])]
+    with serverconn.AckBatch(conn, max_count=100, max_delay=60,
+                             on_flush=flushed.append) as acks:
+        acks.delete(jids[0])
+        assert len(acks) == 1
+        assert conn.reserve()['jid'] == jids[1]
+        assert len(acks) == 0
+        assert flushed[-1] == [(jids[0], 'ok')]
+        acks.delete(jids[1])
+        assert conn.reserve_batch(1) == []
+        assert len(acks) == 0
+    assert '_do_interaction' not in conn.__dict__
+    assert '_interact_many' not in conn.__dict__
+
+    acks = serverconn.AckBatch(conn, max_count=100, max_delay=.1)
+    acks.delete(jids[0])
+    acks.tick()
+    assert len(acks) == 1
+    time.sleep(.2)
+    acks.tick()
+    assert len(acks) == 0
+
+def test_reserve_batch():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    conn.use('default')
+    conn.watchlist = ['default']
+
+    assert conn.reserve_batch(10) == []
+    start = time.time()
+    assert conn.reserve_batch(10, timeout=1) == []
+    assert time.time() - start >= 1
+
+    jids = [jid for jid, state in conn.put_many(['job %s' % i for i in range(7)])]
+    jobs = conn.reserve_batch(5, window=2)
+    assert [job['jid'] for job in jobs] == jids[:5]
+    assert [job['data'] for job in jobs] == ['job %s' % i for i in range(5)]
+    jobs += conn.reserve_batch(5, timeout=None)
+    assert [job['jid'] for job in jobs] == jids
+    assert conn.stats()['data']['current-jobs-reserved'] == 7
+
+    conn.delete_many(jids)
+
+def test_prefetch_queue():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    conn.use('default')
+    conn.watchlist = ['default']
+
+    queue = serverconn.PrefetchQueue(conn, max_jobs=5)
+    assert queue.reserve(0) is None
+
+    items = [('job %s' % i, pri) for i, pri in enumerate([3, 1, 2, 1, 5, 4])]
+    jids = [jid for jid, state in conn.put_many(items)]
+    job = queue.reserve(0)
+    # the server hands out the best five, the buffer keeps them in order
+    assert job['jid'] == jids[1]
+    assert len(queue) == 4
+    assert conn.stats()['data']['current-jobs-reserved'] == 5
+    assert [queue.reserve(0)['jid'] for i in range(4)] == \
+           [jids[3], jids[2], jids[0], jids[5]]
+    assert len(queue) == 0
+
+    job = queue.reserve(0)
+    assert job['jid'] == jids[4]
+    conn.delete_many(jids)
+
+def test_prefetch_queue_releases_stale_jobs():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    first, second = [jid for jid, state in
+                     conn.put_many([('a', 1, 0, 3), ('b', 2, 0, 3)])]
+
+    queue = serverconn.PrefetchQueue(conn, max_jobs=2, min_time_left=1.5)
+    assert queue.reserve(0)['jid'] == first
+    conn.delete(first)
+    time.sleep(2)
+    # b has less than 1.5s left, it is released and reserved afresh
+    assert queue.reserve(0)['jid'] == second
+    assert queue.expired == 1
+    assert conn.stats_job(second)['data']['releases'] == 1
+    conn.delete(second)
+
+def test_prefetch_queue_bytes_and_close():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    jids = [jid for jid, state in
+            conn.put_many([('job %06d' % i, 7) for i in range(10)])]
+
+    with serverconn.PrefetchQueue(conn, max_jobs=10, max_bytes=30) as queue:
+        queue.reserve(0)
+        assert len(queue) == 0
+        queue.reserve(0)
+        # 10 bytes a job
+        assert len(queue) == 2
+        assert queue.bytes == 20
+    assert len(queue) == 0
+    stats = conn.stats()['data']
+    assert stats['current-jobs-reserved'] == 2
+    assert stats['current-jobs-ready'] == 8
+    assert conn.stats_job(jids[2])['data']['pri'] == 7
+    conn.delete_many(jids)
+
+def _beanstalkd(port):
+    process = subprocess.Popen([config.BEANSTALKD, "-l",
+                                config.BEANSTALKD_HOST, "-p", str(port)])
+    time.sleep(0.1)
+    return process
+
+def _stop(process):
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+
+def test_lost_connection_raises_not_connected():
+    port = int(config.BEANSTALKD_PORT) + 100
+    process = _beanstalkd(port)
+    try:
+        c = serverconn.ServerConn(config.BEANSTALKD_HOST, port)
+        _stop(process)
+        assert_raises(errors.NotConnected, c.stats)
+        assert c._socket is None
+    finally:
+        _stop(process)
+
+def test_reconnect_restores_tubes():
+    port = int(config.BEANSTALKD_PORT) + 100
+    process = _beanstalkd(port)
+    try:
+        c = serverconn.ServerConn(config.BEANSTALKD_HOST, port,
+                                  reconnect=True)
+        assert c.max_job_size == 65535
+        c.use('foo')
+        with c.pipeline() as p:
+            p.watch('bar')
+            p.watch('baz')
+        c.ignore('default')
+        assert c.used_tube == 'foo'
+        assert c.watched_tubes == set(['bar', 'baz'])
+
+        _stop(process)
+        process = _beanstalkd(port)
+        # sent again on the new connection, with the tubes as they were
+        assert set(c.list_tubes_watched()['data']) == set(['bar', 'baz'])
+        assert c.list_tube_used()['tube'] == 'foo'
+
+        # a put may have been done before the connection was lost, so it
+        # isn't sent again; the connection is remade all the same
+        _stop(process)
+        process = _beanstalkd(port)
+        assert_raises(errors.NotConnected, c.put, 'job')
+        assert c._socket is not None
+        assert c.put('job')['state'] == 'ok'
+        assert c.stats_tube('foo')['data']['current-jobs-ready'] == 1
+
+        # it gives up when the server doesn't come back
+        _stop(process)
+        c.reconnect_delay = .01
+        start = time.time()
+        assert_raises(errors.NotConnected, c.stats)
+        assert time.time() - start < 1
+    finally:
+        _stop(process)
+
+def test_max_job_size_is_per_connection():
+    oldmax = protohandler.MAX_JOB_SIZE
+    stats = '---\nmax-job-size: 20\n'
+    # connecting sends nothing
+    standin = StandIn({'stats': None}).start()
+    try:
+        c = serverconn.ServerConn(standin.host, standin.port,
+                                  max_job_size=100)
+        assert_raises(errors.JobTooBig, c.put, 'a' * 100)
+        assert c.put('a' * 99)['jid'] == 1
+
+        # asked for on the first put, then kept for the server
+        standin.replies['stats'] = 'OK %s\r\n%s' % (len(stats), stats)
+        c = serverconn.ServerConn(standin.host, standin.port)
+        assert_raises(errors.JobTooBig, c.put, 'a' * 20)
+        assert serverconn.MAX_JOB_SIZES[(standin.host, standin.port)] == 20
+        standin.replies['stats'] = None
+        c.connect()
+        results = c.put_many(['a' * 19, 'a' * 20])
+        assert results[0] == (1, 'ok')
+        assert isinstance(results[1][1], errors.JobTooBig)
+        with c.pipeline() as p:
+            assert_raises(errors.JobTooBig, p.put, 'a' * 20)
+        c = serverconn.ServerConn(standin.host, standin.port)
+        assert c.max_job_size == 20
+        assert protohandler.MAX_JOB_SIZE == oldmax
+    finally:
+        serverconn.MAX_JOB_SIZES.pop((standin.host, standin.port), None)
+        standin.stop()
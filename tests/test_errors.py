@@ -24,3 +24,8 @@ def test_checkError():
 
     for error, rstring in errorlist:
         yield t_func, rstring, error
+
+def test_checkError_passes_other_responses():
+    for rstring in ['INSERTED 3', 'RESERVED 12 5', 'TIMED_OUT', 'OK 15',
+                    'USING default', 'NOT_CONNECTED', 'UNEXPECTED_RESPONSE']:
+        yield errors.checkError, rstring
@@ -0,0 +1,64 @@
+"""
+Server health (circuit breaker) tests. These don't need a server.
+"""
+
+from beanstalk import health
+
+def test_backoff():
+    delays = [health.backoff(i, .1, 1.0, .5) for i in range(6)]
+    for delay, full in zip(delays, [.1, .2, .4, .8, 1.0, 1.0]):
+        assert full / 2 <= delay <= full
+    assert health.backoff(3, .1, 1.0, 0) == .8
+
+def test_circuit_opens_after_threshold_failures():
+    now = [100.0]
+    h = health.ServerHealth(threshold=3, base_delay=1, jitter=0,
+                            clock=lambda: now[0])
+    assert h.state == health.HEALTHY and h.available()
+    h.failure()
+    h.failure()
+    assert h.state == health.DEGRADED and h.available()
+    h.success()
+    assert h.state == health.HEALTHY and h.failures == 0
+
+    for i in range(3):
+        h.failure()
+    assert h.state == health.OPEN
+    assert not h.available()
+    now[0] += 1
+    assert h.available()
+
+def test_half_open_probe():
+    now = [100.0]
+    h = health.ServerHealth(threshold=1, base_delay=1, jitter=0,
+                            clock=lambda: now[0])
+    h.failure()
+    now[0] += 1
+    assert h.available()
+    h.attempt()
+    # one probe at a time
+    assert h.state == health.HALF_OPEN
+    assert not h.available()
+
+    # a failed probe opens the circuit again, for twice as long
+    h.failure()
+    assert h.state == health.OPEN
+    now[0] += 1.5
+    assert not h.available()
+    now[0] += .5
+    assert h.available()
+    h.attempt()
+    h.success()
+    assert h.state == health.HEALTHY and h.available()
+    # and the delay starts over
+    h.failure()
+    assert h.retry_at == now[0] + 1
+
+def test_draining():
+    now = [100.0]
+    h = health.ServerHealth(drain_delay=5, clock=lambda: now[0])
+    h.drain()
+    assert h.available()
+    assert not h.accepts_puts()
+    now[0] += 5
+    assert h.accepts_puts()
@@ -0,0 +1,97 @@
+"""
+Keepalive tests.
+"""
+
+import time
+
+from beanstalk import serverconn
+from beanstalk import keepalive
+from beanstalk import job
+from spawner import spawner
+from config import get_config
+
+config = get_config("ServerConn")
+
+# created during setup
+conn = None
+
+def setup():
+    spawner.spawn(host=config.BEANSTALKD_HOST, port=config.BEANSTALKD_PORT, path=config.BEANSTALKD)
+    global conn
+    conn = serverconn.ServerConn(config.BEANSTALKD_HOST, int(config.BEANSTALKD_PORT))
+
+def teardown():
+    spawner.terminate_all()
+
+def test_schedule():
+    schedule = keepalive.KeepaliveSchedule(fraction=.5, default_ttr=10)
+    schedule.add(1, now=100)
+    schedule.add(2, ttr=4, now=100)
+    assert schedule.due(101) == []
+    assert schedule.due(102) == [2]
+    assert sorted(schedule.due(105)) == [1, 2]
+    assert schedule.next_due() == 102
+
+    schedule.touched(2, now=102)
+    assert schedule.due(103.9) == []
+    assert schedule.due(104) == [2]
+
+    schedule.observe('delete 2\r\n', {'state': 'ok'})
+    assert 2 not in schedule
+    schedule.observe('release 1 0 0\r\n', {'state': 'ok'})
+    assert len(schedule) == 0
+
+def test_schedule_unknown_ttr():
+    schedule = keepalive.KeepaliveSchedule(fraction=.5)
+    schedule.observe('reserve-with-timeout 0\r\n', {'state': 'timeout'})
+    schedule.observe('reserve\r\n', {'state': 'ok', 'jid': 7, 'data': ''})
+    assert schedule.unknown() == [7]
+    assert schedule.due() == []
+    assert schedule.next_due() is None
+
+    # reserved 4s ago with a ttr of 10: due in 1s
+    schedule.known(7, 10, 6, now=100)
+    assert schedule.unknown() == []
+    assert schedule.due(100.5) == []
+    assert schedule.due(101) == [7]
+
+def test_keepalive_touches_until_finished():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    conn.put('slow', ttr=2)
+    conn.job = job.Job
+    ka = keepalive.Keepalive(conn, max_wait=.1).start()
+    try:
+        reserved = conn.reserve()
+        assert reserved.jid in ka.schedule
+
+        # twice the ttr, the job would be ready again without the touches
+        time.sleep(4)
+        assert ka.touches >= 2, ka.touches
+        other = serverconn.ServerConn(config.BEANSTALKD_HOST, int(config.BEANSTALKD_PORT))
+        assert other.reserve_with_timeout(0)['state'] == 'timeout'
+        other.close()
+
+        reserved.Finish()
+        assert len(ka.schedule) == 0
+        touches = ka.touches
+        time.sleep(1.5)
+        assert ka.touches == touches
+    finally:
+        ka.stop()
+        conn.job = False
+    assert '_do_interaction' not in conn.__dict__
+    assert '_interact_many' not in conn.__dict__
+
+def test_keepalive_tracks_batches():
+    conn.put_many(['a', 'b', 'c'], ttr=10)
+    ka = keepalive.Keepalive(conn).start()
+    try:
+        jobs = conn.reserve_batch(3)
+        assert sorted(ka.schedule.jobs) == sorted(j['jid'] for j in jobs)
+        ka.tick()
+        assert ka.schedule.unknown() == []
+        conn.delete_many(j['jid'] for j in jobs)
+        assert len(ka.schedule) == 0
+    finally:
+        ka.stop()
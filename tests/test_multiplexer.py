@@ -0,0 +1,96 @@
+"""
+Multiplexer tests, against stand-in servers.
+"""
+
+import time
+
+from beanstalk import serverconn
+from beanstalk import multiplexer
+from beanstalk import protohandler
+from beanstalk import errors
+from standin import StandIn
+
+standins = []
+
+def setup():
+    standins.append(StandIn().start())
+    # one that never answers a reserve
+    standins.append(StandIn({'reserve': None}).start())
+
+def teardown():
+    for standin in standins:
+        standin.stop()
+    del standins[:]
+
+def _connect(mux, standin):
+    conn = serverconn.ServerConn(standin.host, standin.port)
+    mux.register(conn)
+    return conn
+
+def test_poller():
+    poller = multiplexer.Poller()
+    assert poller.kind in ('epoll', 'poll', 'select')
+    assert poller.poll(0) == []
+    poller.close()
+
+def test_run_many_connections():
+    mux = multiplexer.Multiplexer()
+    conns = [_connect(mux, standins[0]) for i in range(200)]
+    assert len(mux) == 200
+
+    results = mux.run([(conn, [protohandler.process_put('x'),
+                               protohandler.process_delete(1)])
+                       for conn in conns], timeout=5)
+    assert len(results) == 200
+    for conn in conns:
+        put, delete = results[conn]
+        assert put['state'] == 'ok'
+        assert put['jid'] == 1
+        assert delete['state'] == 'ok'
+
+    # the connections are still in step, and still registered
+    results = mux.run([(conn, [protohandler.process_touch(1)])
+                       for conn in conns[:10]])
+    assert [results[conn][0]['state'] for conn in conns[:10]] == ['ok'] * 10
+    assert len(mux) == 200
+    for conn in conns:
+        conn.close()
+    mux.close()
+
+def test_run_error_replies():
+    mux = multiplexer.Multiplexer()
+    conn = _connect(mux, standins[0])
+    standins[0].replies['delete'] = 'NOT_FOUND'
+    try:
+        put, delete = mux.run([(conn, [protohandler.process_put('x'),
+                                       protohandler.process_delete(1)])])[conn]
+    finally:
+        standins[0].replies['delete'] = 'DELETED'
+    assert put['state'] == 'ok'
+    assert isinstance(delete, errors.NotFound)
+    conn.close()
+
+def test_run_deadline():
+    mux = multiplexer.Multiplexer()
+    slow = _connect(mux, standins[1])
+    fast = _connect(mux, standins[0])
+
+    start = time.time()
+    results = mux.run([(slow, [protohandler.process_put('x'),
+                               protohandler.process_reserve()]),
+                       (fast, [protohandler.process_put('x')], None)],
+                      timeout=.2)
+    elapsed = time.time() - start
+    assert .2 <= elapsed < 1, elapsed
+
+    put, reserve = results[slow]
+    assert put['state'] == 'ok'
+    assert isinstance(reserve, errors.CommandTimeout)
+    # it can't be used any more, the reply could still come
+    assert slow._socket is None
+    assert len(mux) == 1
+    assert results[fast][0]['state'] == 'ok'
+
+    res = mux.run([(slow, [protohandler.process_put('x')])])[slow]
+    assert isinstance(res[0], errors.NotConnected)
+    fast.close()
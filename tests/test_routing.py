@@ -0,0 +1,139 @@
+"""
+Routing strategy tests. These don't need a server.
+"""
+
+import random
+
+from beanstalk import errors
+from beanstalk import routing
+
+class Server(object):
+    def __init__(self, i):
+        self.server = '10.0.0.%s' % (i,)
+        self.port = 11300
+    def __repr__(self):
+        return '<Server %s>' % (self.server,)
+
+def _servers(n):
+    return [Server(i) for i in xrange(n)]
+
+def _counts(router, n, keys=None):
+    counts = {}
+    for i in xrange(n):
+        server = router.route(keys[i] if keys else None)
+        counts[server] = counts.get(server, 0) + 1
+    return counts
+
+def test_random_router_does_not_reseed():
+    def seed(*args):
+        raise AssertionError('random.seed called')
+    router = routing.RandomRouter(seed=1)
+    servers = _servers(4)
+    router.update(servers)
+    old_seed, random.seed = random.seed, seed
+    try:
+        counts = _counts(router, 4000)
+    finally:
+        random.seed = old_seed
+    assert set(counts) == set(servers)
+    assert min(counts.values()) > 800
+
+def test_random_router_weights_and_exclude():
+    servers = _servers(3)
+    router = routing.RandomRouter({('10.0.0.0', 11300): 3}, seed=1)
+    router.update(servers)
+    counts = _counts(router, 5000)
+    assert counts[servers[0]] > 2 * counts[servers[1]]
+    assert router.route(exclude=set(servers[1:])) is servers[0]
+    assert router.route(exclude=set(servers)) is None
+
+def test_round_robin_router():
+    servers = a, b, c = _servers(3)
+    router = routing.RoundRobinRouter()
+    router.update(servers)
+    assert [router.route() for i in range(6)] == [a, b, c, a, b, c]
+
+    router = routing.RoundRobinRouter({('10.0.0.0', 11300): 5})
+    router.update(servers)
+    # smooth: a's turns are spread out
+    assert [router.route() for i in range(7)] == [a, a, b, a, c, a, a]
+    assert router.route(exclude=set([a, b])) is c
+    assert router.route(exclude=set(servers)) is None
+
+def test_hash_router_is_consistent():
+    servers = _servers(10)
+    router = routing.HashRouter()
+    router.update(servers)
+    keys = ['tube-%s' % i for i in xrange(10000)]
+    before = dict((key, router.route(key)) for key in keys)
+    assert [router.route(key) for key in keys[:100]] == \
+           [before[key] for key in keys[:100]]
+
+    # spread about evenly
+    counts = _counts(router, len(keys), keys)
+    assert len(counts) == 10
+    assert min(counts.values()) > 500, counts
+
+    # an 11th server takes about 1/11 of the keys, from all the others
+    router.update(servers + [Server(10)])
+    moved = [key for key in keys if router.route(key) is not before[key]]
+    assert 0.05 < len(moved) / float(len(keys)) < 0.15, len(moved)
+    assert all(router.route(key) is not before[key] for key in moved)
+    assert set(router.route(key).server for key in moved) == set(['10.0.0.10'])
+
+    # removing a server only moves its own keys
+    router.update(servers[1:])
+    for key in keys:
+        if before[key] is not servers[0]:
+            assert router.route(key) is before[key]
+
+def test_hash_router_exclude():
+    servers = _servers(3)
+    router = routing.HashRouter()
+    router.update(servers)
+    owner = router.route('foo')
+    other = router.route('foo', exclude=set([owner]))
+    assert other is not None and other is not owner
+    assert router.route('foo', exclude=set(servers)) is None
+    assert routing.HashRouter().route('foo') is None
+
+def test_load_router_picks_the_least_loaded():
+    servers = a, b, c = _servers(3)
+    now = [100.0]
+    router = routing.LoadRouter(ttl=5, clock=lambda: now[0])
+    router.update(servers)
+    router.sampled(a, {'current-jobs-ready': 10, 'current-connections': 2})
+    router.sampled(b, {'current-jobs-ready': 3, 'current-connections': 2})
+    router.sampled(c, {'current-jobs-ready': 0, 'current-connections': 2,
+                       'binlog-oldest-index': 1, 'binlog-current-index': 2})
+    assert router.load({'current-jobs-ready': 3,
+                        'current-connections': 2}) == 5
+
+    # each job routed counts until the next sample
+    picks = [router.route() for i in range(10)]
+    assert picks[:3] == [b, b, b]
+    assert picks.count(a) == 2 and picks.count(b) == 8
+    assert router.route(exclude=set([a, b])) is c
+
+    router.sampled(b, {'current-jobs-ready': 100})
+    assert router.route() is a
+
+def test_load_router_avoids_draining_and_stale_servers():
+    servers = a, b, c = _servers(3)
+    now = [100.0]
+    router = routing.LoadRouter(ttl=5, clock=lambda: now[0])
+    router.update(servers)
+    router.sampled(a, {'current-jobs-ready': 0, 'draining': True})
+    router.sampled(b, {'current-jobs-ready': 50})
+    # c has no sample, so it is only used if no other server can be
+    assert router.route() is b
+    router.failed(b, errors.OutOfMemory())
+    assert router.route() is c
+
+    # not avoided any more, but the samples are stale
+    now[0] += 10
+    assert set(router.route() for i in range(6)) == set(servers)
+    router.sampled(c, {'current-jobs-ready': 1000})
+    assert router.route() is c
+    router.failed(c, errors.NotFound())
+    assert router.route() is c
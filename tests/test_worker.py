@@ -0,0 +1,277 @@
+"""
+Worker runtime tests.
+"""
+
+import os
+import signal
+import time
+import threading
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_raises
+
+from beanstalk import serverconn
+from beanstalk import worker
+from beanstalk import job
+from spawner import spawner
+from config import get_config
+
+config = get_config("ServerConn")
+
+# created during setup
+conn = None
+
+def setup():
+    spawner.spawn(host=config.BEANSTALKD_HOST, port=config.BEANSTALKD_PORT, path=config.BEANSTALKD)
+    global conn
+    conn = serverconn.ServerConn(config.BEANSTALKD_HOST, int(config.BEANSTALKD_PORT))
+
+def teardown():
+    spawner.terminate_all()
+
+def _make_worker(jobclass, **kw):
+    return worker.ThreadedWorker(config.BEANSTALKD_HOST,
+                                 int(config.BEANSTALKD_PORT), jobclass,
+                                 reserve_timeout=0, **kw)
+
+def _wait_for(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "timed out"
+        time.sleep(.01)
+
+class SleepJob(job.Job):
+    ran = []
+    lock = threading.Lock()
+    def run(self):
+        time.sleep(.1)
+        with self.lock:
+            self.ran.append(self.data)
+
+class FailingJob(job.Job):
+    def run(self):
+        raise ValueError(self.data)
+
+
+def test_worker_runs_and_deletes_jobs_in_parallel():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    del SleepJob.ran[:]
+    conn.put_many(['job %s' % i for i in range(20)])
+
+    w = _make_worker(SleepJob, nthreads=10)
+    start = time.time()
+    w.start()
+    _wait_for(lambda: w.counts['done'] == 20)
+    elapsed = time.time() - start
+    w.stop()
+
+    assert sorted(SleepJob.ran) == sorted('job %s' % i for i in range(20))
+    # 20 jobs of .1s each, in 10 threads
+    assert elapsed < 1, elapsed
+    stats = conn.stats()['data']
+    assert stats['current-jobs-ready'] == 0
+    assert stats['current-jobs-reserved'] == 0
+
+def test_worker_releases_then_buries_failing_jobs():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    jid = conn.put('fails', pri=7)['jid']
+
+    w = _make_worker(FailingJob, nthreads=1, retry_delay=0, max_failures=3)
+    w.start()
+    _wait_for(lambda: w.counts['buried'] == 1)
+    w.stop()
+
+    assert w.counts == {'done' : 0, 'released' : 2, 'buried' : 1}
+    stats = conn.stats_job(jid)['data']
+    assert stats['state'] == 'buried'
+    assert stats['pri'] == 7
+    conn.delete(jid)
+
+def test_worker_does_not_count_releases_at_shutdown_as_failures():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    jid = conn.put('fails')['jid']
+
+    w = _make_worker(FailingJob, nthreads=1, retry_delay=0, max_failures=3)
+    # released unstarted by two workers that were shut down
+    other = serverconn.ServerConn(config.BEANSTALKD_HOST,
+                                  int(config.BEANSTALKD_PORT), job=job.Job)
+    for i in range(2):
+        w._release_unstarted(other, [other.reserve()])
+    other.close()
+    assert conn.stats_job(jid)['data']['releases'] == 2
+
+    w.start()
+    _wait_for(lambda: w.counts['buried'] == 1)
+    w.stop()
+
+    assert w.counts == {'done' : 0, 'released' : 2, 'buried' : 1}
+    assert conn.stats_job(jid)['data']['releases'] == 4
+    assert w.failures[jid] == 0
+    conn.delete(jid)
+
+def test_failure_counts_are_bounded():
+    now = [100.0]
+    counts = worker.FailureCounts(size=4, ttl=10, clock=lambda: now[0])
+    assert [counts.add(5) for i in range(3)] == [1, 2, 3]
+    assert counts[5] == 3 and counts[6] == 0
+    # 9 takes the slot of 5, which starts over
+    assert counts.add(9) == 1
+    assert counts[5] == 0
+    assert counts.add(5) == 1
+    counts.discard(9)
+    assert counts[5] == 1
+    counts.discard(5)
+    assert counts[5] == 0
+    # and so does a job that hasn't failed for ttl seconds
+    counts.add(6)
+    now[0] += 10
+    assert counts[6] == 0
+    assert counts.add(6) == 1
+
+def test_release_unstarted_skips_jobs_that_are_gone():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    jids = [jid for jid, state in conn.put_many([('gone', 3), ('kept', 4)])]
+    w = _make_worker(SleepJob)
+    other = serverconn.ServerConn(config.BEANSTALKD_HOST,
+                                  int(config.BEANSTALKD_PORT), job=job.Job)
+    jobs = [other.reserve(), other.reserve()]
+    other.delete(jids[0])
+    w._release_unstarted(other, jobs)
+    assert all(job_._handled for job_ in jobs)
+    stats = conn.stats_job(jids[1])['data']
+    assert stats['state'] == 'ready' and stats['pri'] == 4
+    other.close()
+    conn.delete(jids[1])
+
+def test_worker_reserve_timeout_is_checked():
+    for timeout in None, -1:
+        assert_raises(ValueError, worker.ThreadedWorker,
+                      config.BEANSTALKD_HOST, int(config.BEANSTALKD_PORT),
+                      SleepJob, reserve_timeout=timeout)
+
+def test_worker_stop_releases_unstarted_jobs():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    del SleepJob.ran[:]
+    jids = [jid for jid, state in conn.put_many([('job %s' % i, 5) for i in range(10)])]
+
+    w = _make_worker(SleepJob, nthreads=1, prefetch=10)
+    w.start()
+    _wait_for(lambda: SleepJob.ran)
+    w.stop()
+
+    assert 0 < w.counts['done'] < 10
+    stats = conn.stats()['data']
+    assert stats['current-jobs-reserved'] == 0
+    assert stats['current-jobs-ready'] == 10 - w.counts['done']
+    for jid in jids[w.counts['done']:]:
+        assert conn.stats_job(jid)['data']['pri'] == 5
+        conn.delete(jid)
+
+class LongJob(job.Job):
+    def run(self):
+        time.sleep(3)
+
+def test_worker_keepalive_outlives_ttr():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    jid = conn.put('long', ttr=2)['jid']
+
+    w = _make_worker(LongJob, nthreads=2, keepalive=True)
+    w.start()
+    _wait_for(lambda: w.counts['done'] == 1)
+    w.stop()
+
+    # the other thread never got to run it again
+    assert w.counts == {'done' : 1, 'released' : 0, 'buried' : 0}
+    assert conn.stats()['data']['current-jobs-ready'] == 0
+
+def test_prefork_worker_runs_jobs_in_children():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    conn.put_many(['job %s' % i for i in range(20)])
+
+    w = worker.PreforkWorker(config.BEANSTALKD_HOST,
+                             int(config.BEANSTALKD_PORT), SleepJob,
+                             processes=2, nthreads=2, reserve_timeout=0,
+                             publish_interval=.05)
+    w.start()
+    try:
+        assert len(w.children) == 2
+        _wait_for(lambda: w.counts['done'] == 20)
+        per_child = [c['done'] for c in w.child_counts()]
+        assert sum(per_child) == 20
+        assert all(per_child), per_child
+    finally:
+        w.stop(5)
+    assert not w.children
+    stats = conn.stats()['data']
+    assert stats['current-jobs-ready'] == 0
+    assert stats['current-jobs-reserved'] == 0
+
+def test_prefork_worker_counts_failures_across_children():
+    assert conn.stats()['data']['current-jobs-ready'] == 0, "The server is not empty "\
+           "of jobs so test behaviour cannot be guaranteed.  Bailing out."
+    jid = conn.put('fails')['jid']
+
+    w = worker.PreforkWorker(config.BEANSTALKD_HOST,
+                             int(config.BEANSTALKD_PORT), FailingJob,
+                             processes=2, reserve_timeout=0, retry_delay=0,
+                             max_failures=3, publish_interval=.05)
+    w.start()
+    try:
+        _wait_for(lambda: w.counts['buried'] == 1)
+    finally:
+        w.stop(5)
+    assert w.counts == {'done' : 0, 'released' : 2, 'buried' : 1}
+    assert conn.stats_job(jid)['data']['state'] == 'buried'
+    conn.delete(jid)
+
+def _cpus_allowed(pid):
+    for line in open('/proc/%s/status' % pid):
+        if line.startswith('Cpus_allowed_list:'):
+            return line.split()[1]
+
+def test_prefork_worker_pins_children_to_cpus():
+    if not os.path.exists('/proc/self/status'):
+        raise SkipTest("no /proc to check the CPUs on")
+    allowed = worker.getaffinity()
+    assert allowed
+    # a CPU outside the allowed set is refused, which leaves this process
+    # as it is
+    outside = [cpu for cpu in range(worker.CPU_SETSIZE) if cpu not in allowed]
+    if outside:
+        assert_raises(OSError, worker.setaffinity, outside[0])
+    assert worker.getaffinity() == allowed
+
+    w = worker.PreforkWorker(config.BEANSTALKD_HOST,
+                             int(config.BEANSTALKD_PORT), SleepJob,
+                             processes=2, reserve_timeout=0, cpus=True)
+    w.start()
+    try:
+        for pid, slot in w.children.items():
+            expected = str(allowed[slot % len(allowed)])
+            _wait_for(lambda: _cpus_allowed(pid) == expected)
+    finally:
+        w.stop(5)
+
+def test_prefork_worker_restarts_dead_children():
+    w = worker.PreforkWorker(config.BEANSTALKD_HOST,
+                             int(config.BEANSTALKD_PORT), SleepJob,
+                             processes=2, reserve_timeout=0, restart_delay=0)
+    w.start()
+    try:
+        pid, slot = w.children.items()[0]
+        os.kill(pid, signal.SIGKILL)
+        _wait_for(lambda: w.poll() or w.restarts)
+        assert w.restarts == 1
+        assert len(w.children) == 2
+        assert pid not in w.children
+        assert sorted(w.children.values()) == [0, 1]
+    finally:
+        w.stop(5)
+    assert not w.children
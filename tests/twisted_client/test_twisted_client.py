@@ -5,11 +5,11 @@ sys.path.append('tests')
 import os
 
 from twisted.internet import protocol, reactor, defer
-from twisted.internet.task import Clock
+from twisted.internet.task import Clock, deferLater
 from twisted.internet.error import ConnectionDone, ConnectionRefusedError
 from twisted.trial import unittest
 
-from twisted_client import Beanstalk, BeanstalkClientFactory, BeanstalkClient
+from twisted_client import Beanstalk, BeanstalkClientFactory, BeanstalkClient, TwistedKeepalive
 from spawner import spawner
 from config import get_config
 
@@ -247,3 +247,39 @@ class BeanstalkClientTestCase(unittest.TestCase):
                     .addCallback(lambda _: self.client.peek_ready()).addCallbacks(self.fail, check_error)
 
         return self.client.connectTCP(self.host, self.port).addCallback(change_state).addCallback(reconnect).addCallback(check)
+
+
+class TwistedKeepaliveTestCase(unittest.TestCase):
+    def setUp(self):
+        _setUp(self)
+
+    def tearDown(self):
+        spawner.terminate_all()
+
+    def test_touches_until_finished(self):
+        def reserve(proto):
+            self.proto = proto
+            self.keepalive = TwistedKeepalive(proto, max_wait=.1).start()
+            return proto.put("JOB", ttr=2).addCallback(lambda _: proto.reserve())
+
+        def wait(job):
+            self.jid = job['jid']
+            self.failUnless(self.jid in self.keepalive.schedule)
+            # twice the ttr, the job would be ready again without the touches
+            return deferLater(reactor, 4, lambda: None)
+
+        def check_reserved(_):
+            self.failUnless(self.keepalive.touches >= 2)
+            return self.proto.stats_job(self.jid).addCallback(lambda stats: self.failUnlessEqual('reserved', stats['data']['state']))
+
+        def finish(_):
+            return self.proto.delete(self.jid)
+
+        def check_untracked(_):
+            self.failUnlessEqual(0, len(self.keepalive.schedule))
+            self.keepalive.stop()
+            self.failIf('_cmd' in self.proto.__dict__)
+            self.proto.transport.loseConnection()
+
+        return protocol.ClientCreator(reactor, Beanstalk).connectTCP(self.host, self.port).addCallback(reserve) \
+                   .addCallback(wait).addCallback(check_reserved).addCallback(finish).addCallback(check_untracked)